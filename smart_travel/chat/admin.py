@@ -1,7 +1,8 @@
 from django.contrib import admin
-from chat.models import ConversationModel
-from chat.cqrs.queries import QueryRetrieveMessages
+from chat.storage import transcript_cache
+from chat.models import CompletionUsageModel, ConversationModel
 from accounts.models import AccountModel
+from django.db.models import Avg, Count, F, Sum  # type: ignore
 from django.shortcuts import render  # type: ignore
 from django.urls import path  # type: ignore
 from dataclasses import dataclass
@@ -13,6 +14,9 @@ class UsageStatisics(object):
     num_conversations: int
     num_calls: int
     num_tokens: int
+    num_input_tokens: int
+    num_cached_tokens: int
+    avg_latency_ms: float
 
     @property
     def calls_per_user(self):
@@ -24,24 +28,34 @@ class UsageStatisics(object):
 
     @property
     def tokens_per_call(self):
-        return self.num_tokens / self.num_calls
+        return self.num_tokens / self.num_calls if self.num_calls else 0.0
+
+    @property
+    def cached_token_ratio(self):
+        # Cached tokens are a subset of the input tokens.
+        return self.num_cached_tokens / self.num_input_tokens if self.num_input_tokens else 0.0
 
     @classmethod
     def calculate(cls):
         num_accounts = AccountModel.objects.count()
         num_conversations = ConversationModel.objects.count()
-        num_calls = 0
-        num_tokens = 0
-
-        for conversation in ConversationModel.objects.all():
-            messages = QueryRetrieveMessages.execute(conversation.id)["data"]
-            tokens_per_response = [
-                len(msg.message.split(" ")) for msg in messages if msg.is_user
-            ]
-            num_calls += len(tokens_per_response)
-            num_tokens += sum(tokens_per_response)
+        usage = CompletionUsageModel.objects.aggregate(
+            num_calls=Count("id"),
+            num_tokens=Sum(F("input_tokens") + F("output_tokens")),
+            num_input_tokens=Sum("input_tokens"),
+            num_cached_tokens=Sum("cached_tokens"),
+            avg_latency_ms=Avg("latency_ms"),
+        )
 
-        return cls(num_accounts, num_conversations, num_calls, num_tokens)
+        return cls(
+            num_accounts,
+            num_conversations,
+            usage["num_calls"],
+            usage["num_tokens"] or 0,
+            usage["num_input_tokens"] or 0,
+            usage["num_cached_tokens"] or 0,
+            usage["avg_latency_ms"] or 0.0,
+        )
 
     def to_dict(self) -> dict[str, float]:
         return {
@@ -51,12 +65,16 @@ class UsageStatisics(object):
             "conversations_per_user": self.conversations_per_user,
             "calls_per_user": self.calls_per_user,
             "tokens_per_call": self.tokens_per_call,
+            "cached_token_ratio": self.cached_token_ratio,
+            "avg_latency_ms": self.avg_latency_ms,
         }
 
 
 def usage_statistics_page(request):
     stats = UsageStatisics.calculate()
-    return render(request, "usage.html", stats.to_dict())
+    context = stats.to_dict()
+    context["transcript_cache_hit_rate"] = transcript_cache.stats.hit_rate
+    return render(request, "usage.html", context)
 
 
 original_get_urls = admin.site.get_urls
@@ -76,3 +94,4 @@ def get_admin_urls():
 admin.site.get_urls = get_admin_urls
 
 admin.site.register(ConversationModel)
+admin.site.register(CompletionUsageModel)
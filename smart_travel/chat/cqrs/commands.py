@@ -1,16 +1,41 @@
-import hashlib
+from datetime import timedelta
 from pathlib import Path
+from typing import Optional
 
 from accounts.models import AccountModel
 from chat.models import ConversationModel
+from chat.signals import defer_storage_deletion
+from chat.storage import ConversationHistory, get_storage
+from chat.utility.group_commit import GroupCommitter
 from chat.utility.message import Message
+from chat.utility.retrieval import exchange_index
+from django.conf import settings  # type: ignore
+from django.db import transaction  # type: ignore
+from django.db.models import QuerySet  # type: ignore
 from django.utils import timezone  # type: ignore
 from eda.cqrs import CQRSCommand
 from eda.event_dispatcher import publish
-from chat.cqrs.queries import (
-    QueryFindConversation,
-    _ensure_file_exists,
-    _retrieve_convo_by_id,
+from chat.cqrs.queries import QueryFindConversation, _retrieve_convo_by_id
+
+DELETE_PARAMS__CHUNK_SIZE = 500
+
+
+def _touch_conversations(conv_ids: set[int]):
+    ConversationModel.objects.filter(id__in=conv_ids).update(
+        time_of_last_message=timezone.now()
+    )
+
+
+def _append_to_storage(convo: ConversationModel, messages: list[Message], fsync: bool):
+    get_storage().append_many(convo, messages, fsync=fsync)
+
+
+transcript_writer = GroupCommitter(
+    max_batch=settings.CHAT_GROUP_COMMIT_MAX_BATCH,
+    delay=settings.CHAT_GROUP_COMMIT_DELAY,
+    fsync_policy=settings.CHAT_TRANSCRIPT_FSYNC,
+    on_commit=_touch_conversations,
+    append=_append_to_storage,
 )
 
 
@@ -35,34 +60,18 @@ class CommandCreateConversation(CQRSCommand):
             ConversationModel: New conversation.
         """
 
-        def create_unique_filename(title: str, user_name: str) -> str:
-            """
-            Create a unique filename using the title and user name.
-
-            Note:
-                Uses hashing to create a unique filename for each user x title combination. This
-                makes it easier to handle special characters in the consituent title and user
-                strings if they have been hashed.
-
-            Args:
-                title (str): Title of the conversation.
-                user_name (str): User's user name.
-
-            Returns:
-                str: Unique filename.
-            """
-
-            title_hash = hashlib.sha256(title.encode("utf-8")).hexdigest()
-            user_name_hash = hashlib.sha256(user_name.encode("utf-8")).hexdigest()
-            return f"{user_name_hash}__{title_hash}.txt"
-
         try:
-            new_convo = ConversationModel.objects.create(
-                title=title,
-                user=user,
-                file_name=create_unique_filename(title, user.user_name),
-                time_of_last_message=timezone.now(),
-            )
+            # The file name is derived from the primary key, so it is only known once the
+            # row exists.
+            with transaction.atomic():
+                new_convo = ConversationModel.objects.create(
+                    title=title,
+                    user=user,
+                    file_name="",
+                    time_of_last_message=timezone.now(),
+                )
+                new_convo.file_name = ConversationModel.storage_name(new_convo.id)
+                new_convo.save(update_fields=["file_name"])
         except Exception:
             return False
 
@@ -84,6 +93,7 @@ class CommandDeleteConversation(CQRSCommand):
             convo = _retrieve_convo_by_id(conv_id)
             if convo.user.id != user_id:
                 return False
+            # Its messages are deleted as well, see `chat.signals`.
             convo.delete()
         except Exception:
             return False
@@ -92,6 +102,150 @@ class CommandDeleteConversation(CQRSCommand):
         return True
 
 
+"""
+Command: Delete Conversations
+"""
+
+
+def _delete_in_chunks(convos: QuerySet, chunk_size: int) -> int:
+    """
+    Delete the matching conversations a chunk at a time.
+
+    Note:
+        Each chunk is deleted in its own short transaction, so other writers wait for one
+        chunk at most rather than the whole delete. The messages of a chunk are deleted
+        together once it has committed, see `ConversationStorage.delete_many`.
+
+    Returns:
+        int: Number of conversations deleted.
+    """
+
+    storage = get_storage()
+    num_deleted = 0
+    while True:
+        chunk = list(convos.order_by("id").values_list("id", flat=True)[:chunk_size])
+        if not len(chunk):
+            return num_deleted
+        with defer_storage_deletion() as deleted, transaction.atomic():
+            ConversationModel.objects.filter(id__in=chunk).delete()
+        transaction.on_commit(lambda deleted=deleted: storage.delete_many(deleted), robust=True)
+        num_deleted += len(deleted)
+
+
+class CommandDeleteConversations(CQRSCommand):
+    EVENT_NAME = "DELETE_CONVERSATIONS"
+
+    @staticmethod
+    def execute(user_id, conv_ids: list[int]) -> int:
+        """
+        Delete several conversations of a user at once, publishing a single event.
+
+        Args:
+            conv_ids (list[int]): Conversations to be deleted. Those of other users are
+                skipped.
+
+        Returns:
+            int: Number of conversations deleted.
+        """
+
+        try:
+            num_deleted = _delete_in_chunks(
+                ConversationModel.objects.filter(user_id=user_id, id__in=conv_ids),
+                DELETE_PARAMS__CHUNK_SIZE,
+            )
+        except Exception:
+            return 0
+
+        publish(CommandDeleteConversations.EVENT_NAME, {"num_deleted": num_deleted})
+        return num_deleted
+
+
+"""
+Command: Purge Conversations
+"""
+
+
+class CommandPurgeConversations(CQRSCommand):
+    EVENT_NAME = "PURGE_CONVERSATIONS"
+
+    @staticmethod
+    def execute(idle_days: int, chunk_size: int = DELETE_PARAMS__CHUNK_SIZE) -> int:
+        """
+        Delete every conversation without new messages for a number of days, publishing a
+        single event.
+
+        Args:
+            idle_days (int): Minimum number of days since the last message.
+            chunk_size (int, optional): Number of conversations deleted per transaction.
+                Defaults to DELETE_PARAMS__CHUNK_SIZE.
+
+        Returns:
+            int: Number of conversations deleted.
+        """
+
+        cutoff = timezone.now() - timedelta(days=idle_days)
+        num_deleted = _delete_in_chunks(
+            ConversationModel.objects.filter(time_of_last_message__lt=cutoff), chunk_size
+        )
+        publish(
+            CommandPurgeConversations.EVENT_NAME,
+            {"num_deleted": num_deleted, "idle_days": idle_days},
+        )
+        return num_deleted
+
+
+"""
+Command: Fork Conversation
+"""
+
+
+class CommandForkConversation(CQRSCommand):
+    EVENT_NAME = "FORK_CONVERSATION"
+
+    @staticmethod
+    def execute(
+        user_id, conv_id: int, num_messages: int, title: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        Start a new conversation from the first messages of an existing one.
+
+        Note:
+            Nothing is copied, the fork reads the shared messages from its parent and stores
+            only the messages added to it, see `ConversationHistory`.
+
+        Args:
+            conv_id (int): Conversation to be forked.
+            num_messages (int): Number of its messages the fork starts with.
+            title (Optional[str], optional): Title of the fork. Defaults to None, using the
+                title of the conversation.
+
+        Returns:
+            Optional[int]: ID of the fork, or None if it could not be created.
+        """
+
+        try:
+            parent = _retrieve_convo_by_id(conv_id)
+            if parent.user_id != user_id:
+                return None
+            num_messages = min(max(num_messages, 0), ConversationHistory(parent).count())
+            with transaction.atomic():
+                fork = ConversationModel.objects.create(
+                    title=(parent.title if title is None else title)[:50],
+                    user_id=parent.user_id,
+                    file_name="",
+                    time_of_last_message=timezone.now(),
+                    parent=parent,
+                    fork_point=num_messages,
+                )
+                fork.file_name = ConversationModel.storage_name(fork.id)
+                fork.save(update_fields=["file_name"])
+        except Exception:
+            return None
+
+        publish(CommandForkConversation.EVENT_NAME, {"conv_id": fork.id, "parent_id": parent.id})
+        return fork.id
+
+
 """
 Command: Save Message
 """
@@ -103,18 +257,21 @@ class CommandSaveMessage(CQRSCommand):
     @staticmethod
     def execute(conv_id: int, message: Message) -> bool:
         """
-        Save the message to this conversation's file.
+        Save the message to this conversation's storage, see `get_storage`.
+
+        Note:
+            Appends from concurrent chats are batched into group commits, see
+            `GroupCommitter`.
 
         Args:
             message (Message): Message to be saved.
         """
         try:
-            convo = _retrieve_convo_by_id(conv_id)
-            _ensure_file_exists(convo.abs_path)
-            with open(convo.abs_path, "a") as conv_file:
-                conv_file.write(message.serialize())
-            convo.time_of_last_message = timezone.now()
-            convo.save()
+            # Only what the write needs, the timestamp is updated without a full save.
+            convo = ConversationModel.objects.only("file_name", "user_id").get(id=conv_id)
+            if not transcript_writer.write(conv_id, convo, message):
+                return False
+            exchange_index.observe(conv_id, convo.user_id, message)
         except Exception:
             return False
 
@@ -3,6 +3,7 @@ from typing import Any, Optional
 
 from accounts.models import AccountModel
 from chat.models import ConversationModel
+from chat.storage import ConversationHistory
 from eda.cqrs import CQRSQuery, CQRSQueryResponse
 from eda.event_dispatcher import publish
 from chat.utility.message import Message
@@ -14,18 +15,6 @@ Auxillary
 """
 
 
-def _ensure_file_exists(abs_path: Path):
-    """
-    Ensure this conversation's file exists. If it does not, then create the
-    requisite directories with the conversation file.
-    """
-    if abs_path.exists():
-        return
-    if not abs_path.parent.exists():
-        abs_path.parent.mkdir(parents=True)
-    abs_path.touch()
-
-
 def _retrieve_convo_by_id(conv_id: int) -> ConversationModel:
     result = QueryFindConversation.execute(chat_id=conv_id)
     assert result["status"]
@@ -95,12 +84,16 @@ class QueryRetrieveMessages(CQRSQuery):
     EVENT_NAME = "RETRIEVED_MESSAGES"
 
     @staticmethod
-    def execute(conv_id: int) -> QueryRetrieveMessagesResponse:
+    def execute(
+        conv_id: int, start: int = 0, limit: Optional[int] = None
+    ) -> QueryRetrieveMessagesResponse:
         """
-        Retrieve messages from this conversation's file.
+        Retrieve messages from this conversation's history, see `ConversationHistory`.
 
-        Note:
-            If the file does not exist prior, it will be created.
+        Args:
+            start (int, optional): Index of the first message to retrieve. Defaults to 0.
+            limit (Optional[int], optional): Maximum number of messages to retrieve. Defaults to
+                None, retrieving all of them.
 
         Returns:
             list[Message]: Loaded messages.
@@ -108,9 +101,9 @@ class QueryRetrieveMessages(CQRSQuery):
 
         try:
             convo = _retrieve_convo_by_id(conv_id)
-            _ensure_file_exists(convo.abs_path)
-            with open(convo.abs_path, "r") as conv_file:
-                messages = Message.deserialize_messages(conv_file.readlines())
+            messages = ConversationHistory(convo).read(
+                start, None if limit is None else start + limit
+            )
         except Exception:
             return QueryRetrieveMessagesResponse(status=False, title="", data=[])
 
@@ -118,3 +111,112 @@ class QueryRetrieveMessages(CQRSQuery):
         return QueryRetrieveMessagesResponse(
             status=True, title=convo.title, data=messages
         )
+
+
+"""
+Query: Retrieve Recent Messages
+"""
+
+
+class QueryRetrieveRecentMessages(CQRSQuery):
+    EVENT_NAME = "RETRIEVED_RECENT_MESSAGES"
+
+    @staticmethod
+    def execute(conv_id: int, n: int) -> QueryRetrieveMessagesResponse:
+        """
+        Retrieve the last n messages of this conversation.
+
+        Note:
+            Only the tail of the conversation is read, so the cost does not grow with the
+            length of the conversation.
+
+        Args:
+            n (int): Maximum number of messages to retrieve.
+
+        Returns:
+            list[Message]: Loaded messages in order.
+        """
+
+        try:
+            convo = _retrieve_convo_by_id(conv_id)
+            messages = ConversationHistory(convo).read_tail(n)
+        except Exception:
+            return QueryRetrieveMessagesResponse(status=False, title="", data=[])
+
+        publish(QueryRetrieveRecentMessages.EVENT_NAME)
+        return QueryRetrieveMessagesResponse(status=True, title=convo.title, data=messages)
+
+
+"""
+Query: Retrieve Messages Since
+"""
+
+
+class QueryRetrieveMessagesSinceResponse(QueryRetrieveMessagesResponse):
+    next_seq: int
+
+
+class QueryRetrieveMessagesSince(CQRSQuery):
+    EVENT_NAME = "RETRIEVED_MESSAGES_SINCE"
+
+    @staticmethod
+    def execute(conv_id: int, seq: int) -> QueryRetrieveMessagesSinceResponse:
+        """
+        Retrieve the messages of this conversation from a sequence number onwards.
+
+        Note:
+            Messages are numbered from 0 in the order they were saved and the numbers never
+            change. A client that has seen n messages passes n and then the returned
+            `next_seq`, so each call only reads what is new.
+
+        Args:
+            seq (int): Sequence number of the first message to retrieve.
+
+        Returns:
+            list[Message]: Loaded messages in order, and the sequence number following them.
+        """
+
+        seq = max(seq, 0)
+        try:
+            convo = _retrieve_convo_by_id(conv_id)
+            messages = ConversationHistory(convo).read_since(seq)
+        except Exception:
+            return QueryRetrieveMessagesSinceResponse(
+                status=False, title="", data=[], next_seq=seq
+            )
+
+        publish(QueryRetrieveMessagesSince.EVENT_NAME)
+        return QueryRetrieveMessagesSinceResponse(
+            status=True, title=convo.title, data=messages, next_seq=seq + len(messages)
+        )
+
+
+"""
+Query: Count Messages
+"""
+
+
+class QueryCountMessagesResponse(CQRSQueryResponse):
+    data: int
+
+
+class QueryCountMessages(CQRSQuery):
+    EVENT_NAME = "COUNTED_MESSAGES"
+
+    @staticmethod
+    def execute(conv_id: int) -> QueryCountMessagesResponse:
+        """
+        Count the messages of this conversation.
+
+        Returns:
+            int: Number of messages.
+        """
+
+        try:
+            convo = _retrieve_convo_by_id(conv_id)
+            count = ConversationHistory(convo).count()
+        except Exception:
+            return QueryCountMessagesResponse(status=False, data=0)
+
+        publish(QueryCountMessages.EVENT_NAME)
+        return QueryCountMessagesResponse(status=True, data=count)
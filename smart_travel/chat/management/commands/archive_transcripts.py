@@ -0,0 +1,69 @@
+from datetime import timedelta
+
+from chat.models import ConversationModel
+from chat.storage import MESSAGE_STORE__FILE
+from chat.utility.transcript import TRANSCRIPT_ARCHIVE_CODECS
+from django.conf import settings  # type: ignore
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.utils import timezone  # type: ignore
+
+
+class Command(BaseCommand):
+    help = (
+        "Compress the transcripts of conversations without new messages for a number of "
+        "days. Safe to run while the site is up, e.g. daily from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.CHAT_TRANSCRIPT_ARCHIVE_AFTER_DAYS,
+            help="Archive conversations idle for at least this many days.",
+        )
+        parser.add_argument(
+            "--codec",
+            choices=list(TRANSCRIPT_ARCHIVE_CODECS),
+            default=settings.CHAT_TRANSCRIPT_ARCHIVE_CODEC,
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only report what would be archived."
+        )
+
+    def handle(self, *args, **options):
+        if settings.CHAT_MESSAGE_STORE != MESSAGE_STORE__FILE:
+            raise CommandError(
+                f"Only transcript files are archived, the message store is "
+                f"{settings.CHAT_MESSAGE_STORE!r}."
+            )
+
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        convos = (
+            ConversationModel.objects.filter(time_of_last_message__lt=cutoff)
+            .only("id", "file_name")
+            .iterator(chunk_size=1000)
+        )
+        num_archived = num_bytes_before = num_bytes_after = 0
+        for convo in convos:
+            transcript = convo.transcript
+            if options["dry_run"]:
+                if transcript.path.exists():
+                    num_archived += 1
+                    num_bytes_before += transcript.path.stat().st_size
+                continue
+            sizes = transcript.archive(options["codec"])
+            if sizes is not None:
+                num_archived += 1
+                num_bytes_before += sizes[0]
+                num_bytes_after += sizes[1]
+
+        if options["dry_run"]:
+            self.stdout.write(
+                f"Would archive {num_archived} transcripts "
+                f"({num_bytes_before / (1 << 20):.1f} MB)."
+            )
+            return
+        self.stdout.write(
+            f"Archived {num_archived} transcripts, "
+            f"{num_bytes_before / (1 << 20):.1f} MB -> {num_bytes_after / (1 << 20):.1f} MB."
+        )
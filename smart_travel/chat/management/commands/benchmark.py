@@ -0,0 +1,425 @@
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from accounts.models import AccountModel
+from chat.models import ConversationModel
+from chat.storage import STORAGE_BACKENDS, FileSystemStorage, SQLiteBlobStorage
+from chat.utility.group_commit import GroupCommitter
+from chat.utility.handle_pool import handle_pool
+from chat.utility.message import Message, _parse_source_label, render_markdown
+from chat.utility.transcript import TranscriptFile
+from chat.utility.transcript_cache import TranscriptCache
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.db import transaction  # type: ignore
+from django.utils import timezone  # type: ignore
+
+
+def _measure(fn: Callable[[], Any], repeat: int) -> tuple[float, int]:
+    """
+    Time a function and measure its peak memory.
+
+    Returns:
+        tuple[float, int]: Best wall-clock time in seconds, and peak traced memory in bytes.
+    """
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def _sample_messages(num_bytes: int, lines_per_reply: int = 200) -> list[Message]:
+    reply = "".join(
+        f"- Day {idx}: visit the museum district, then dinner near the river.\n"
+        for idx in range(lines_per_reply)
+    )
+    messages = []
+    size = 0
+    while size < num_bytes:
+        messages.append(Message("Can you plan the next part of the trip?", True))
+        messages.append(Message(reply, False))
+        size += len(reply) + 40
+    return messages
+
+
+"""
+Suite: Parser
+"""
+
+
+def _deserialize_by_concatenation(raw_contents: list[str]) -> list[Message]:
+    # The parser as it was before messages were streamed, kept as the baseline.
+    messages = []
+    is_user = False
+    message = ""
+    source_label_encountered = False
+    for line in raw_contents:
+        if (next_is_user := _parse_source_label(line)) is not None:
+            if len(message) and source_label_encountered:
+                messages.append(Message(message, is_user))
+            is_user = next_is_user
+            message = ""
+            source_label_encountered = True
+        else:
+            message += line
+    if len(message) and source_label_encountered:
+        messages.append(Message(message, is_user))
+    return messages
+
+
+def _bench_parser(options: dict[str, Any], write: Callable[[str], None]):
+    messages = _sample_messages(options["size_mb"] * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_path = Path(tmp_dir) / "legacy.txt"
+        legacy_path.write_text("".join(message.serialize() for message in messages))
+        framed = TranscriptFile(Path(tmp_dir) / "framed.txt")
+        framed.append_many(messages)
+
+        def read_concatenation():
+            with open(legacy_path, "r") as infile:
+                return _deserialize_by_concatenation(infile.readlines())
+
+        def read_list():
+            with open(legacy_path, "r") as infile:
+                return Message.deserialize_messages(infile.readlines())
+
+        def stream_legacy():
+            for _ in TranscriptFile(legacy_path).iter_messages():
+                pass
+
+        def stream_framed():
+            for _ in framed.iter_messages():
+                pass
+
+        write(
+            f"{len(messages)} messages, {legacy_path.stat().st_size / 1024 / 1024:.1f} MB"
+        )
+        for name, fn in [
+            ("legacy, concatenation", read_concatenation),
+            ("legacy, joined", read_list),
+            ("legacy, streamed", stream_legacy),
+            ("framed, read all", framed.read_all),
+            ("framed, streamed", stream_framed),
+        ]:
+            seconds, peak = _measure(fn, options["repeat"])
+            write(f"{name:<30} {seconds * 1000:10.1f} ms {peak / 1024 / 1024:10.2f} MB peak")
+
+
+"""
+Suite: Messages
+"""
+
+
+@dataclass
+class _DictMessage(object):
+    # The message as it was before it was slotted, kept as the baseline.
+    message: str
+    is_user: bool
+    markdown: Optional[str] = None
+
+
+def _bench_messages(options: dict[str, Any], write: Callable[[str], None]):
+    num_messages = 10_000
+    texts = [f"Day {idx}: **museum** then dinner near the river." for idx in range(num_messages)]
+
+    def allocated(build: Callable[[], list]) -> int:
+        tracemalloc.start()
+        messages = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del messages
+        return current
+
+    for name, build in [
+        (
+            "dict dataclass",
+            lambda: [_DictMessage(text, idx % 2 == 0) for idx, text in enumerate(texts)],
+        ),
+        (
+            "dict dataclass, HTML stored",
+            lambda: [
+                _DictMessage(text, idx % 2 == 0, render_markdown(text))
+                for idx, text in enumerate(texts)
+            ],
+        ),
+        (
+            "slotted",
+            lambda: [Message(text, idx % 2 == 0) for idx, text in enumerate(texts)],
+        ),
+        (
+            "slotted, HTML rendered",
+            lambda: [
+                Message(text, idx % 2 == 0, render_markdown(text))
+                for idx, text in enumerate(texts)
+            ],
+        ),
+    ]:
+        num_bytes = allocated(build)
+        write(
+            f"{name:<30} {num_bytes / 1024:10.1f} KB per {num_messages} messages "
+            f"{num_bytes / num_messages:8.1f} B each"
+        )
+    write("Message texts are allocated up front and not counted.")
+
+
+"""
+Suite: Writes
+"""
+
+
+def _bench_writes(options: dict[str, Any], write: Callable[[str], None]):
+    num_threads = 32
+    messages_per_thread = 50
+    num_conversations = 8
+
+    def run(append: Callable[[int, Path, Message], Any], tmp_dir: str) -> float:
+        def writer(thread_idx: int):
+            for idx in range(messages_per_thread):
+                conv_id = (thread_idx + idx) % num_conversations
+                append(
+                    conv_id,
+                    Path(tmp_dir) / f"conversation_{conv_id}.txt",
+                    Message(f"Message {idx} of writer {thread_idx}", idx % 2 == 0),
+                )
+
+        threads = [threading.Thread(target=writer, args=(idx,)) for idx in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    num_messages = num_threads * messages_per_thread
+    write(f"{num_threads} writers, {num_messages} messages, {num_conversations} conversations")
+    for fsync in (False, True):
+        # Appending one message at a time needs a lock per transcript, as the group
+        # committer's leader provides, or concurrent appends would interleave.
+        locks = [threading.Lock() for _ in range(num_conversations)]
+
+        def append_each(conv_id: int, path: Path, message: Message):
+            with locks[conv_id]:
+                TranscriptFile(path).append_many([message], fsync=fsync)
+
+        committer = GroupCommitter(fsync_policy="always" if fsync else "never")
+        for name, append in [
+            ("per message", append_each),
+            ("group commit", committer.write),
+        ]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                seconds = run(append, tmp_dir)
+            write(
+                f"{name + (', fsync' if fsync else ''):<30} {seconds * 1000:10.1f} ms "
+                f"{num_messages / seconds:10.0f} msg/s"
+            )
+        write(f"{'':<30} mean batch of {committer.mean_batch_size:.1f} messages")
+
+
+"""
+Suite: Locks
+"""
+
+
+def _bench_locks(options: dict[str, Any], write: Callable[[str], None]):
+    num_threads = 32
+    ops_per_thread = 100
+    num_conversations = 16
+    global_lock = threading.Lock()
+
+    def run(coarse: bool, read_ratio: float, tmp_dir: str) -> float:
+        transcripts = [
+            TranscriptFile(Path(tmp_dir) / f"conversation_{idx}.txt")
+            for idx in range(num_conversations)
+        ]
+        for transcript in transcripts:
+            transcript.append_many(_sample_messages(64 * 1024, lines_per_reply=20))
+
+        def worker(thread_idx: int):
+            for idx in range(ops_per_thread):
+                transcript = transcripts[(thread_idx + idx) % num_conversations]
+                # Transcripts always lock per conversation, the coarse run additionally
+                # serializes every operation as a single global lock would.
+                with global_lock if coarse else nullcontext():
+                    if (idx % 10) < read_ratio * 10:
+                        transcript.read_tail(20)
+                    else:
+                        transcript.append_many([Message("Thanks!", True)], fsync=True)
+
+        threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    num_ops = num_threads * ops_per_thread
+    write(f"{num_threads} threads, {num_ops} operations, {num_conversations} conversations")
+    for read_ratio in (0.0, 0.5, 0.9):
+        for name, coarse in [("global lock", True), ("per conversation", False)]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                seconds = run(coarse, read_ratio, tmp_dir)
+            label = f"{name}, {read_ratio:.0%} reads"
+            write(f"{label:<30} {seconds * 1000:10.1f} ms {num_ops / seconds:10.0f} ops/s")
+
+
+"""
+Suite: Handles
+"""
+
+
+def _bench_handles(options: dict[str, Any], write: Callable[[str], None]):
+    num_ops = 5_000
+    num_conversations = 32
+
+    def run(tmp_dir: str) -> tuple[float, float]:
+        transcripts = [
+            TranscriptFile(Path(tmp_dir) / f"conversation_{idx}.txt")
+            for idx in range(num_conversations)
+        ]
+        for transcript in transcripts:
+            transcript.append_many(_sample_messages(16 * 1024, lines_per_reply=10))
+
+        start = time.perf_counter()
+        for idx in range(num_ops):
+            transcripts[idx % num_conversations].append(Message("Thanks!", True))
+        append_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for idx in range(num_ops):
+            transcripts[idx % num_conversations].read_tail(20)
+        return append_seconds, time.perf_counter() - start
+
+    write(f"{num_ops} appends and tail reads over {num_conversations} conversations")
+    max_handles = handle_pool.max_handles
+    try:
+        # Without room in the pool every handle is closed as soon as it is released.
+        for name, pool_size in [("open per call", 0), ("pooled", max_handles)]:
+            handle_pool.close_all()
+            handle_pool.max_handles = pool_size
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                append_seconds, read_seconds = run(tmp_dir)
+            write(
+                f"{name:<30} append {append_seconds / num_ops * 1e6:8.1f} us "
+                f"tail read {read_seconds / num_ops * 1e6:8.1f} us"
+            )
+    finally:
+        handle_pool.close_all()
+        handle_pool.max_handles = max_handles
+
+
+"""
+Suite: Storage
+"""
+
+
+def _bench_storage(options: dict[str, Any], write: Callable[[str], None]):
+    num_conversations = 20
+    num_turns = 25
+    reply = _sample_messages(1, lines_per_reply=30)[1]
+
+    def run(storage, convos: list[ConversationModel]) -> dict[str, float]:
+        timings = {"append": 0.0, "history": 0.0, "page": 0.0}
+        for turn in range(num_turns):
+            for convo in convos:
+                start = time.perf_counter()
+                storage.append(convo, Message(f"Question {turn}?", True))
+                timings["append"] += time.perf_counter() - start
+
+                # The agent is sent the recent history, then the reply is saved and the chat
+                # page shows the last messages.
+                start = time.perf_counter()
+                storage.read_tail(convo, 40)
+                timings["history"] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                storage.append(convo, reply)
+                timings["append"] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                storage.read(convo, -50)
+                storage.count(convo)
+                timings["page"] += time.perf_counter() - start
+        return timings
+
+    write(
+        f"{num_conversations} conversations x {num_turns} turns, "
+        f"{len(reply.message)} character replies"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir, transaction.atomic():
+        # Rows created for the run are rolled back at the end.
+        user = AccountModel.objects.create(
+            first_name="Benchmark", last_name="User", user_name="benchmark", password_hash=""
+        )
+        convos = [
+            ConversationModel.objects.create(
+                title=f"Benchmark {idx}",
+                user=user,
+                # An absolute file name places the transcript in the temporary directory.
+                file_name=str(Path(tmp_dir) / f"conversation_{idx}.txt"),
+                time_of_last_message=timezone.now(),
+            )
+            for idx in range(num_conversations)
+        ]
+        backends = dict(STORAGE_BACKENDS)
+        backends["file"] = lambda: FileSystemStorage(TranscriptCache(64 << 20, 4 << 20))
+        backends["sqlite_blob"] = lambda: SQLiteBlobStorage(Path(tmp_dir) / "messages.sqlite3")
+
+        num_turns_total = num_conversations * num_turns
+        for name, factory in backends.items():
+            storage = factory()
+            timings = run(storage, convos)
+            size = sum(storage.size(convo) for convo in convos)
+            write(
+                f"{name:<30} "
+                + " ".join(
+                    f"{op} {seconds / num_turns_total * 1e6:8.1f} us"
+                    for op, seconds in timings.items()
+                )
+                + f" size {size / 1024:8.1f} KB"
+            )
+            for convo in convos:
+                storage.delete(convo)
+        transaction.set_rollback(True)
+
+
+SUITES: dict[str, Callable[[dict[str, Any], Callable[[str], None]], None]] = {
+    "parser": _bench_parser,
+    "messages": _bench_messages,
+    "writes": _bench_writes,
+    "locks": _bench_locks,
+    "handles": _bench_handles,
+    "storage": _bench_storage,
+}
+
+
+class Command(BaseCommand):
+    help = "Run micro-benchmarks of the chat storage and parsing code."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "suites", nargs="*", help=f"Suites to run out of {', '.join(SUITES)}, all by default."
+        )
+        parser.add_argument("--size-mb", type=int, default=8, help="Size of sample transcripts.")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement.")
+
+    def handle(self, *args, **options):
+        suites: list[str] = options["suites"] or list(SUITES)
+        unknown = set(suites) - set(SUITES)
+        if unknown:
+            raise CommandError(f"Unknown suites: {', '.join(sorted(unknown))}.")
+        for name in suites:
+            self.stdout.write(f"== {name} ==")
+            SUITES[name](options, self.stdout.write)
@@ -0,0 +1,102 @@
+import gzip
+import json
+import sys
+from contextlib import nullcontext
+from typing import IO, Any, Iterator
+
+from accounts.models import AccountModel
+from chat.models import ConversationModel
+from chat.storage import get_storage
+from django.core.management.base import BaseCommand  # type: ignore
+
+EXPORT_PARAMS__CHUNK_SIZE = 1000
+
+
+def _records(users, convos) -> Iterator[dict[str, Any]]:
+    """
+    Users, then conversations, then the messages of each conversation in order.
+
+    Note:
+        Conversations are exported before any message, so an import knows the ID of every
+        conversation by the time its messages arrive. Forks export only their own messages,
+        with the parent they read the rest from.
+    """
+
+    for user in users.iterator(chunk_size=EXPORT_PARAMS__CHUNK_SIZE):
+        yield {
+            "type": "user",
+            "id": user.id,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "user_name": user.user_name,
+            "password_hash": user.password_hash,
+        }
+    for convo in convos.iterator(chunk_size=EXPORT_PARAMS__CHUNK_SIZE):
+        yield {
+            "type": "conversation",
+            "id": convo.id,
+            "user_id": convo.user_id,
+            "title": convo.title,
+            "time_of_last_message": convo.time_of_last_message.isoformat(),
+            "parent_id": convo.parent_id,
+            "fork_point": convo.fork_point,
+        }
+    storage = get_storage()
+    for convo in convos.only("id", "file_name").iterator(chunk_size=EXPORT_PARAMS__CHUNK_SIZE):
+        for seq, message in enumerate(storage.iter_messages(convo)):
+            yield {
+                "type": "message",
+                "conversation_id": convo.id,
+                "seq": seq,
+                "is_user": message.is_user,
+                "message": message.message,
+            }
+
+
+class Command(BaseCommand):
+    help = (
+        "Export users, conversations and messages as newline-delimited JSON, streamed in "
+        "constant memory. Read back with `import_conversations`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "output", help="File to write, '-' for stdout. Compressed if it ends in '.gz'."
+        )
+        parser.add_argument(
+            "--user",
+            action="append",
+            dest="user_names",
+            help="Only export this user's conversations. Can be given more than once.",
+        )
+
+    def handle(self, *args, **options):
+        users = AccountModel.objects.order_by("id")
+        if options["user_names"]:
+            users = users.filter(user_name__in=options["user_names"])
+        # A fork belongs to the user of its parent and has a higher ID, so parents are always
+        # exported, and imported, before their forks.
+        convos = ConversationModel.objects.filter(user__in=users).order_by("id")
+
+        counts = {"user": 0, "conversation": 0, "message": 0}
+        output = options["output"]
+        if output == "-":
+            outfile_context = nullcontext(sys.stdout)
+        elif output.endswith(".gz"):
+            outfile_context = gzip.open(output, "wt", encoding="utf-8")
+        else:
+            outfile_context = open(output, "w", encoding="utf-8")
+        with outfile_context as outfile:
+            self._write(outfile, _records(users, convos), counts)
+
+        self.stderr.write(
+            f"Exported {counts['user']} users, {counts['conversation']} conversations and "
+            f"{counts['message']} messages."
+        )
+
+    @staticmethod
+    def _write(outfile: IO[str], records: Iterator[dict[str, Any]], counts: dict[str, int]):
+        for record in records:
+            outfile.write(json.dumps(record, ensure_ascii=False))
+            outfile.write("\n")
+            counts[record["type"]] += 1
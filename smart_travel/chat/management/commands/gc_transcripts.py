@@ -0,0 +1,145 @@
+import os
+import re
+import shutil
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, Optional
+
+from chat.models import PROJECT_DIR, ConversationModel
+from chat.utility.handle_pool import handle_pool
+from chat.utility.locks import LOCK_FILE_SUFFIX, LockManager, transcript_locks
+from chat.utility.transcript import TranscriptFile
+from django.core.management.base import BaseCommand  # type: ignore
+
+GC_PARAMS__CHUNK_SIZE = 1000
+GC_PARAMS__MIN_AGE_MINUTES = 60
+
+# Sidecars of a transcript: its index, lock file, archives and temporary files of rewrites.
+_SIDECAR = re.compile(
+    r"^(?P<owner>.*?)(\.idx|\.lock|\.gz|\.xz|\.tmp|\.idx\.\d+\.\d+\.tmp)?$"
+)
+
+
+def _walk(root: Path, skip: Optional[Path] = None) -> Iterator[os.DirEntry]:
+    # Depth first with `os.scandir`, so only one directory listing is held at a time.
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if skip is None or Path(entry.path).resolve() != skip:
+                        yield from _walk(Path(entry.path), skip)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+    except FileNotFoundError:
+        return
+
+
+def _owner(file_name: str) -> str:
+    return _SIDECAR.match(file_name)["owner"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove transcript files that no conversation refers to, e.g. those of conversations "
+        "deleted before their files were cleaned up. Safe to run while the site is up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only report what would be removed."
+        )
+        parser.add_argument(
+            "--quarantine",
+            type=Path,
+            help="Move orphaned files into this directory instead of deleting them.",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=GC_PARAMS__MIN_AGE_MINUTES,
+            help="Leave files modified within this many minutes alone.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=GC_PARAMS__CHUNK_SIZE,
+            help="Number of files looked up in the database at once.",
+        )
+
+    def handle(self, *args, **options):
+        root = Path(PROJECT_DIR) / ConversationModel.MEDIA_DIR
+        quarantine = options["quarantine"]
+        skip = quarantine.resolve() if quarantine is not None else None
+        # Files written recently may belong to a conversation being created or relocated.
+        cutoff = time.time() - options["min_age"] * 60
+        start = time.perf_counter()
+        num_scanned = num_orphans = num_bytes = 0
+
+        files = _walk(root, skip)
+        while True:
+            chunk = [
+                (Path(entry.path).relative_to(root).as_posix(), entry.stat(follow_symlinks=False))
+                for entry in islice(files, options["chunk_size"])
+            ]
+            if not len(chunk):
+                break
+            num_scanned += len(chunk)
+
+            owners = {_owner(file_name) for file_name, _ in chunk}
+            referenced = set(
+                ConversationModel.objects.filter(file_name__in=owners).values_list(
+                    "file_name", flat=True
+                )
+            )
+            orphans: dict[str, list[str]] = {}
+            for file_name, stat in chunk:
+                owner = _owner(file_name)
+                if stat.st_mtime >= cutoff:
+                    continue
+                # Temporary files left behind by an interrupted rewrite are garbage either way.
+                if owner not in referenced or file_name.endswith(".tmp"):
+                    orphans.setdefault(owner, []).append(file_name)
+                    num_orphans += 1
+                    num_bytes += stat.st_size
+
+            if options["verbosity"] > 1:
+                for file_names in orphans.values():
+                    for file_name in file_names:
+                        self.stdout.write(f"Orphaned {file_name}")
+            if options["dry_run"]:
+                continue
+            for owner, file_names in orphans.items():
+                self._remove(root, owner, file_names, quarantine)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"Scanned {num_scanned} files in {elapsed:.1f}s, "
+            f"{'would remove' if options['dry_run'] else 'removed'} {num_orphans} orphaned "
+            f"files ({num_bytes / (1 << 20):.1f} MB)"
+            + (f" into {quarantine}." if quarantine is not None else ".")
+        )
+
+    @staticmethod
+    def _remove(root: Path, owner: str, file_names: list[str], quarantine: Optional[Path]):
+        transcript = TranscriptFile(root / owner)
+        with transcript_locks.write(transcript.path):
+            # The file may have been claimed since the chunk was looked up.
+            if ConversationModel.objects.filter(file_name=owner).exists():
+                file_names = [name for name in file_names if name.endswith(".tmp")]
+            else:
+                # Lock files are only removed while held, see `LockManager`. Taking the lock
+                # created one if there was none.
+                lock_path = LockManager.lock_path(transcript.path)
+                lock_path.unlink(missing_ok=True)
+                handle_pool.invalidate(lock_path)
+            for file_name in file_names:
+                path = root / file_name
+                # Lock files hold nothing worth keeping.
+                if quarantine is None or file_name.endswith(LOCK_FILE_SUFFIX):
+                    path.unlink(missing_ok=True)
+                elif path.exists():
+                    destination = quarantine / file_name
+                    destination.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.move(path, destination)
+                handle_pool.invalidate(path)
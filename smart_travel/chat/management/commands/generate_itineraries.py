@@ -0,0 +1,209 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Optional
+
+from accounts.models import AccountModel
+from chat.cqrs.commands import CommandCreateConversation, CommandSaveMessage
+from chat.models import ConversationModel
+from chat.utility.message import Message
+from chat.utility.rate_limit import TokenBucket
+from chat.utility.usage_recorder import UsageRecorder
+from chatbot.travel_chatbot import Chatbot
+from chatbot.usage import CompletionUsage
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from openai import RateLimitError
+
+MAX_RETRIES = 6
+BASE_BACKOFF = 2.0
+
+
+def _prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def _read_prompts(path: Path) -> list[str]:
+    with open(path, "r") as infile:
+        lines = [line.strip() for line in infile]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+class _Throttle(object):
+    """
+    Client-side request pacing shared by all workers, plus a global cooldown that every worker
+    honours after the upstream reports a rate limit.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float]):
+        self._bucket = (
+            TokenBucket(capacity=1, refill_rate=requests_per_minute / 60)
+            if requests_per_minute
+            else None
+        )
+        self._cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                delay = self._cooldown_until - time.monotonic()
+                if delay <= 0 and (self._bucket is None or self._bucket.take()):
+                    return
+            time.sleep(max(delay, 0.05))
+
+    def cooldown(self, seconds: float):
+        with self._lock:
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + seconds)
+
+
+class Command(BaseCommand):
+    help = "Generate agent replies for a file of prompts, e.g. recurring itineraries."
+
+    def add_arguments(self, parser):
+        parser.add_argument("prompts", type=Path, help="File with one prompt per line.")
+        parser.add_argument(
+            "--output", type=Path, help="NDJSON file results are appended to."
+        )
+        parser.add_argument(
+            "--user", help="User name whose conversations the results are saved into."
+        )
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument(
+            "--requests-per-minute",
+            type=float,
+            default=None,
+            help="Client-side cap on the request rate.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            type=Path,
+            default=None,
+            help="File of completed prompts, defaults to <prompts>.checkpoint.",
+        )
+
+    def handle(self, *args, **options):
+        if options["output"] is None and options["user"] is None:
+            raise CommandError("Provide --output, --user or both.")
+
+        user: Optional[AccountModel] = None
+        if options["user"] is not None:
+            user = AccountModel.objects.filter(user_name=options["user"]).first()
+            if user is None:
+                raise CommandError(f"No user named {options['user']}.")
+
+        # Itineraries need web search, so every prompt goes to the full model.
+        chatbot = Chatbot(routing=False)
+        if not chatbot.initialize_session():
+            raise CommandError("Could not initialize the chatbot session.")
+
+        checkpoint_path = options["checkpoint"] or options["prompts"].with_suffix(
+            options["prompts"].suffix + ".checkpoint"
+        )
+        completed = set()
+        if checkpoint_path.exists():
+            completed = set(checkpoint_path.read_text().split())
+
+        prompts = [
+            prompt
+            for prompt in _read_prompts(options["prompts"])
+            if _prompt_key(prompt) not in completed
+        ]
+        self.stdout.write(f"{len(prompts)} prompts to generate, {len(completed)} done.")
+
+        throttle = _Throttle(options["requests_per_minute"])
+        usage_recorder = UsageRecorder()
+
+        def generate(prompt: str) -> tuple[str, Optional[CompletionUsage]]:
+            usages: list[CompletionUsage] = []
+            for attempt in range(MAX_RETRIES):
+                throttle.acquire()
+                try:
+                    response = chatbot.prompt_completion(
+                        [Message(prompt, True)], on_usage=usages.append
+                    )
+                    return response or "", usages[-1] if len(usages) else None
+                except RateLimitError as e:
+                    retry_after = e.response.headers.get("retry-after")
+                    throttle.cooldown(
+                        float(retry_after) if retry_after else BASE_BACKOFF * 2**attempt
+                    )
+            raise CommandError(f"Rate limited {MAX_RETRIES} times, giving up.")
+
+        output_file = open(options["output"], "a") if options["output"] else None
+        checkpoint_file = open(checkpoint_path, "a")
+        num_failed = 0
+        try:
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+                prompt_iter = iter(prompts)
+                in_flight: dict[Future, str] = {}
+
+                # Keep a bounded window in flight so huge prompt files are not queued at once.
+                def fill():
+                    while len(in_flight) < 2 * options["concurrency"]:
+                        prompt = next(prompt_iter, None)
+                        if prompt is None:
+                            return
+                        in_flight[executor.submit(generate, prompt)] = prompt
+
+                fill()
+                while len(in_flight):
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        prompt = in_flight.pop(future)
+                        try:
+                            response, usage = future.result()
+                        except Exception as e:
+                            num_failed += 1
+                            self.stderr.write(f"Failed: {prompt!r}: {e}")
+                            continue
+
+                        if usage is not None:
+                            usage_recorder.record(
+                                usage, user_id=user.id if user is not None else None
+                            )
+                        # Not checkpointed, so a rerun generates it again.
+                        if user is not None and not self._save_conversation(
+                            user, prompt, response
+                        ):
+                            num_failed += 1
+                            self.stderr.write(f"Failed to save conversation: {prompt!r}")
+                            continue
+                        if output_file is not None:
+                            output_file.write(
+                                json.dumps(
+                                    {
+                                        "key": _prompt_key(prompt),
+                                        "prompt": prompt,
+                                        "response": response,
+                                        "model": usage.model if usage else None,
+                                        "input_tokens": usage.input_tokens if usage else None,
+                                        "output_tokens": usage.output_tokens if usage else None,
+                                        "latency": usage.latency if usage else None,
+                                    }
+                                )
+                                + "\n"
+                            )
+                            output_file.flush()
+                        checkpoint_file.write(_prompt_key(prompt) + "\n")
+                        checkpoint_file.flush()
+                    fill()
+        finally:
+            checkpoint_file.close()
+            if output_file is not None:
+                output_file.close()
+            usage_recorder.flush()
+
+        self.stdout.write(f"Generated {len(prompts) - num_failed}, failed {num_failed}.")
+
+    @staticmethod
+    def _save_conversation(user: AccountModel, prompt: str, response: str) -> bool:
+        title = prompt[:50]
+        if not CommandCreateConversation.execute(title, user):
+            return False
+        convo = ConversationModel.objects.filter(user=user, title=title).latest("id")
+        return CommandSaveMessage.execute(
+            convo.id, Message(prompt, True)
+        ) and CommandSaveMessage.execute(convo.id, Message(response, False))
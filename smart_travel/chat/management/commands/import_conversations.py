@@ -0,0 +1,162 @@
+import gzip
+import json
+import sys
+from contextlib import nullcontext
+from typing import IO, Any, Iterator, Optional
+
+from accounts.models import AccountModel
+from chat.models import ConversationModel
+from chat.storage import get_storage
+from chat.utility.message import Message
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.db import transaction  # type: ignore
+from django.utils.dateparse import parse_datetime  # type: ignore
+
+IMPORT_PARAMS__CHUNK_SIZE = 1000
+
+
+def _parse(infile: IO[str]) -> Iterator[tuple[int, dict[str, Any]]]:
+    for line_number, line in enumerate(infile, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except json.JSONDecodeError as error:
+            raise CommandError(f"Line {line_number} is not valid JSON: {error}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Import users, conversations and messages written by `export_conversations`. Users "
+        "are matched by user name, conversations are always created anew."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "input", help="File to read, '-' for stdin. Decompressed if it ends in '.gz'."
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=IMPORT_PARAMS__CHUNK_SIZE,
+            help="Number of rows created, or messages written, at once.",
+        )
+
+    def handle(self, *args, **options):
+        self.batch_size = options["batch_size"]
+        self.storage = get_storage()
+        # Exported IDs to the IDs of the imported rows.
+        self.user_ids: dict[int, int] = {}
+        self.conv_ids: dict[int, int] = {}
+        self.pending_users: list[dict[str, Any]] = []
+        self.pending_convos: list[dict[str, Any]] = []
+        self.messages: list[Message] = []
+        self.messages_conv_id: Optional[int] = None
+        self.num_messages = 0
+
+        path = options["input"]
+        if path == "-":
+            infile_context = nullcontext(sys.stdin)
+        elif path.endswith(".gz"):
+            infile_context = gzip.open(path, "rt", encoding="utf-8")
+        else:
+            infile_context = open(path, "r", encoding="utf-8")
+        with infile_context as infile:
+            for line_number, record in _parse(infile):
+                try:
+                    self._import(record)
+                except (KeyError, TypeError, ValueError) as error:
+                    raise CommandError(f"Line {line_number} is not a valid record: {error!r}")
+        self._flush_users()
+        self._flush_convos()
+        self._flush_messages()
+
+        self.stdout.write(
+            f"Imported {len(self.user_ids)} users, {len(self.conv_ids)} conversations and "
+            f"{self.num_messages} messages."
+        )
+
+    def _import(self, record: dict[str, Any]):
+        kind = record["type"]
+        if kind == "user":
+            self.pending_users.append(record)
+            if len(self.pending_users) >= self.batch_size:
+                self._flush_users()
+        elif kind == "conversation":
+            self._flush_users()
+            # A fork needs the ID of its parent, which may still be waiting to be created.
+            if record["parent_id"] is not None and record["parent_id"] not in self.conv_ids:
+                self._flush_convos()
+            self.pending_convos.append(record)
+            if len(self.pending_convos) >= self.batch_size:
+                self._flush_convos()
+        elif kind == "message":
+            self._flush_users()
+            self._flush_convos()
+            conv_id = self.conv_ids[record["conversation_id"]]
+            if conv_id != self.messages_conv_id or len(self.messages) >= self.batch_size:
+                self._flush_messages()
+                self.messages_conv_id = conv_id
+            self.messages.append(Message(record["message"], bool(record["is_user"])))
+        else:
+            raise ValueError(f"unknown type {kind!r}")
+
+    def _flush_users(self):
+        if not len(self.pending_users):
+            return
+        user_names = {record["user_name"] for record in self.pending_users}
+        existing = dict(
+            AccountModel.objects.filter(user_name__in=user_names).values_list("user_name", "id")
+        )
+        new_users = {
+            record["user_name"]: AccountModel(
+                first_name=record["first_name"],
+                last_name=record["last_name"],
+                user_name=record["user_name"],
+                password_hash=record["password_hash"],
+            )
+            for record in self.pending_users
+            if record["user_name"] not in existing
+        }
+        with transaction.atomic():
+            AccountModel.objects.bulk_create(new_users.values())
+        existing.update((user_name, user.id) for user_name, user in new_users.items())
+        for record in self.pending_users:
+            self.user_ids[record["id"]] = existing[record["user_name"]]
+        self.pending_users = []
+
+    def _flush_convos(self):
+        if not len(self.pending_convos):
+            return
+        rows = [
+            ConversationModel(
+                title=record["title"],
+                user_id=self.user_ids[record["user_id"]],
+                file_name="",
+                time_of_last_message=parse_datetime(record["time_of_last_message"]),
+                parent_id=(
+                    None if record["parent_id"] is None else self.conv_ids[record["parent_id"]]
+                ),
+                fork_point=record["fork_point"],
+            )
+            for record in self.pending_convos
+        ]
+        with transaction.atomic():
+            ConversationModel.objects.bulk_create(rows)
+            for row in rows:
+                row.file_name = ConversationModel.storage_name(row.id)
+            ConversationModel.objects.bulk_update(rows, ["file_name"])
+        for record, row in zip(self.pending_convos, rows):
+            self.conv_ids[record["id"]] = row.id
+        self.pending_convos = []
+
+    def _flush_messages(self):
+        if not len(self.messages):
+            return
+        convo = ConversationModel(
+            id=self.messages_conv_id,
+            file_name=ConversationModel.storage_name(self.messages_conv_id),
+        )
+        self.storage.append_many(convo, self.messages)
+        self.num_messages += len(self.messages)
+        self.messages = []
@@ -0,0 +1,82 @@
+from itertools import islice
+
+from chat.models import ConversationModel, MessageModel
+from chat.utility.message import render_markdown
+from django.core.management.base import BaseCommand  # type: ignore
+from django.db import transaction  # type: ignore
+from django.db.models import Count  # type: ignore
+
+
+class Command(BaseCommand):
+    help = (
+        "Import transcript files into the message table, one conversation at a time. "
+        "Only messages past those already imported are added, so an interrupted import "
+        "can be resumed, and messages appended since caught up, by running it again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--no-render",
+            action="store_true",
+            help="Skip rendering agent messages, they are rendered when first displayed.",
+        )
+
+    def handle(self, *args, **options):
+        num_imported = dict(
+            MessageModel.objects.values("conversation_id")
+            .annotate(num=Count("id"))
+            .values_list("conversation_id", "num")
+        )
+        num_convos = num_messages = num_skipped = num_mismatched = 0
+
+        for convo in ConversationModel.objects.order_by("id").iterator(chunk_size=500):
+            if not convo.transcript.exists():
+                num_skipped += 1
+                continue
+            start = num_imported.get(convo.id, 0)
+            num_transcript = convo.transcript.count()
+            if start > num_transcript:
+                self.stderr.write(
+                    f"Conversation {convo.id} has {start} messages imported but only "
+                    f"{num_transcript} in its transcript."
+                )
+                num_mismatched += 1
+                continue
+            if start == num_transcript:
+                num_skipped += 1
+                continue
+
+            # The missing messages of each conversation are imported whole or not at all,
+            # streamed in batches so long transcripts are never held in memory at once.
+            num_rows = 0
+            with transaction.atomic():
+                batch = []
+                messages = islice(convo.transcript.iter_messages(), start, None)
+                for seq, message in enumerate(messages, start):
+                    batch.append(
+                        MessageModel.from_message(
+                            convo.id,
+                            seq,
+                            message,
+                            None
+                            if message.is_user or options["no_render"]
+                            else render_markdown(message.message),
+                        )
+                    )
+                    if len(batch) >= options["batch_size"]:
+                        MessageModel.objects.bulk_create(batch)
+                        num_rows += len(batch)
+                        batch = []
+                MessageModel.objects.bulk_create(batch)
+                num_rows += len(batch)
+
+            num_convos += 1
+            num_messages += num_rows
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Imported {num_rows} messages of conversation {convo.id}.")
+
+        self.stdout.write(
+            f"Imported {num_messages} messages from {num_convos} conversations, "
+            f"skipped {num_skipped}, {num_mismatched} did not match their transcript."
+        )
@@ -0,0 +1,49 @@
+import time
+from datetime import timedelta
+
+from chat.cqrs.commands import DELETE_PARAMS__CHUNK_SIZE, CommandPurgeConversations
+from chat.models import ConversationModel
+from django.conf import settings  # type: ignore
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.utils import timezone  # type: ignore
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete conversations, and their messages, without new messages for a number of "
+        "days. Safe to run while the site is up, e.g. daily from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.CHAT_RETENTION_DAYS,
+            help="Delete conversations idle for at least this many days.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only report what would be deleted."
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=DELETE_PARAMS__CHUNK_SIZE,
+            help="Number of conversations deleted per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        if options["days"] is None:
+            raise CommandError("No retention period, pass --days or set CHAT_RETENTION_DAYS.")
+        if options["days"] < 0 or options["chunk_size"] < 1:
+            raise CommandError("--days must not be negative and --chunk-size must be positive.")
+
+        if options["dry_run"]:
+            cutoff = timezone.now() - timedelta(days=options["days"])
+            num_idle = ConversationModel.objects.filter(time_of_last_message__lt=cutoff).count()
+            self.stdout.write(f"Would delete {num_idle} conversations.")
+            return
+
+        start = time.perf_counter()
+        num_deleted = CommandPurgeConversations.execute(options["days"], options["chunk_size"])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"Deleted {num_deleted} conversations in {elapsed:.1f}s.")
@@ -0,0 +1,118 @@
+import os
+import shutil
+from itertools import groupby
+from pathlib import Path
+
+from chat.storage import transcript_cache
+from chat.models import PROJECT_DIR, ConversationModel
+from chat.utility.handle_pool import handle_pool
+from chat.utility.locks import LockManager, transcript_locks
+from chat.utility.transcript import TranscriptFile
+from django.core.management.base import BaseCommand  # type: ignore
+
+
+def _media_path(file_name: str) -> Path:
+    return Path(PROJECT_DIR) / ConversationModel.MEDIA_DIR / file_name
+
+
+def _link_or_copy(source: Path, destination: Path, copy: bool):
+    if not source.exists():
+        return
+    if not copy:
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+
+
+def _share_lock(old: TranscriptFile, new: TranscriptFile):
+    """
+    Make the new path's lock file a hard link of the old path's.
+
+    Note:
+        Until the old path is unlinked, saves may append to the linked transcript through
+        either path. `flock` locks the lock file's inode, so with a single lock file for both
+        paths those appends still exclude one another, across processes and threads alike.
+    """
+
+    old_lock, new_lock = LockManager.lock_path(old.path), LockManager.lock_path(new.path)
+    with handle_pool.handle(old_lock, create=True):
+        pass
+    tmp_path = new_lock.with_name(new_lock.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        os.link(old_lock, tmp_path)
+    except OSError:
+        # The transcript is copied rather than linked then, see `_link_or_copy`.
+        return
+    os.replace(tmp_path, new_lock)
+    handle_pool.invalidate(new_lock)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move transcripts from the flat layout into the sharded layout keyed by conversation "
+        "ID. Safe to run while the site is up and to resume after an interruption."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only report what would be moved."
+        )
+
+    def handle(self, *args, **options):
+        # Only IDs and names are held, and rows are updated while going through them.
+        convos = list(
+            ConversationModel.objects.order_by("file_name", "id").values_list("id", "file_name")
+        )
+        num_moved = num_shared = 0
+        stale: list[TranscriptFile] = []
+
+        for file_name, group in groupby(convos, key=lambda convo: convo[1]):
+            moving = [
+                conv_id
+                for conv_id, _ in group
+                if file_name != ConversationModel.storage_name(conv_id)
+            ]
+            if not len(moving):
+                continue
+            # Conversations with the same title by the same user shared a file, each keeps a
+            # copy of the shared history.
+            shared = len(moving) > 1
+            num_shared += len(moving) if shared else 0
+            num_moved += len(moving)
+            if options["dry_run"]:
+                continue
+
+            old = TranscriptFile(_media_path(file_name))
+            for conv_id in moving:
+                new_name = ConversationModel.storage_name(conv_id)
+                new = TranscriptFile(_media_path(new_name))
+                new.path.parent.mkdir(parents=True, exist_ok=True)
+                new.delete()
+                if not shared:
+                    _share_lock(old, new)
+                # A hard link keeps appends made through the old path until the row is updated
+                # in the new file as well.
+                with transcript_locks.write(old.path):
+                    _link_or_copy(old.path, new.path, copy=shared)
+                    _link_or_copy(old.index_path, new.index_path, copy=shared)
+                    for codec, archive_path in old.archive_paths.items():
+                        _link_or_copy(archive_path, new.archive_paths[codec], copy=shared)
+                    ConversationModel.objects.filter(id=conv_id, file_name=file_name).update(
+                        file_name=new_name
+                    )
+                transcript_cache.invalidate(conv_id)
+            stale.append(old)
+
+        # Old paths are unlinked last, giving saves that looked up a path before it changed
+        # the whole run to finish.
+        for old in stale:
+            old.delete()
+
+        self.stdout.write(
+            f"{'Would relocate' if options['dry_run'] else 'Relocated'} {num_moved} transcripts, "
+            f"{num_shared} of them copied out of shared files."
+        )
@@ -0,0 +1,138 @@
+import json
+from pathlib import Path
+from typing import Optional
+
+from chat.models import PROJECT_DIR, ConversationModel
+from chat.utility.locks import LOCK_FILE_SUFFIX
+from chatbot.replay import RecordedBackend, TurnReport, replay_transcripts
+from chat.utility.transcript import TRANSCRIPT_ARCHIVE_CODECS, TRANSCRIPT_INDEX_SUFFIX
+from chatbot.travel_chatbot import SYSTEM_PROMPT_PATH, Chatbot
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+
+# Sidecars next to a transcript that hold no messages of their own, see `gc_transcripts`.
+_SIDECAR_SUFFIXES = (TRANSCRIPT_INDEX_SUFFIX, LOCK_FILE_SUFFIX, ".tmp")
+_ARCHIVE_SUFFIXES = tuple(suffix for suffix, _ in TRANSCRIPT_ARCHIVE_CODECS.values())
+
+
+def _transcript_path(path: Path) -> Optional[Path]:
+    # Archives are read through the path of the transcript they replaced.
+    if path.name.endswith(_SIDECAR_SUFFIXES):
+        return None
+    if path.name.endswith(_ARCHIVE_SUFFIXES):
+        return path.with_suffix("")
+    return path
+
+
+def _collect_transcripts(paths: list[Path]) -> list[Path]:
+    transcripts = []
+    for path in paths:
+        if path.is_dir():
+            # Stored transcripts are sharded into subdirectories, see `storage_name`.
+            found = {_transcript_path(p) for p in path.rglob("*") if p.is_file()}
+            found.discard(None)
+            transcripts.extend(sorted(found))
+        elif path.is_file():
+            transcript = _transcript_path(path)
+            if transcript is None:
+                raise CommandError(f"Not a transcript: {path}")
+            transcripts.append(transcript)
+        else:
+            raise CommandError(f"No such transcript or directory: {path}")
+    return transcripts
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay recorded conversations through the chatbot and report prompt size, tokens, "
+        "latency and cost per turn."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "transcripts",
+            nargs="*",
+            type=Path,
+            help="Transcript files or directories, defaults to all stored conversations.",
+        )
+        parser.add_argument(
+            "--backend",
+            choices=["recorded", "openai"],
+            default="recorded",
+            help="Answer with the recorded replies offline, or call the OpenAI API.",
+        )
+        parser.add_argument("--model", default="gpt-5.1")
+        parser.add_argument("--fast-model", default="gpt-5-mini")
+        parser.add_argument("--no-routing", action="store_true")
+        parser.add_argument(
+            "--system-prompt",
+            type=Path,
+            default=SYSTEM_PROMPT_PATH,
+            help="System prompt file to replay with instead of the shipped one.",
+        )
+        parser.add_argument(
+            "--max-history",
+            type=int,
+            default=None,
+            help="Only send this many of the most recent messages with each turn.",
+        )
+        parser.add_argument(
+            "--base-latency",
+            type=float,
+            default=0.0,
+            help="Simulated latency of the recorded backend in seconds.",
+        )
+        parser.add_argument(
+            "--latency-per-1k-tokens",
+            type=float,
+            default=0.0,
+            help="Simulated latency of the recorded backend per 1000 tokens in seconds.",
+        )
+        parser.add_argument("--output", type=Path, help="NDJSON file of per-turn reports.")
+
+    def handle(self, *args, **options):
+        transcripts = _collect_transcripts(
+            options["transcripts"] or [PROJECT_DIR / ConversationModel.MEDIA_DIR]
+        )
+
+        chatbot = Chatbot(
+            model=options["model"],
+            fast_model=options["fast_model"],
+            routing=not options["no_routing"],
+            system_prompt_path=options["system_prompt"],
+        )
+        backend = None
+        if options["backend"] == "recorded":
+            backend = RecordedBackend(
+                base_latency=options["base_latency"],
+                latency_per_1k_tokens=options["latency_per_1k_tokens"],
+            )
+            backend.attach(chatbot)
+        elif not chatbot.initialize_session():
+            raise CommandError("Could not initialize the chatbot session.")
+
+        output_file = open(options["output"], "w") if options["output"] else None
+
+        def on_turn(turn: TurnReport):
+            if output_file is not None:
+                output_file.write(json.dumps(turn.to_dict()) + "\n")
+            if options["verbosity"] > 1:
+                self.stdout.write(
+                    f"{turn.transcript}#{turn.turn} {turn.route} {turn.model}: "
+                    f"{turn.prompt_chars} chars, ~{turn.estimated_tokens} tokens, "
+                    f"{turn.latency:.3f}s"
+                )
+
+        try:
+            report = replay_transcripts(
+                chatbot,
+                transcripts,
+                backend=backend,
+                max_history=options["max_history"],
+                on_turn=on_turn,
+            )
+        finally:
+            if output_file is not None:
+                output_file.close()
+
+        self.stdout.write(f"Replayed {len(transcripts)} transcripts.")
+        self.stdout.write(report.summary())
@@ -1,7 +1,12 @@
+import hashlib
 from pathlib import Path
+from typing import Optional
 
 from accounts.models import AccountModel
+from chat.utility.message import Message
+from chat.utility.transcript import TranscriptFile
 from django.db import models  # type: ignore
+from django.utils import timezone  # type: ignore
 
 PROJECT_DIR = Path(__file__).parent.parent
 
@@ -13,7 +18,98 @@ class ConversationModel(models.Model):
     user = models.ForeignKey(AccountModel, on_delete=models.CASCADE)
     file_name = models.CharField(max_length=200)
     time_of_last_message = models.DateTimeField()
+    # A fork starts with the first `fork_point` messages of its parent, which are read from the
+    # parent rather than copied, see `ConversationHistory`.
+    parent = models.ForeignKey(
+        "self", null=True, blank=True, on_delete=models.SET_NULL, related_name="forks"
+    )
+    fork_point = models.PositiveIntegerField(default=0)
 
     @property
     def abs_path(self) -> Path:
         return Path(PROJECT_DIR) / ConversationModel.MEDIA_DIR / self.file_name
+
+    @staticmethod
+    def storage_name(conv_id: int) -> str:
+        """
+        Path of a conversation's transcript relative to the media directory.
+
+        Note:
+            Transcripts are spread over two levels of 256 subdirectories keyed by a hash of
+            the primary key, so no directory grows past a few thousand entries even with
+            millions of conversations, while the name itself stays unique.
+
+        Args:
+            conv_id (int): Primary key of the conversation.
+
+        Returns:
+            str: Relative path such as `3f/a2/1234.txt`.
+        """
+
+        digest = hashlib.sha256(str(conv_id).encode("utf-8")).hexdigest()
+        return f"{digest[:2]}/{digest[2:4]}/{conv_id}.txt"
+
+    @property
+    def transcript(self) -> TranscriptFile:
+        return TranscriptFile(self.abs_path)
+
+
+class MessageModel(models.Model):
+    ROLE_USER = "user"
+    ROLE_AGENT = "agent"
+    ROLES = [(ROLE_USER, "User"), (ROLE_AGENT, "Agent")]
+
+    conversation = models.ForeignKey(
+        ConversationModel, on_delete=models.CASCADE, related_name="messages"
+    )
+    seq = models.PositiveIntegerField()
+    role = models.CharField(max_length=5, choices=ROLES)
+    content = models.TextField()
+    rendered_html = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["conversation", "seq"], name="unique_conversation_message_seq"
+            )
+        ]
+
+    @classmethod
+    def from_message(
+        cls, conv_id: int, seq: int, message: Message, rendered_html: Optional[str] = None
+    ) -> "MessageModel":
+        return cls(
+            conversation_id=conv_id,
+            seq=seq,
+            role=cls.ROLE_USER if message.is_user else cls.ROLE_AGENT,
+            content=message.message,
+            rendered_html=rendered_html,
+        )
+
+    def to_message(self) -> Message:
+        return Message(self.content, self.role == self.ROLE_USER, self.rendered_html)
+
+
+class DailyTokenUsageModel(models.Model):
+    user = models.ForeignKey(AccountModel, on_delete=models.CASCADE)
+    day = models.DateField()
+    tokens = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("user", "day")
+
+
+class CompletionUsageModel(models.Model):
+    user = models.ForeignKey(AccountModel, null=True, on_delete=models.SET_NULL)
+    conversation = models.ForeignKey(
+        ConversationModel, null=True, on_delete=models.SET_NULL
+    )
+    model = models.CharField(max_length=50)
+    route = models.CharField(max_length=10)
+    input_tokens = models.PositiveIntegerField()
+    output_tokens = models.PositiveIntegerField()
+    cached_tokens = models.PositiveIntegerField(default=0)
+    latency_ms = models.PositiveIntegerField()
+    web_search_calls = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
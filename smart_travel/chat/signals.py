@@ -0,0 +1,72 @@
+import copy
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+from chat.models import ConversationModel
+from chat.storage import ConversationHistory, get_storage
+from django.db import transaction  # type: ignore
+from django.db.models.signals import post_delete, pre_delete  # type: ignore
+from django.dispatch import receiver  # type: ignore
+
+_deferred = threading.local()
+
+
+@contextmanager
+def defer_storage_deletion() -> Iterator[list[ConversationModel]]:
+    """
+    Collect the conversations deleted by this thread within the block instead of deleting
+    their messages one by one, so the caller can delete them in bulk.
+
+    Yields:
+        list[ConversationModel]: Deleted conversations, filled in as they are deleted.
+    """
+
+    convos: list[ConversationModel] = []
+    _deferred.convos = convos
+    try:
+        yield convos
+    finally:
+        _deferred.convos = None
+
+
+@receiver(pre_delete, sender=ConversationModel)
+def _detach_forks(sender, instance: ConversationModel, **kwargs):
+    """
+    Give the forks of a conversation being deleted their own copy of the shared messages.
+
+    Note:
+        Messages stored in the database are copied right away, within the delete's transaction
+        and before its cascade deletes the shared messages. Otherwise the shared messages are
+        located now, while the conversation still exists, and copied once the transaction
+        commits, before the conversation's own messages are deleted, so a rolled back delete
+        leaves the forks untouched.
+    """
+
+    for fork in ConversationModel.objects.filter(parent_id=instance.id):
+        history = ConversationHistory(fork)
+        if history.storage.transactional:
+            history.detach()
+            continue
+        history.prefix  # Resolved while the parent rows exist.
+        transaction.on_commit(history.detach, robust=True)
+
+
+@receiver(post_delete, sender=ConversationModel)
+def _delete_conversation_storage(sender, instance: ConversationModel, **kwargs):
+    """
+    Delete a conversation's messages along with its row.
+
+    Note:
+        Also runs for queryset and cascading deletes, e.g. when the user is deleted. Messages
+        are only deleted once the transaction commits, so a rolled back delete keeps them.
+        Bulk deletes collect the conversations instead, see `defer_storage_deletion`.
+    """
+
+    # Django clears the primary key of the instance once the delete is done.
+    convo = copy.copy(instance)
+    deferred = getattr(_deferred, "convos", None)
+    if deferred is not None:
+        deferred.append(convo)
+        return
+    transaction.on_commit(lambda: get_storage().delete(convo), robust=True)
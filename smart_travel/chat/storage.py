@@ -0,0 +1,619 @@
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from chat.models import ConversationModel, MessageModel
+from chat.utility.message import Message, render_markdown
+from chat.utility.transcript_cache import TranscriptCache
+from django.conf import settings  # type: ignore
+from django.core.exceptions import ImproperlyConfigured  # type: ignore
+from django.db import IntegrityError, transaction  # type: ignore
+from django.db.models import Max, Sum  # type: ignore
+from django.db.models.functions import Length  # type: ignore
+
+MESSAGE_STORE__FILE = "file"
+MESSAGE_STORE__DATABASE = "database"
+MESSAGE_STORE__SQLITE_BLOB = "sqlite_blob"
+MESSAGE_STORE__MEMORY = "memory"
+MESSAGE_STORE_PARAMS__MAX_SEQ_RETRIES = 5
+MESSAGE_STORE_PARAMS__PAGE_SIZE = 1000
+MESSAGE_STORE_PARAMS__DELETE_WORKERS = 8
+
+transcript_cache = TranscriptCache(
+    max_bytes=settings.CHAT_TRANSCRIPT_CACHE_MAX_BYTES,
+    max_entry_bytes=settings.CHAT_TRANSCRIPT_CACHE_MAX_ENTRY_BYTES,
+)
+
+
+def _resolve_range(
+    start: int, stop: Optional[int], count: Callable[[], int]
+) -> tuple[int, Optional[int]]:
+    # Negative indices count from the end, which needs the number of messages.
+    if start >= 0 and (stop is None or stop >= 0):
+        return start, stop
+    start, stop, _ = slice(start, stop).indices(count())
+    return start, stop
+
+
+class ConversationStorage(ABC):
+    """
+    Storage of the messages of conversations.
+
+    Note:
+        Messages are kept in the order they were appended and never reordered, so the index of
+        a message is its stable sequence number within the conversation. Ranges follow slice
+        semantics, so negative indices count from the end of the conversation.
+    """
+
+    # Whether writes are part of the current database transaction, i.e. roll back with it.
+    transactional = False
+
+    @abstractmethod
+    def append_many(
+        self, convo: ConversationModel, messages: list[Message], fsync: bool = False
+    ): ...
+
+    @abstractmethod
+    def prepend_many(self, convo: ConversationModel, messages: list[Message]):
+        """
+        Insert messages before the existing ones, e.g. to detach a fork from its parent.
+        Sequence numbers of the existing messages shift accordingly.
+        """
+
+    @abstractmethod
+    def read(
+        self, convo: ConversationModel, start: int = 0, stop: Optional[int] = None
+    ) -> list[Message]: ...
+
+    @abstractmethod
+    def read_tail(self, convo: ConversationModel, k: int) -> list[Message]: ...
+
+    @abstractmethod
+    def count(self, convo: ConversationModel) -> int: ...
+
+    @abstractmethod
+    def delete(self, convo: ConversationModel): ...
+
+    @abstractmethod
+    def size(self, convo: ConversationModel) -> int:
+        """
+        Returns:
+            int: Approximate number of bytes the conversation takes up.
+        """
+
+    def append(self, convo: ConversationModel, message: Message):
+        self.append_many(convo, [message])
+
+    def delete_many(self, convos: list[ConversationModel]):
+        for convo in convos:
+            self.delete(convo)
+
+    def read_all(self, convo: ConversationModel) -> list[Message]:
+        return self.read(convo)
+
+    def read_since(self, convo: ConversationModel, seq: int) -> list[Message]:
+        """
+        Read the messages from a sequence number onwards, e.g. those a client has not seen yet.
+        Backends read only the new messages.
+
+        Args:
+            seq (int): Sequence number of the first message, i.e. the number of messages
+                already seen.
+        """
+
+        return self.read(convo, max(seq, 0))
+
+    def iter_messages(self, convo: ConversationModel) -> Iterator[Message]:
+        """
+        Iterate over the conversation's messages a page at a time, e.g. to export them.
+        """
+
+        start = 0
+        while True:
+            page = self.read(convo, start, start + MESSAGE_STORE_PARAMS__PAGE_SIZE)
+            yield from page
+            if len(page) < MESSAGE_STORE_PARAMS__PAGE_SIZE:
+                return
+            start += len(page)
+
+
+"""
+Storage: File System
+"""
+
+
+class FileSystemStorage(ConversationStorage):
+    """
+    A framed transcript file per conversation, read through the transcript cache.
+    """
+
+    def __init__(self, cache: TranscriptCache):
+        self.cache = cache
+
+    def append_many(
+        self, convo: ConversationModel, messages: list[Message], fsync: bool = False
+    ):
+        convo.transcript.append_many(messages, fsync=fsync)
+
+    def prepend_many(self, convo: ConversationModel, messages: list[Message]):
+        convo.transcript.prepend_many(messages)
+
+    def read(
+        self, convo: ConversationModel, start: int = 0, stop: Optional[int] = None
+    ) -> list[Message]:
+        return self.cache.read(convo.id, convo.transcript, start, stop)
+
+    def read_tail(self, convo: ConversationModel, k: int) -> list[Message]:
+        return self.cache.read_tail(convo.id, convo.transcript, k)
+
+    def read_since(self, convo: ConversationModel, seq: int) -> list[Message]:
+        return self.cache.read_since(convo.id, convo.transcript, seq)
+
+    def iter_messages(self, convo: ConversationModel) -> Iterator[Message]:
+        # Streamed from the file, bypassing the cache.
+        yield from convo.transcript.iter_messages()
+
+    def count(self, convo: ConversationModel) -> int:
+        return self.cache.count(convo.id, convo.transcript)
+
+    def delete(self, convo: ConversationModel):
+        convo.transcript.delete()
+        self.cache.invalidate(convo.id)
+
+    def delete_many(self, convos: list[ConversationModel]):
+        # Unlinking is dominated by waiting on the file system, so files are removed in
+        # parallel.
+        if len(convos) <= 1:
+            return super().delete_many(convos)
+        with ThreadPoolExecutor(
+            max_workers=min(MESSAGE_STORE_PARAMS__DELETE_WORKERS, len(convos))
+        ) as executor:
+            for _ in executor.map(self.delete, convos):
+                pass
+
+    def size(self, convo: ConversationModel) -> int:
+        try:
+            return convo.transcript.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+
+"""
+Storage: Database
+"""
+
+
+class DatabaseStorage(ConversationStorage):
+    """
+    A `MessageModel` row per message, read through the (conversation, seq) index.
+
+    Note:
+        Agent messages are stored with their rendered HTML. Durability follows the database,
+        so the fsync flag is ignored.
+    """
+
+    transactional = True
+
+    def append_many(
+        self, convo: ConversationModel, messages: list[Message], fsync: bool = False
+    ):
+        """
+        Insert the messages as the next rows of the conversation.
+
+        Note:
+            The next sequence number is read from the (conversation, seq) index. If a
+            concurrent save took the same numbers first, the unique constraint rejects the
+            insert and it is retried with the following numbers.
+        """
+
+        rendered = [
+            None if message.is_user else render_markdown(message.message) for message in messages
+        ]
+        for _ in range(MESSAGE_STORE_PARAMS__MAX_SEQ_RETRIES):
+            last_seq = MessageModel.objects.filter(conversation_id=convo.id).aggregate(
+                last_seq=Max("seq")
+            )["last_seq"]
+            first_seq = 0 if last_seq is None else last_seq + 1
+            rows = [
+                MessageModel.from_message(convo.id, first_seq + idx, message, rendered_html)
+                for idx, (message, rendered_html) in enumerate(zip(messages, rendered))
+            ]
+            try:
+                with transaction.atomic():
+                    MessageModel.objects.bulk_create(rows)
+                return
+            except IntegrityError:
+                continue
+        raise IntegrityError(f"Could not allocate a sequence number in conversation {convo.id}.")
+
+    def prepend_many(self, convo: ConversationModel, messages: list[Message]):
+        with transaction.atomic():
+            rows = list(
+                MessageModel.objects.select_for_update()
+                .filter(conversation_id=convo.id)
+                .order_by("seq")
+            )
+            # Renumbered by reinserting, updating in place would collide on the constraint.
+            MessageModel.objects.filter(conversation_id=convo.id).delete()
+            new_rows = [
+                MessageModel.from_message(
+                    convo.id,
+                    idx,
+                    message,
+                    None if message.is_user else render_markdown(message.message),
+                )
+                for idx, message in enumerate(messages)
+            ]
+            for row in rows:
+                row.pk = None
+                row.seq += len(messages)
+            MessageModel.objects.bulk_create(new_rows + rows)
+
+    def read(
+        self, convo: ConversationModel, start: int = 0, stop: Optional[int] = None
+    ) -> list[Message]:
+        start, stop = _resolve_range(start, stop, lambda: self.count(convo))
+        rows = MessageModel.objects.filter(conversation_id=convo.id, seq__gte=start).order_by(
+            "seq"
+        )
+        if stop is not None:
+            rows = rows[:max(stop - start, 0)]
+        return [row.to_message() for row in rows]
+
+    def read_tail(self, convo: ConversationModel, k: int) -> list[Message]:
+        if k <= 0:
+            return []
+        rows = MessageModel.objects.filter(conversation_id=convo.id).order_by("-seq")[:k]
+        return [row.to_message() for row in reversed(rows)]
+
+    def count(self, convo: ConversationModel) -> int:
+        return MessageModel.objects.filter(conversation_id=convo.id).count()
+
+    def delete(self, convo: ConversationModel):
+        MessageModel.objects.filter(conversation_id=convo.id).delete()
+
+    def delete_many(self, convos: list[ConversationModel]):
+        MessageModel.objects.filter(conversation_id__in=[convo.id for convo in convos]).delete()
+
+    def size(self, convo: ConversationModel) -> int:
+        return (
+            MessageModel.objects.filter(conversation_id=convo.id).aggregate(
+                size=Sum(Length("content"))
+            )["size"]
+            or 0
+        )
+
+
+"""
+Storage: SQLite Blob
+"""
+
+
+class SQLiteBlobStorage(ConversationStorage):
+    """
+    Messages as blobs in a dedicated SQLite database, clustered by (conversation, seq).
+
+    Note:
+        The table is `WITHOUT ROWID`, so the rows of a conversation are stored together in key
+        order and a tail is a short backwards range scan. The database runs in WAL mode with
+        a connection per thread, so reads never wait for writes.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def append_many(
+        self, convo: ConversationModel, messages: list[Message], fsync: bool = False
+    ):
+        connection = self._connection()
+        connection.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            (first_seq,) = connection.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE conv_id = ?", (convo.id,)
+            ).fetchone()
+            connection.executemany(
+                "INSERT INTO messages (conv_id, seq, is_user, body) VALUES (?, ?, ?, ?)",
+                [
+                    (convo.id, first_seq + idx, message.is_user, message.message.encode("utf-8"))
+                    for idx, message in enumerate(messages)
+                ],
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def prepend_many(self, convo: ConversationModel, messages: list[Message]):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Negated first so the renumbering never collides with an existing key.
+            connection.execute(
+                "UPDATE messages SET seq = -seq - 1 - ? WHERE conv_id = ?",
+                (len(messages), convo.id),
+            )
+            connection.execute(
+                "UPDATE messages SET seq = -seq - 1 WHERE conv_id = ? AND seq < 0", (convo.id,)
+            )
+            connection.executemany(
+                "INSERT INTO messages (conv_id, seq, is_user, body) VALUES (?, ?, ?, ?)",
+                [
+                    (convo.id, idx, message.is_user, message.message.encode("utf-8"))
+                    for idx, message in enumerate(messages)
+                ],
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def read(
+        self, convo: ConversationModel, start: int = 0, stop: Optional[int] = None
+    ) -> list[Message]:
+        start, stop = _resolve_range(start, stop, lambda: self.count(convo))
+        rows = self._connection().execute(
+            "SELECT is_user, body FROM messages WHERE conv_id = ? AND seq >= ? "
+            "ORDER BY seq LIMIT ?",
+            (convo.id, start, -1 if stop is None else max(stop - start, 0)),
+        )
+        return [Message(body.decode("utf-8"), bool(is_user)) for is_user, body in rows]
+
+    def read_tail(self, convo: ConversationModel, k: int) -> list[Message]:
+        if k <= 0:
+            return []
+        rows = self._connection().execute(
+            "SELECT is_user, body FROM messages WHERE conv_id = ? ORDER BY seq DESC LIMIT ?",
+            (convo.id, k),
+        )
+        return [Message(body.decode("utf-8"), bool(is_user)) for is_user, body in rows][::-1]
+
+    def count(self, convo: ConversationModel) -> int:
+        return self._scalar("SELECT COUNT(*) FROM messages WHERE conv_id = ?", convo.id)
+
+    def delete(self, convo: ConversationModel):
+        self._connection().execute("DELETE FROM messages WHERE conv_id = ?", (convo.id,))
+
+    def delete_many(self, convos: list[ConversationModel]):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "DELETE FROM messages WHERE conv_id = ?", [(convo.id,) for convo in convos]
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def size(self, convo: ConversationModel) -> int:
+        return self._scalar(
+            "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM messages WHERE conv_id = ?", convo.id
+        )
+
+    def _scalar(self, sql: str, conv_id: int) -> int:
+        return self._connection().execute(sql, (conv_id,)).fetchone()[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Transactions are managed explicitly.
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "conv_id INTEGER NOT NULL, seq INTEGER NOT NULL, is_user INTEGER NOT NULL, "
+                "body BLOB NOT NULL, PRIMARY KEY (conv_id, seq)) WITHOUT ROWID"
+            )
+            self._local.connection = connection
+        return connection
+
+    def _after_fork(self):
+        # SQLite connections must not be used across a fork.
+        self._local = threading.local()
+
+
+"""
+Storage: Memory
+"""
+
+
+class MemoryStorage(ConversationStorage):
+    """
+    Messages held in process memory, e.g. for development and tests. Nothing is persisted.
+    """
+
+    def __init__(self):
+        self._messages: dict[int, list[Message]] = {}
+        self._lock = threading.Lock()
+
+    def append_many(
+        self, convo: ConversationModel, messages: list[Message], fsync: bool = False
+    ):
+        with self._lock:
+            self._messages.setdefault(convo.id, []).extend(messages)
+
+    def prepend_many(self, convo: ConversationModel, messages: list[Message]):
+        with self._lock:
+            self._messages[convo.id] = messages + self._messages.get(convo.id, [])
+
+    def read(
+        self, convo: ConversationModel, start: int = 0, stop: Optional[int] = None
+    ) -> list[Message]:
+        with self._lock:
+            return self._messages.get(convo.id, [])[start:stop]
+
+    def read_tail(self, convo: ConversationModel, k: int) -> list[Message]:
+        if k <= 0:
+            return []
+        with self._lock:
+            return self._messages.get(convo.id, [])[-k:]
+
+    def count(self, convo: ConversationModel) -> int:
+        with self._lock:
+            return len(self._messages.get(convo.id, []))
+
+    def delete(self, convo: ConversationModel):
+        with self._lock:
+            self._messages.pop(convo.id, None)
+
+    def size(self, convo: ConversationModel) -> int:
+        with self._lock:
+            messages = self._messages.get(convo.id, [])
+        return sum(len(message.message.encode("utf-8")) for message in messages)
+
+
+STORAGE_BACKENDS: dict[str, Callable[[], ConversationStorage]] = {
+    MESSAGE_STORE__FILE: lambda: FileSystemStorage(transcript_cache),
+    MESSAGE_STORE__DATABASE: DatabaseStorage,
+    MESSAGE_STORE__SQLITE_BLOB: lambda: SQLiteBlobStorage(Path(settings.CHAT_SQLITE_BLOB_PATH)),
+    MESSAGE_STORE__MEMORY: MemoryStorage,
+}
+_storages: dict[str, ConversationStorage] = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(name: Optional[str] = None) -> ConversationStorage:
+    """
+    Get the storage backend, one instance per backend and process.
+
+    Args:
+        name (Optional[str], optional): Name of the backend. Defaults to None, using the
+            `CHAT_MESSAGE_STORE` setting.
+
+    Returns:
+        ConversationStorage: Storage backend.
+    """
+
+    name = settings.CHAT_MESSAGE_STORE if name is None else name
+    if name not in STORAGE_BACKENDS:
+        raise ImproperlyConfigured(
+            f"Unknown message store {name!r}, expected one of {', '.join(STORAGE_BACKENDS)}."
+        )
+    with _storages_lock:
+        if name not in _storages:
+            _storages[name] = STORAGE_BACKENDS[name]()
+        return _storages[name]
+
+
+"""
+Storage: Conversation History
+"""
+
+
+class ConversationHistory(object):
+    """
+    Messages of a conversation including those it shares with the conversations it was forked
+    from.
+
+    Note:
+        A fork stores only its own messages. Its history is the first `fork_point` messages
+        of its parent's history followed by them, resolved up the chain of parents. Messages
+        are numbered across the whole history, so a fork at message N numbers its own
+        messages from N. Conversations that are not forks read straight from storage.
+    """
+
+    def __init__(self, convo: ConversationModel, storage: Optional[ConversationStorage] = None):
+        self.convo = convo
+        self.storage = get_storage() if storage is None else storage
+        self._prefix: Optional[list[tuple[ConversationModel, int]]] = None
+
+    @property
+    def prefix(self) -> list[tuple[ConversationModel, int]]:
+        """
+        Returns:
+            list[tuple[ConversationModel, int]]: Ancestors, root first, each with the number of
+                its own messages that are part of the history.
+        """
+
+        if self._prefix is None:
+            self._prefix = self._resolve_prefix()
+        return self._prefix
+
+    @property
+    def prefix_length(self) -> int:
+        return sum(num_messages for _, num_messages in self.prefix)
+
+    def count(self) -> int:
+        return self.prefix_length + self.storage.count(self.convo)
+
+    def read(self, start: int = 0, stop: Optional[int] = None) -> list[Message]:
+        if self.convo.parent_id is None:
+            return self.storage.read(self.convo, start, stop)
+        start, stop = _resolve_range(start, stop, self.count)
+        messages = []
+        base = 0
+        for ancestor, num_messages in self.prefix:
+            own_start = max(start - base, 0)
+            own_stop = num_messages if stop is None else min(stop - base, num_messages)
+            if own_start < own_stop:
+                messages.extend(self.storage.read(ancestor, own_start, own_stop))
+            base += num_messages
+        if stop is None or stop > base:
+            messages.extend(
+                self.storage.read(
+                    self.convo, max(start - base, 0), None if stop is None else stop - base
+                )
+            )
+        return messages
+
+    def read_tail(self, k: int) -> list[Message]:
+        messages = self.storage.read_tail(self.convo, k)
+        if self.convo.parent_id is None:
+            return messages
+        for ancestor, num_messages in reversed(self.prefix):
+            missing = k - len(messages)
+            if missing <= 0:
+                break
+            messages = (
+                self.storage.read(ancestor, max(num_messages - missing, 0), num_messages)
+                + messages
+            )
+        return messages
+
+    def read_since(self, seq: int) -> list[Message]:
+        if self.convo.parent_id is None:
+            return self.storage.read_since(self.convo, seq)
+        prefix_length = self.prefix_length
+        if seq >= prefix_length:
+            return self.storage.read_since(self.convo, seq - prefix_length)
+        return self.read(max(seq, 0))
+
+    def detach(self):
+        """
+        Copy the shared messages into the conversation's own storage and unlink it from its
+        parent, e.g. before the parent is deleted.
+        """
+
+        if self.convo.parent_id is None:
+            return
+        shared = self.read(0, self.prefix_length)
+        self.storage.prepend_many(self.convo, shared)
+        ConversationModel.objects.filter(id=self.convo.id).update(parent=None, fork_point=0)
+        self.convo.parent_id, self.convo.fork_point = None, 0
+        self._prefix = None
+
+    def _resolve_prefix(self) -> list[tuple[ConversationModel, int]]:
+        prefix = []
+        convo = self.convo
+        # Number of messages of the current ancestor's history within the fork's history.
+        wanted: Optional[int] = None
+        while convo.parent_id is not None:
+            wanted = convo.fork_point if wanted is None else min(wanted, convo.fork_point)
+            convo = ConversationModel.objects.only("file_name", "parent_id", "fork_point").get(
+                id=convo.parent_id
+            )
+            if convo.parent_id is None:
+                prefix.append((convo, wanted))
+            else:
+                prefix.append((convo, max(wanted - convo.fork_point, 0)))
+        prefix.reverse()
+        return [(ancestor, num_messages) for ancestor, num_messages in prefix if num_messages]
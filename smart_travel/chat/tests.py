@@ -1,16 +1,27 @@
+import fcntl
+import json
+import os
 import shutil
 import tempfile
+import threading
 import time
 from dataclasses import dataclass
-from io import BytesIO
+from datetime import timedelta
+from io import BytesIO, StringIO
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Any, Optional
 from unittest.mock import patch
 
 from accounts.models import AccountModel
+from chat.admin import UsageStatisics
 from chat.views import event_handler__new_conversation, event_handler__new_user_message
 from django.contrib.auth.hashers import make_password  # type: ignore
-from django.test import Client, TestCase, TransactionTestCase  # type: ignore
+from django.core.management import call_command  # type: ignore
+from django.core.management.base import CommandError  # type: ignore
+from django.db import transaction  # type: ignore
+from django.core.exceptions import ImproperlyConfigured  # type: ignore
+from django.test import Client, TestCase, TransactionTestCase, override_settings  # type: ignore
 from django.urls import reverse  # type: ignore
 from django.utils import timezone  # type: ignore
 from eda.event_dispatcher import get_event, subscribe
@@ -18,12 +29,46 @@ from eda.event_dispatcher import get_event, subscribe
 from .cqrs.commands import (
     CommandCreateConversation,
     CommandDeleteConversation,
+    CommandDeleteConversations,
+    CommandForkConversation,
+    CommandPurgeConversations,
     CommandSaveMessage,
 )
-from .cqrs.queries import QueryFindConversation, QueryRetrieveMessages
+from .cqrs.queries import (
+    QueryCountMessages,
+    QueryFindConversation,
+    QueryRetrieveMessages,
+    QueryRetrieveMessagesSince,
+    QueryRetrieveRecentMessages,
+)
 from .forms import MessageForm, NewChatForm
-from .models import ConversationModel
+from .signals import defer_storage_deletion
+from chatbot.usage import CompletionUsage
+
+from .models import (
+    CompletionUsageModel,
+    ConversationModel,
+    DailyTokenUsageModel,
+    MessageModel,
+)
+from .storage import (
+    ConversationHistory,
+    DatabaseStorage,
+    FileSystemStorage,
+    MemoryStorage,
+    SQLiteBlobStorage,
+    get_storage,
+)
+from .utility.group_commit import GroupCommitter
+from .utility.handle_pool import HandlePool
+from .utility.locks import LockManager, RWLock, transcript_locks
 from .utility.message import Message
+from .utility.rate_limit import RateLimiter, TokenBucket, TokenQuotaTracker
+from .utility.retrieval import ExchangeIndex, TfidfIndex, tokenize
+from .utility.scheduler import AgentScheduler, Priority
+from .utility.transcript import TRANSCRIPT_MAGIC, TranscriptFile
+from .utility.transcript_cache import TranscriptCache
+from .utility.usage_recorder import UsageRecorder
 
 """
 Mocked Classes
@@ -40,10 +85,29 @@ class MockedChatbot:
     def initialize_session(self) -> bool:
         return MOCK__INITIALIZE_SESSION__RET_VAL
 
-    def prompt_completion(self, _: list[Message]) -> Optional[str]:
+    def prompt_completion(self, _: list[Message], **__) -> Optional[str]:
         return MOCK__PROMPT_COMPLETION__RET_VAL
 
 
+class MockedOpenAI:
+    def __init__(self, *_, **__):
+        self.requests: list[dict[str, Any]] = []
+        self.responses = self
+
+    def create(self, **kwargs) -> SimpleNamespace:
+        self.requests.append(kwargs)
+        return SimpleNamespace(
+            output_text=f"Reply to {kwargs['input'][-1]['content']}",
+            model=kwargs["model"],
+            output=[],
+            usage=SimpleNamespace(
+                input_tokens=100,
+                output_tokens=20,
+                input_tokens_details=SimpleNamespace(cached_tokens=0),
+            ),
+        )
+
+
 @dataclass
 class MockRequest:
     session: Any
@@ -79,6 +143,13 @@ def poll_and_handle_event(request, name: Optional[str] = None):
         EVENT_HANDLER_CALLBACKS[event["name"]](request, event)
 
 
+def remove_transcript(transcript: TranscriptFile):
+    # Transcripts keep their lock file once deleted, tests writing to the media directory
+    # remove it too.
+    transcript.delete()
+    LockManager.lock_path(transcript.path).unlink(missing_ok=True)
+
+
 """
 Tests
 """
@@ -285,6 +356,22 @@ class CommandCreateConversationTests(TestCase):
         conv2 = ConversationModel.objects.get(title="Trip 2", user=self.user)
         self.assertNotEqual(conv1.file_name, conv2.file_name)
 
+    def test_same_title_gets_own_file(self):
+        self.assertTrue(CommandCreateConversation.execute(title="Trip", user=self.user))
+        self.assertTrue(CommandCreateConversation.execute(title="Trip", user=self.user))
+
+        conv1, conv2 = ConversationModel.objects.filter(title="Trip").order_by("id")
+        self.assertNotEqual(conv1.file_name, conv2.file_name)
+        self.assertEqual(conv1.file_name, ConversationModel.storage_name(conv1.id))
+
+    def test_storage_name_is_sharded(self):
+        shard, subshard, name = ConversationModel.storage_name(1234).split("/")
+        self.assertEqual(name, "1234.txt")
+        self.assertEqual((len(shard), len(subshard)), (2, 2))
+        self.assertEqual(
+            ConversationModel.storage_name(1234), ConversationModel.storage_name(1234)
+        )
+
 
 class CommandDeleteConversationTests(TestCase):
     def setUp(self):
@@ -325,6 +412,137 @@ class CommandDeleteConversationTests(TestCase):
         self.assertFalse(result)
         self.assertTrue(ConversationModel.objects.filter(id=conv_id).exists())
 
+    def test_delete_conversation_removes_transcript(self):
+        with tempfile.TemporaryDirectory() as temp_dir, patch.object(
+            ConversationModel,
+            "abs_path",
+            new_callable=lambda: property(lambda convo: Path(temp_dir) / convo.file_name),
+        ):
+            self.conversation.transcript.append(Message("Hello", True))
+            with self.captureOnCommitCallbacks(execute=True):
+                CommandDeleteConversation.execute(
+                    user_id=self.user.id, conv_id=self.conversation.id
+                )
+            self.assertEqual(os.listdir(temp_dir), ["test.txt.lock"])
+
+    def test_deleting_user_removes_transcripts(self):
+        with tempfile.TemporaryDirectory() as temp_dir, patch.object(
+            ConversationModel,
+            "abs_path",
+            new_callable=lambda: property(lambda convo: Path(temp_dir) / convo.file_name),
+        ):
+            self.conversation.transcript.append(Message("Hello", True))
+            with self.captureOnCommitCallbacks(execute=True):
+                AccountModel.objects.filter(id=self.user.id).delete()
+            self.assertEqual(os.listdir(temp_dir), ["test.txt.lock"])
+
+    def test_rolled_back_delete_keeps_transcript(self):
+        with tempfile.TemporaryDirectory() as temp_dir, patch.object(
+            ConversationModel,
+            "abs_path",
+            new_callable=lambda: property(lambda convo: Path(temp_dir) / convo.file_name),
+        ):
+            self.conversation.transcript.append(Message("Hello", True))
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                ConversationModel.objects.filter(id=self.conversation.id).delete()
+            self.assertEqual(len(callbacks), 1)
+            self.assertTrue(self.conversation.transcript.exists())
+            self.conversation.transcript.delete()
+
+    def test_deferred_delete_collects_conversations(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            with defer_storage_deletion() as deleted:
+                ConversationModel.objects.filter(id=self.conversation.id).delete()
+        self.assertEqual(len(callbacks), 0)
+        self.assertEqual([convo.id for convo in deleted], [self.conversation.id])
+
+
+@override_settings(CHAT_MESSAGE_STORE="memory")
+class CommandDeleteConversationsTests(TestCase):
+    def setUp(self):
+        self.user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        self.other_user = AccountModel.objects.create(
+            first_name="Other",
+            last_name="User",
+            user_name="otheruser",
+            password_hash=make_password("testpass"),
+        )
+        now = timezone.now()
+        self.conversations = [
+            ConversationModel.objects.create(
+                title=f"Chat {idx}",
+                user=self.user if idx < 4 else self.other_user,
+                file_name=f"bulk_delete_{idx}.txt",
+                time_of_last_message=now - timedelta(days=10 * idx),
+            )
+            for idx in range(6)
+        ]
+        for convo in self.conversations:
+            get_storage().append(convo, Message(f"Hello {convo.id}", True))
+        for event in ("DELETE_CONVERSATIONS", "PURGE_CONVERSATIONS"):
+            subscribe("TESTING_BULK_DELETE", event)
+
+    def tearDown(self):
+        for convo in self.conversations:
+            get_storage().delete(convo)
+        while get_event("TESTING_BULK_DELETE") is not None:
+            pass
+
+    def _remaining(self) -> list[int]:
+        return list(ConversationModel.objects.order_by("id").values_list("id", flat=True))
+
+    def test_delete_only_own_conversations(self):
+        conv_ids = [convo.id for convo in self.conversations[2:]]
+        with self.captureOnCommitCallbacks(execute=True):
+            num_deleted = CommandDeleteConversations.execute(self.user.id, conv_ids)
+
+        self.assertEqual(num_deleted, 2)
+        kept = self.conversations[:2] + self.conversations[4:]
+        self.assertEqual(self._remaining(), [convo.id for convo in kept])
+        for convo in self.conversations[2:4]:
+            self.assertEqual(get_storage().read_all(convo), [])
+        self.assertEqual(get_storage().count(self.conversations[4]), 1)
+
+        event = get_event("TESTING_BULK_DELETE")
+        self.assertEqual(event["name"], "DELETE_CONVERSATIONS")
+        self.assertEqual(event["data"], {"num_deleted": 2})
+        self.assertIsNone(get_event("TESTING_BULK_DELETE"))
+
+    def test_purge_idle_conversations_in_chunks(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            num_deleted = CommandPurgeConversations.execute(idle_days=15, chunk_size=2)
+
+        self.assertEqual(num_deleted, 4)
+        # The messages of each chunk are deleted together.
+        self.assertEqual(len(callbacks), 2)
+        self.assertEqual(self._remaining(), [convo.id for convo in self.conversations[:2]])
+        for convo in self.conversations[2:]:
+            self.assertEqual(get_storage().count(convo), 0)
+
+        event = get_event("TESTING_BULK_DELETE")
+        self.assertEqual(event["name"], "PURGE_CONVERSATIONS")
+        self.assertEqual(event["data"], {"num_deleted": 4, "idle_days": 15})
+        self.assertIsNone(get_event("TESTING_BULK_DELETE"))
+
+    def test_delete_chats_view(self):
+        session = self.client.session
+        session["user_id"] = self.user.id
+        session.save()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("operation__delete_chats"),
+                {"conv_ids": [self.conversations[0].id, self.conversations[5].id]},
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(self.conversations[0].id, self._remaining())
+        self.assertIn(self.conversations[5].id, self._remaining())
+
 
 class CommandSaveMessageTests(TestCase):
     def setUp(self):
@@ -364,7 +582,7 @@ class CommandSaveMessageTests(TestCase):
         if file_path.exists():
             content = file_path.read_text()
             self.assertIn("### User\nHello\n", content)
-            file_path.unlink()
+            TranscriptFile(file_path).delete()
 
     @patch.object(
         ConversationModel,
@@ -396,7 +614,7 @@ class CommandSaveMessageTests(TestCase):
                 self.assertIn("### User\nHow are you?\n", content)
         finally:
             if file_path.exists():
-                file_path.unlink()
+                TranscriptFile(file_path).delete()
 
 
 class QueryFindConversationTests(TestCase):
@@ -507,6 +725,260 @@ class QueryRetrieveMessagesTests(TestCase):
                 temp_file.unlink()
 
 
+@override_settings(CHAT_MESSAGE_STORE="memory")
+class QueryRetrieveMessagesSinceTests(TestCase):
+    def setUp(self):
+        user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        self.conversation = ConversationModel.objects.create(
+            title="Test Chat",
+            user=user,
+            file_name="messages_since.txt",
+            time_of_last_message=timezone.now(),
+        )
+
+    def tearDown(self):
+        get_storage().delete(self.conversation)
+
+    def test_incremental_sync(self):
+        for idx in range(3):
+            CommandSaveMessage.execute(self.conversation.id, Message(f"Message {idx}", True))
+
+        response = QueryRetrieveMessagesSince.execute(self.conversation.id, 0)
+        self.assertTrue(response["status"])
+        self.assertEqual(len(response["data"]), 3)
+        self.assertEqual(response["next_seq"], 3)
+
+        response = QueryRetrieveMessagesSince.execute(self.conversation.id, response["next_seq"])
+        self.assertEqual(response["data"], [])
+        self.assertEqual(response["next_seq"], 3)
+
+        CommandSaveMessage.execute(self.conversation.id, Message("Message 3", False))
+        response = QueryRetrieveMessagesSince.execute(self.conversation.id, response["next_seq"])
+        self.assertEqual(response["data"], [Message("Message 3", False)])
+        self.assertEqual(response["next_seq"], 4)
+
+    def test_missing_conversation(self):
+        response = QueryRetrieveMessagesSince.execute(99999, 2)
+        self.assertFalse(response["status"])
+        self.assertEqual(response["next_seq"], 2)
+
+
+@override_settings(CHAT_MESSAGE_STORE="memory")
+class ConversationForkTests(TestCase):
+    def setUp(self):
+        self.user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        self.conversation = ConversationModel.objects.create(
+            title="Trip",
+            user=self.user,
+            file_name="fork_parent.txt",
+            time_of_last_message=timezone.now(),
+        )
+        self.messages = [Message(f"Message {idx}", idx % 2 == 0) for idx in range(6)]
+        get_storage().append_many(self.conversation, self.messages)
+
+    def tearDown(self):
+        for convo in ConversationModel.objects.all():
+            get_storage().delete(convo)
+
+    def _fork(self, conv_id: int, num_messages: int) -> ConversationModel:
+        fork_id = CommandForkConversation.execute(self.user.id, conv_id, num_messages)
+        self.assertIsNotNone(fork_id)
+        return ConversationModel.objects.get(id=fork_id)
+
+    def test_fork_shares_prefix(self):
+        fork = self._fork(self.conversation.id, 4)
+        CommandSaveMessage.execute(fork.id, Message("Instead", True))
+
+        self.assertEqual(get_storage().read_all(fork), [Message("Instead", True)])
+        history = ConversationHistory(fork)
+        expected = self.messages[:4] + [Message("Instead", True)]
+        self.assertEqual(history.count(), 5)
+        self.assertEqual(history.read(), expected)
+        self.assertEqual(history.read(3, 5), expected[3:5])
+        self.assertEqual(history.read(-2), expected[-2:])
+        self.assertEqual(history.read_tail(3), expected[-3:])
+        self.assertEqual(history.read_since(2), expected[2:])
+        self.assertEqual(history.read_since(4), expected[4:])
+
+        response = QueryRetrieveRecentMessages.execute(fork.id, 2)
+        self.assertEqual(response["data"], expected[-2:])
+        # The parent is unaffected.
+        self.assertEqual(QueryCountMessages.execute(self.conversation.id)["data"], 6)
+
+    def test_fork_of_fork(self):
+        fork = self._fork(self.conversation.id, 4)
+        get_storage().append_many(fork, [Message("A", True), Message("B", False)])
+        fork_of_fork = self._fork(fork.id, 5)
+        get_storage().append(fork_of_fork, Message("C", True))
+
+        self.assertEqual(
+            ConversationHistory(fork_of_fork).read(),
+            self.messages[:4] + [Message("A", True), Message("C", True)],
+        )
+        shallow = self._fork(fork.id, 2)
+        self.assertEqual(ConversationHistory(shallow).read(), self.messages[:2])
+
+    def test_fork_point_is_clamped(self):
+        fork = self._fork(self.conversation.id, 100)
+        self.assertEqual(fork.fork_point, 6)
+
+    def test_fork_wrong_user(self):
+        self.assertIsNone(CommandForkConversation.execute(-1, self.conversation.id, 2))
+
+    def test_deleting_parent_keeps_fork_history(self):
+        fork = self._fork(self.conversation.id, 3)
+        get_storage().append(fork, Message("Own", True))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            CommandDeleteConversation.execute(self.user.id, self.conversation.id)
+
+        fork.refresh_from_db()
+        self.assertIsNone(fork.parent_id)
+        self.assertEqual(
+            ConversationHistory(fork).read(), self.messages[:3] + [Message("Own", True)]
+        )
+
+    def test_rolled_back_delete_keeps_fork_linked(self):
+        fork = self._fork(self.conversation.id, 3)
+
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                ConversationModel.objects.filter(id=self.conversation.id).delete()
+                raise RuntimeError("rolled back")
+
+        fork.refresh_from_db()
+        self.assertEqual(fork.parent_id, self.conversation.id)
+        self.assertEqual(ConversationHistory(fork).read(), self.messages[:3])
+
+    def test_fork_view_selects_fork(self):
+        session = self.client.session
+        session["user_id"] = self.user.id
+        session.save()
+
+        response = self.client.get(
+            reverse("operation__fork_chat", args=[self.conversation.id, 2])
+        )
+        self.assertEqual(response.status_code, 302)
+        fork = ConversationModel.objects.get(parent=self.conversation)
+        self.assertEqual(self.client.session["conv_id"], fork.id)
+        self.assertEqual(fork.fork_point, 2)
+
+
+# Messages in the database are deleted by the cascade of their conversation's delete.
+@override_settings(CHAT_MESSAGE_STORE="database")
+class DatabaseConversationForkTests(ConversationForkTests):
+    pass
+
+
+@override_settings(CHAT_MESSAGE_STORE="database")
+class DatabaseMessageStoreTests(TestCase):
+    def setUp(self):
+        self.user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        self.conversation = ConversationModel.objects.create(
+            title="Test Chat",
+            user=self.user,
+            file_name="database_store.txt",
+            time_of_last_message=timezone.now(),
+        )
+        for idx in range(3):
+            CommandSaveMessage.execute(self.conversation.id, Message(f"Question {idx}", True))
+            CommandSaveMessage.execute(self.conversation.id, Message(f"**Answer {idx}**", False))
+
+    def test_messages_are_rows_not_files(self):
+        self.assertFalse(self.conversation.abs_path.exists())
+        self.assertEqual(
+            list(
+                MessageModel.objects.filter(conversation=self.conversation)
+                .order_by("seq")
+                .values_list("seq", flat=True)
+            ),
+            list(range(6)),
+        )
+
+    def test_retrieve_messages(self):
+        response = QueryRetrieveMessages.execute(self.conversation.id)
+
+        self.assertTrue(response["status"])
+        self.assertEqual(len(response["data"]), 6)
+        self.assertEqual(response["data"][0], Message("Question 0", True))
+        self.assertFalse(response["data"][1].is_user)
+        self.assertEqual(response["data"][1].markdown, "<p><strong>Answer 0</strong></p>")
+
+    def test_retrieve_page(self):
+        response = QueryRetrieveMessages.execute(self.conversation.id, start=2, limit=3)
+        self.assertEqual(
+            [message.message for message in response["data"]],
+            ["Question 1", "**Answer 1**", "Question 2"],
+        )
+
+    def test_count_messages(self):
+        response = QueryCountMessages.execute(self.conversation.id)
+        self.assertTrue(response["status"])
+        self.assertEqual(response["data"], 6)
+
+    def test_retrieve_recent_messages(self):
+        response = QueryRetrieveRecentMessages.execute(self.conversation.id, 2)
+        self.assertEqual(
+            [message.message for message in response["data"]], ["Question 2", "**Answer 2**"]
+        )
+
+    def test_messages_deleted_with_conversation(self):
+        CommandDeleteConversation.execute(self.user.id, self.conversation.id)
+        self.assertFalse(MessageModel.objects.exists())
+
+
+class FileMessageStorePaginationTests(TestCase):
+    def setUp(self):
+        self.user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        self.conversation = ConversationModel.objects.create(
+            title="Test Chat",
+            user=self.user,
+            file_name="file_store_pagination.txt",
+            time_of_last_message=timezone.now(),
+        )
+        self.conversation.abs_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conversation.abs_path.write_text(
+            "### User\nHello\n### Agent\nHi there!\n### User\nBye\n"
+        )
+
+    def tearDown(self):
+        remove_transcript(self.conversation.transcript)
+
+    def test_retrieve_page(self):
+        response = QueryRetrieveMessages.execute(self.conversation.id, start=1, limit=1)
+        self.assertEqual(response["data"], [Message("Hi there!\n", False)])
+
+    def test_count_messages(self):
+        self.assertEqual(QueryCountMessages.execute(self.conversation.id)["data"], 3)
+
+    def test_retrieve_recent_messages(self):
+        response = QueryRetrieveRecentMessages.execute(self.conversation.id, 2)
+        self.assertTrue(response["status"])
+        self.assertEqual(
+            response["data"], [Message("Hi there!\n", False), Message("Bye\n", True)]
+        )
+
+
 class ChatViewTests(TestCase):
     def setUp(self):
         self.client = Client()
@@ -531,6 +1003,67 @@ class ChatViewTests(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertIn("/accounts", response.url)
 
+    @override_settings(CHAT_VIEW_RECENT_MESSAGES=2)
+    def test_chat_view_shows_recent_messages(self):
+        conversation = ConversationModel.objects.create(
+            title="Long Chat",
+            user=self.user,
+            file_name="long_chat.txt",
+            time_of_last_message=timezone.now(),
+        )
+        for idx in range(5):
+            CommandSaveMessage.execute(conversation.id, Message(f"Message {idx}", True))
+        session = self.client.session
+        session["conv_id"] = conversation.id
+        session.save()
+
+        try:
+            response = self.client.get(reverse("chat"))
+            self.assertEqual(
+                [m.message for m in response.context["messages"]], ["Message 3", "Message 4"]
+            )
+            self.assertTrue(response.context["has_earlier"])
+
+            response = self.client.post(reverse("chat"), data={"limit": 2})
+            self.assertEqual(len(response.context["messages"]), 4)
+            self.assertTrue(response.context["has_earlier"])
+
+            response = self.client.post(reverse("chat"), data={"limit": 4})
+            self.assertEqual(len(response.context["messages"]), 5)
+            self.assertFalse(response.context["has_earlier"])
+        finally:
+            remove_transcript(conversation.transcript)
+
+    @override_settings(CHAT_MESSAGE_STORE="memory")
+    def test_sync_messages(self):
+        conversation = ConversationModel.objects.create(
+            title="Sync Chat",
+            user=self.user,
+            file_name="sync_chat.txt",
+            time_of_last_message=timezone.now(),
+        )
+        for idx in range(3):
+            CommandSaveMessage.execute(conversation.id, Message(f"Message {idx}", idx == 0))
+        session = self.client.session
+        session["conv_id"] = conversation.id
+        session.save()
+
+        try:
+            response = self.client.get(reverse("chat"))
+            self.assertEqual(response.context["next_seq"], 3)
+
+            response = self.client.get(reverse("operation__sync_messages"), {"since": 1})
+            data = response.json()
+            self.assertEqual([m["seq"] for m in data["messages"]], [1, 2])
+            self.assertEqual(data["messages"][0]["message"], "Message 1")
+            self.assertEqual(data["html"].count('class="message agent-message"'), 2)
+            self.assertEqual(data["next_seq"], 3)
+
+            response = self.client.get(reverse("operation__sync_messages"), {"since": "x"})
+            self.assertEqual(response.status_code, 400)
+        finally:
+            get_storage().delete(conversation)
+
     def test_handle_new_chat(self):
         response = self.client.post(
             reverse("chat") + "operation/new_chat", data={"title": "New Trip"}
@@ -737,8 +1270,7 @@ class AgentMessageSubmissionTests(TransactionTestCase):
             self.assertIn("### Agent\n", content)
             self.assertIn("I can help you plan your trip to Paris!", content)
         finally:
-            if conv_file_path.exists():
-                conv_file_path.unlink()
+            remove_transcript(TranscriptFile(conv_file_path))
             MOCK__PROMPT_COMPLETION__RET_VAL = None
 
     @patch("chat.views.chatbot", new_callable=MockedChatbot)
@@ -778,6 +1310,1487 @@ class AgentMessageSubmissionTests(TransactionTestCase):
             self.assertEqual(len([m for m in messages if m.is_user]), 2)
             self.assertEqual(len([m for m in messages if not m.is_user]), 2)
         finally:
-            if conv_file_path.exists():
-                conv_file_path.unlink()
+            remove_transcript(TranscriptFile(conv_file_path))
             MOCK__PROMPT_COMPLETION__RET_VAL = None
+
+
+class AgentSchedulerTests(TestCase):
+    def setUp(self):
+        self.scheduler = AgentScheduler(num_workers=1)
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.executed = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.release.set()
+
+    def _block(self):
+        self.started.set()
+        self.release.wait(timeout=5)
+
+    def _record(self, name: str):
+        with self.lock:
+            self.executed.append(name)
+
+    def _wait_for(self, count: int):
+        start = time.time()
+        while len(self.executed) < count and time.time() - start < 5:
+            time.sleep(0.01)
+
+    def test_heavy_user_does_not_starve_others(self):
+        self.scheduler.submit("heavy", self._block)
+        self.started.wait(timeout=5)
+        for idx in range(3):
+            self.scheduler.submit("heavy", self._record, f"heavy-{idx}")
+        self.scheduler.submit("light", self._record, "light-0")
+        self.assertEqual(self.scheduler.queued("heavy"), 3)
+
+        self.release.set()
+        self._wait_for(4)
+        self.assertEqual(self.executed, ["heavy-0", "light-0", "heavy-1", "heavy-2"])
+
+    def test_interactive_served_before_background(self):
+        self.scheduler.submit("user", self._block)
+        self.started.wait(timeout=5)
+        self.scheduler.submit("user", self._record, "summary", priority=Priority.BACKGROUND)
+        self.scheduler.submit("user", self._record, "turn", priority=Priority.INTERACTIVE)
+
+        self.release.set()
+        self._wait_for(2)
+        self.assertEqual(self.executed, ["turn", "summary"])
+
+    def test_weight_increases_share(self):
+        self.scheduler.submit("a", self._block)
+        self.started.wait(timeout=5)
+        for idx in range(2):
+            self.scheduler.submit("a", self._record, f"a-{idx}")
+        for idx in range(2):
+            self.scheduler.submit("b", self._record, f"b-{idx}", weight=2.0)
+
+        self.release.set()
+        self._wait_for(4)
+        self.assertEqual(self.executed, ["b-0", "a-0", "b-1", "a-1"])
+
+    def test_wait_times(self):
+        self.scheduler.submit("user", self._block)
+        self.started.wait(timeout=5)
+        self.scheduler.submit("user", self._record, "queued")
+        time.sleep(0.05)
+
+        self.release.set()
+        self._wait_for(1)
+        stats = self.scheduler.wait_times()["user"]
+        self.assertEqual(stats.count, 2)
+        self.assertGreaterEqual(stats.max_wait, 0.05)
+        self.assertGreater(stats.mean_wait, 0)
+
+    def test_failures_are_logged_and_surfaced(self):
+        def fail():
+            raise RuntimeError("agent unavailable")
+
+        with self.assertLogs("chat.utility.scheduler", level="ERROR") as logs:
+            future = self.scheduler.submit("user", fail)
+            with self.assertRaisesRegex(RuntimeError, "agent unavailable"):
+                future.result(timeout=5)
+        self.assertIn("'user'", logs.output[0])
+        # The worker survives the failure.
+        self.assertEqual(self.scheduler.submit("user", lambda: 42).result(timeout=5), 42)
+
+
+class TokenBucketTests(TestCase):
+    def test_burst_then_limited(self):
+        bucket = TokenBucket(capacity=2, refill_rate=0)
+        self.assertTrue(bucket.take())
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_refill(self):
+        bucket = TokenBucket(capacity=1, refill_rate=100)
+        self.assertTrue(bucket.take())
+        time.sleep(0.02)
+        self.assertTrue(bucket.take())
+
+
+class RateLimiterTests(TestCase):
+    def test_limits_are_per_user(self):
+        limiter = RateLimiter(capacity=1, refill_rate=0)
+        self.assertTrue(limiter.allow(1))
+        self.assertFalse(limiter.allow(1))
+        self.assertTrue(limiter.allow(2))
+
+
+class TokenQuotaTrackerTests(TestCase):
+    def setUp(self):
+        self.user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+
+    def test_charge_reduces_remaining(self):
+        tracker = TokenQuotaTracker(daily_quota=100, flush_interval=3600)
+        tracker.charge(self.user.id, 30)
+        self.assertEqual(tracker.remaining(self.user.id), 70)
+        tracker.charge(self.user.id, 100)
+        self.assertEqual(tracker.remaining(self.user.id), 0)
+
+    def test_flush_persists_usage(self):
+        tracker = TokenQuotaTracker(daily_quota=100, flush_interval=3600)
+        tracker.charge(self.user.id, 30)
+        self.assertFalse(DailyTokenUsageModel.objects.exists())
+
+        tracker.flush()
+        tracker.charge(self.user.id, 20)
+        tracker.flush()
+
+        usage = DailyTokenUsageModel.objects.get(user=self.user)
+        self.assertEqual(usage.tokens, 50)
+        self.assertEqual(usage.day, timezone.localdate())
+
+        reloaded = TokenQuotaTracker(daily_quota=100, flush_interval=3600)
+        self.assertEqual(reloaded.used(self.user.id), 50)
+
+    def test_flush_on_interval(self):
+        tracker = TokenQuotaTracker(daily_quota=100, flush_interval=0)
+        tracker.charge(self.user.id, 10)
+        self.assertEqual(DailyTokenUsageModel.objects.get(user=self.user).tokens, 10)
+
+    def test_flush_skips_deleted_accounts(self):
+        tracker = TokenQuotaTracker(daily_quota=100, flush_interval=3600)
+        tracker.charge(self.user.id, 10)
+        self.user.delete()
+        tracker.flush()
+        self.assertFalse(DailyTokenUsageModel.objects.exists())
+
+    def test_charge_at_midnight(self):
+        tracker = TokenQuotaTracker(daily_quota=100, flush_interval=3600)
+        today = timezone.localdate()
+        with patch(
+            "chat.utility.rate_limit.timezone.localdate",
+            side_effect=[today, today + timedelta(days=1)],
+        ):
+            tracker.charge(self.user.id, 10)
+        self.assertEqual(tracker.used(self.user.id), 10)
+
+    def test_flush_reloads_usage_of_other_processes(self):
+        tracker = TokenQuotaTracker(daily_quota=100, flush_interval=3600)
+        other = TokenQuotaTracker(daily_quota=100, flush_interval=3600)
+        tracker.charge(self.user.id, 10)
+        other.charge(self.user.id, 20)
+        other.flush()
+        self.assertEqual(tracker.used(self.user.id), 10)
+
+        tracker.flush()
+        self.assertEqual(tracker.used(self.user.id), 30)
+
+    def test_background_flush(self):
+        tracker = TokenQuotaTracker(daily_quota=100, flush_interval=0.01)
+        with patch.object(
+            tracker, "flush", side_effect=RuntimeError("database is locked")
+        ), patch("chat.utility.rate_limit.atexit.register") as register, self.assertLogs(
+            "chat.utility.rate_limit", level="ERROR"
+        ) as logs:
+            tracker.start()
+            start = time.time()
+            while not len(logs.output) and time.time() - start < 5:
+                time.sleep(0.01)
+        register.assert_called_once()
+        self.assertIn("Failed to flush token usage", logs.output[0])
+
+
+class NewUserMessageLimitTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass123"),
+        )
+        session = self.client.session
+        session["user_id"] = self.user.id
+        session.save()
+
+    @patch("chat.views.rate_limiter", new=RateLimiter(capacity=0, refill_rate=0))
+    def test_rate_limited(self):
+        response = self.client.post(
+            reverse("operation__new_user_message"), data={"message": "Hello"}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("too quickly", self.client.session["error"])
+
+    @patch(
+        "chat.views.token_quota",
+        new=TokenQuotaTracker(daily_quota=0, flush_interval=3600),
+    )
+    def test_daily_quota_exhausted(self):
+        response = self.client.post(
+            reverse("operation__new_user_message"), data={"message": "Hello"}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("daily message allowance", self.client.session["error"])
+
+
+class UsageRecorderTests(TestCase):
+    def setUp(self):
+        self.user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        self.conversation = ConversationModel.objects.create(
+            title="Test Chat",
+            user=self.user,
+            file_name="usage.txt",
+            time_of_last_message=timezone.now(),
+        )
+        self.usage = CompletionUsage(
+            model="gpt-test",
+            route="full",
+            input_tokens=100,
+            output_tokens=20,
+            cached_tokens=80,
+            latency=1.25,
+            web_search_calls=1,
+        )
+
+    def test_flush_writes_records(self):
+        recorder = UsageRecorder()
+        recorder.record(self.usage, user_id=self.user.id, conv_id=self.conversation.id)
+        self.assertFalse(CompletionUsageModel.objects.exists())
+
+        recorder.flush()
+
+        record = CompletionUsageModel.objects.get()
+        self.assertEqual(record.user, self.user)
+        self.assertEqual(record.conversation, self.conversation)
+        self.assertEqual(record.model, "gpt-test")
+        self.assertEqual(record.input_tokens, 100)
+        self.assertEqual(record.cached_tokens, 80)
+        self.assertEqual(record.latency_ms, 1250)
+        self.assertEqual(record.web_search_calls, 1)
+
+    def test_failed_background_write_is_logged(self):
+        recorder = UsageRecorder(flush_interval=0.01)
+        with patch.object(
+            recorder, "_write", side_effect=RuntimeError("database is locked")
+        ), self.assertLogs("chat.utility.usage_recorder", level="ERROR") as logs:
+            recorder.start()
+            recorder.record(self.usage, user_id=self.user.id)
+            start = time.time()
+            while not len(logs.output) and time.time() - start < 5:
+                time.sleep(0.01)
+        self.assertIn("Failed to write 1 usage records", logs.output[0])
+
+    def test_flush_detaches_deleted_conversation(self):
+        recorder = UsageRecorder()
+        recorder.record(self.usage, user_id=self.user.id, conv_id=self.conversation.id)
+        self.conversation.delete()
+
+        recorder.flush()
+
+        record = CompletionUsageModel.objects.get()
+        self.assertEqual(record.user, self.user)
+        self.assertIsNone(record.conversation)
+
+    def test_usage_statistics_aggregate(self):
+        recorder = UsageRecorder()
+        recorder.record(self.usage, user_id=self.user.id)
+        recorder.record(self.usage, user_id=self.user.id)
+        recorder.flush()
+
+        stats = UsageStatisics.calculate()
+        self.assertEqual(stats.num_calls, 2)
+        self.assertEqual(stats.num_tokens, 240)
+        self.assertEqual(stats.tokens_per_call, 120)
+        self.assertEqual(stats.num_input_tokens, 200)
+        self.assertAlmostEqual(stats.cached_token_ratio, 160 / 200)
+        self.assertEqual(stats.avg_latency_ms, 1250)
+
+
+class TfidfIndexTests(TestCase):
+    def setUp(self):
+        self.index = TfidfIndex()
+        self.index.add("Museums to visit in Paris, such as the Louvre", payload=1, owner=1)
+        self.index.add("Street food markets in Bangkok", payload=2, owner=1)
+        self.index.add("Museums to visit in Madrid, such as the Prado", payload=3, owner=2)
+
+    def test_tokenize(self):
+        self.assertEqual(
+            tokenize("What is [the Louvre](https://louvre.fr) like?"), ["louvre"]
+        )
+
+    def test_search_ranks_by_similarity(self):
+        results = self.index.search("Which museums are in Paris?", k=3)
+        self.assertEqual([r.payload for r in results], [1, 3])
+        self.assertGreater(results[0].score, results[1].score)
+
+    def test_search_by_owner(self):
+        results = self.index.search("museums", owner=2)
+        self.assertEqual([r.payload for r in results], [3])
+
+    def test_search_unknown_terms(self):
+        self.assertEqual(self.index.search("Snorkeling reefs"), [])
+
+    def test_compaction_drops_oldest(self):
+        index = TfidfIndex(max_documents=4)
+        for i in range(5):
+            index.add(f"document number {i} about topic{i}", payload=i)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.search("topic0"), [])
+        self.assertEqual([r.payload for r in index.search("topic4")], [4])
+
+
+class ExchangeIndexTests(TestCase):
+    ANSWER = (
+        "The Louvre opens at 9am every day except Tuesday. Book tickets online ahead of time "
+        "to skip the queue at the pyramid entrance."
+    )
+
+    def setUp(self):
+        self.index = ExchangeIndex()
+        self.index.observe(1, 7, Message("What time does the Louvre open in Paris?", True))
+        self.index.observe(1, 7, Message(self.ANSWER, False))
+
+    def test_find_duplicate(self):
+        self.assertEqual(
+            self.index.find_duplicate(7, "What time does the Louvre open in Paris?", 0.95),
+            self.ANSWER,
+        )
+
+    def test_find_duplicate_other_user(self):
+        self.assertIsNone(
+            self.index.find_duplicate(8, "What time does the Louvre open in Paris?", 0.95)
+        )
+
+    def test_short_questions_are_never_duplicates(self):
+        self.index.observe(2, 7, Message("Yes please", True))
+        self.index.observe(2, 7, Message("Here it is.", False))
+        self.assertIsNone(self.index.find_duplicate(7, "Yes please", 0.5))
+
+    def test_context_snippets(self):
+        self.assertEqual(
+            self.index.context_snippets(7, "Do I need Louvre tickets?", k=3, min_score=0.1),
+            [self.ANSWER],
+        )
+        self.assertEqual(
+            self.index.context_snippets(8, "Do I need Louvre tickets?", k=3, min_score=0.1), []
+        )
+
+
+class TranscriptFileTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = Path(self.temp_dir) / "conversation.txt"
+        self.transcript = TranscriptFile(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_round_trip(self):
+        self.transcript.append(Message("Hello", True))
+        self.transcript.append_many([Message("Hi!", False), Message("Bye", True)])
+
+        self.assertTrue(self.path.read_bytes().startswith(TRANSCRIPT_MAGIC))
+        self.assertEqual(self.transcript.count(), 3)
+        self.assertEqual(
+            self.transcript.read_all(),
+            [Message("Hello", True), Message("Hi!", False), Message("Bye", True)],
+        )
+
+    def test_source_labels_inside_messages(self):
+        message = Message("Itinerary:\n### User\nnot a new message", False)
+        self.transcript.append(message)
+        self.transcript.append(Message("Thanks", True))
+
+        self.assertEqual(self.transcript.read_all(), [message, Message("Thanks", True)])
+
+    def test_read_range_and_tail(self):
+        self.transcript.append_many([Message(f"Message {idx}", idx % 2 == 0) for idx in range(10)])
+
+        self.assertEqual(
+            [message.message for message in self.transcript.read(4, 6)],
+            ["Message 4", "Message 5"],
+        )
+        self.assertEqual(
+            [message.message for message in self.transcript.read_tail(2)],
+            ["Message 8", "Message 9"],
+        )
+        self.assertEqual(self.transcript.read_tail(0), [])
+
+    def test_archive_is_read_and_restored(self):
+        messages = [Message(f"Message {idx}", idx % 2 == 0) for idx in range(10)]
+        self.transcript.append_many(messages)
+
+        for codec in ("gzip", "lzma"):
+            with self.subTest(codec=codec):
+                size_before, size_after = self.transcript.archive(codec)
+                self.assertLess(size_after, size_before)
+                self.assertEqual(
+                    set(os.listdir(self.temp_dir)),
+                    {
+                        self.transcript.archive_paths[codec].name,
+                        LockManager.lock_path(self.transcript.path).name,
+                    },
+                )
+                self.assertTrue(self.transcript.is_archived())
+                self.assertIsNone(self.transcript.archive(codec))
+
+                self.assertEqual(self.transcript.count(), len(messages))
+                self.assertEqual(self.transcript.read(4, 6), messages[4:6])
+                self.assertEqual(self.transcript.read_tail(2), messages[-2:])
+                self.assertEqual(list(self.transcript.iter_messages()), messages)
+                self.assertEqual(self.transcript.read_from(0)[0], messages)
+
+                message = Message(f"Back with {codec}", True)
+                self.transcript.append(message)
+                messages.append(message)
+                self.assertFalse(self.transcript.is_archived())
+                self.assertFalse(self.transcript.archive_paths[codec].exists())
+                self.assertEqual(self.transcript.read_all(), messages)
+
+    def test_delete_removes_archive(self):
+        self.transcript.append(Message("Hello", True))
+        self.transcript.archive()
+        self.transcript.delete()
+
+        self.assertFalse(self.transcript.exists())
+        self.assertEqual(
+            os.listdir(self.temp_dir), [LockManager.lock_path(self.transcript.path).name]
+        )
+
+    def test_prepend(self):
+        self.transcript.append_many([Message("Hello", True), Message("Hi!", False)])
+        self.transcript.prepend_many([Message("Earlier", True)])
+        self.transcript.append(Message("Bye", True))
+
+        self.assertEqual(
+            self.transcript.read_all(),
+            [
+                Message("Earlier", True),
+                Message("Hello", True),
+                Message("Hi!", False),
+                Message("Bye", True),
+            ],
+        )
+        self.assertEqual(
+            self.transcript.read_tail(2), [Message("Hi!", False), Message("Bye", True)]
+        )
+        self.assertEqual(self.transcript.read_since(3), [Message("Bye", True)])
+
+    def test_read_since(self):
+        messages = [Message(f"Message {idx}", idx % 2 == 0) for idx in range(5)]
+        self.transcript.append_many(messages)
+
+        self.assertEqual(self.transcript.read_since(0), messages)
+        self.assertEqual(self.transcript.read_since(3), messages[3:])
+        self.assertEqual(self.transcript.read_since(5), [])
+        self.assertEqual(self.transcript.read_since(7), [])
+
+        # An index missing the last records is rebuilt rather than trusted.
+        with open(self.transcript.index_path, "r+b") as index_file:
+            index_file.truncate(3 * 8)
+        self.assertEqual(self.transcript.read_since(3), messages[3:])
+
+    def test_missing_index_is_rebuilt(self):
+        self.transcript.append_many([Message("Hello", True), Message("Hi!", False)])
+        self.transcript.index_path.unlink()
+
+        self.assertEqual(self.transcript.read_tail(1), [Message("Hi!", False)])
+        self.assertTrue(self.transcript.index_path.exists())
+
+    def test_torn_record_is_ignored_and_repaired(self):
+        self.transcript.append(Message("Hello", True))
+        with open(self.path, "ab") as outfile:
+            outfile.write(b"#!A 100 0.0\n### Agent\nPartial")
+
+        self.assertEqual(self.transcript.read_all(), [Message("Hello", True)])
+        self.transcript.append(Message("Again", True))
+        self.assertEqual(
+            self.transcript.read_all(), [Message("Hello", True), Message("Again", True)]
+        )
+
+    def test_legacy_tail(self):
+        self.path.write_text(
+            "### User\nHello\n### Agent\n### Day 1\nLouvre\n### User\nThanks\n"
+        )
+
+        self.assertEqual(
+            self.transcript.read_tail(2),
+            [Message("Louvre\n", False), Message("Thanks\n", True)],
+        )
+        self.assertEqual(self.transcript.read_tail(10), self.transcript.read_all())
+
+    def test_legacy_transcript(self):
+        self.path.write_text("### User\nHello\n### Agent\nHi there!\n")
+
+        self.assertTrue(self.transcript.is_legacy())
+        self.assertEqual(self.transcript.read_tail(1), [Message("Hi there!\n", False)])
+
+        self.transcript.append(Message("Bye", True))
+        self.assertFalse(self.transcript.is_legacy())
+        self.assertEqual(
+            self.transcript.read_all(),
+            [Message("Hello\n", True), Message("Hi there!\n", False), Message("Bye", True)],
+        )
+
+
+class MessageTests(TestCase):
+    def test_slotted(self):
+        self.assertFalse(hasattr(Message("Hello", True), "__dict__"))
+
+    def test_markdown_rendered_lazily(self):
+        message = Message("**Rome**", False)
+        with patch("chat.utility.message.render_markdown", return_value="<b>Rome</b>") as render:
+            self.assertEqual(message.markdown, "<b>Rome</b>")
+            self.assertEqual(message.markdown, "<b>Rome</b>")
+        render.assert_called_once_with("**Rome**")
+
+    def test_rendered_html_not_compared(self):
+        self.assertEqual(Message("Hi", False, "<p>Hi</p>"), Message("Hi", False))
+
+
+class MessageStreamingTests(TestCase):
+    def test_iter_messages_is_lazy(self):
+        def lines():
+            yield "### User\n"
+            yield "Hello\n"
+            yield "### Agent\n"
+            raise AssertionError("Read past the first message.")
+
+        self.assertEqual(next(Message.iter_messages(lines())), Message("Hello\n", True))
+
+    def test_iter_messages_bytes(self):
+        messages = list(Message.iter_messages([b"### User\n", "Caf\u00e9\n".encode("utf-8")]))
+        self.assertEqual(messages, [Message("Caf\u00e9\n", True)])
+
+    def test_matches_deserialize(self):
+        lines = ["ignored\n", "### User\n", "a\n", "b\n", "### Agent\n", "### User\n", "c"]
+        self.assertEqual(
+            list(Message.iter_messages(lines)), Message.deserialize_messages(lines)
+        )
+        self.assertEqual(
+            Message.deserialize_messages(lines), [Message("a\nb\n", True), Message("c", True)]
+        )
+
+    def test_transcript_iter_messages(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            transcript = TranscriptFile(Path(temp_dir) / "conversation.txt")
+            transcript.append_many([Message("Hello", True), Message("Hi!", False)])
+            self.assertEqual(list(transcript.iter_messages()), transcript.read_all())
+
+            transcript.path.write_text("### User\nHello\n")
+            self.assertEqual(list(transcript.iter_messages()), [Message("Hello\n", True)])
+
+
+class TranscriptCacheTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.transcript = TranscriptFile(Path(self.temp_dir) / "conversation.txt")
+        self.transcript.append_many([Message("Hello", True), Message("Hi!", False)])
+        self.cache = TranscriptCache(max_bytes=1024 * 1024, max_entry_bytes=1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_hit_after_miss(self):
+        self.assertEqual(len(self.cache.read(1, self.transcript)), 2)
+        self.assertEqual(self.cache.read_tail(1, self.transcript, 1), [Message("Hi!", False)])
+
+        self.assertEqual(self.cache.stats.misses, 1)
+        self.assertEqual(self.cache.stats.hits, 1)
+        self.assertEqual(self.cache.stats.hit_rate, 0.5)
+
+    def test_archived_transcript(self):
+        self.cache.read(1, self.transcript)
+        self.transcript.archive()
+
+        self.assertEqual(len(self.cache.read(1, self.transcript)), 2)
+        self.transcript.append(Message("Bye", True))
+        self.assertEqual(self.cache.read_tail(1, self.transcript, 1), [Message("Bye", True)])
+
+    def test_append_parses_only_new_records(self):
+        self.cache.read(1, self.transcript)
+        self.transcript.append(Message("Bye", True))
+
+        with patch.object(TranscriptFile, "is_legacy", side_effect=AssertionError):
+            messages = self.cache.read(1, self.transcript)
+        self.assertEqual(messages[-1], Message("Bye", True))
+        self.assertEqual(self.cache.count(1, self.transcript), 3)
+        self.assertEqual(self.cache.stats.partial_hits, 1)
+
+    def test_rewritten_file_is_reparsed(self):
+        self.cache.read(1, self.transcript)
+        self.transcript.delete()
+        self.transcript.append(Message("Fresh start", True))
+
+        self.assertEqual(self.cache.read(1, self.transcript), [Message("Fresh start", True)])
+
+    def test_callers_cannot_modify_entry(self):
+        self.cache.read(1, self.transcript).clear()
+        self.assertEqual(len(self.cache.read(1, self.transcript)), 2)
+
+    def test_lru_eviction(self):
+        other = TranscriptFile(Path(self.temp_dir) / "other.txt")
+        other.append(Message("Other", True))
+        cache = TranscriptCache(
+            max_bytes=self.transcript.path.stat().st_size + 10, max_entry_bytes=1024
+        )
+
+        cache.read(1, self.transcript)
+        cache.read(2, other)
+
+        self.assertEqual(cache.stats.evictions, 1)
+
+        cache.read(1, self.transcript)
+        self.assertEqual(cache.stats.evictions, 2)
+        self.assertEqual(cache.stats.misses, 3)
+
+    def test_large_transcript_bypasses_cache(self):
+        cache = TranscriptCache(max_bytes=1024, max_entry_bytes=10)
+        self.assertEqual(cache.read_tail(1, self.transcript, 1), [Message("Hi!", False)])
+        self.assertEqual(cache.stats.bypasses, 1)
+        self.assertEqual(cache.num_bytes, 0)
+
+
+class GroupCommitterTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_concurrent_writes_are_batched(self):
+        committed: list[set[int]] = []
+        committer = GroupCommitter(delay=0.05, on_commit=committed.append)
+        results: list[bool] = []
+
+        def write(idx: int):
+            path = Path(self.temp_dir) / f"conversation_{idx % 2}.txt"
+            results.append(committer.write(idx % 2, path, Message(f"Message {idx}", True)))
+
+        threads = [threading.Thread(target=write, args=(idx,)) for idx in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [True] * 8)
+        self.assertEqual(committer.num_writes, 8)
+        self.assertLess(committer.num_commits, 8)
+        self.assertEqual(len(committed), committer.num_commits)
+        self.assertEqual(set().union(*committed), {0, 1})
+        for conv_id in (0, 1):
+            transcript = TranscriptFile(Path(self.temp_dir) / f"conversation_{conv_id}.txt")
+            self.assertEqual(
+                sorted(message.message for message in transcript.read_all()),
+                sorted(f"Message {idx}" for idx in range(conv_id, 8, 2)),
+            )
+
+    def test_failed_write(self):
+        committed: list[set[int]] = []
+        committer = GroupCommitter(on_commit=committed.append)
+        with self.assertLogs("chat.utility.group_commit", level="ERROR") as logs:
+            self.assertFalse(committer.write(1, Path(self.temp_dir), Message("Hello", True)))
+        self.assertEqual(committed, [])
+        self.assertIn(f"Failed to append 1 messages to {Path(self.temp_dir)!r}", logs.output[0])
+
+    def test_failed_commit_callback(self):
+        path = Path(self.temp_dir) / "conversation.txt"
+        committer = GroupCommitter(on_commit=lambda conv_ids: 1 / 0)
+        with self.assertLogs("chat.utility.group_commit", level="ERROR") as logs:
+            self.assertFalse(committer.write(1, path, Message("Hello", True)))
+        self.assertIn("Commit callback failed for conversations [1]", logs.output[0])
+
+    def test_fsync_policy(self):
+        path = Path(self.temp_dir) / "conversation.txt"
+        committer = GroupCommitter(fsync_policy="always")
+        with patch("os.fsync") as fsync:
+            self.assertTrue(committer.write(1, path, Message("Hello", True)))
+        fsync.assert_called_once()
+        with self.assertRaises(ValueError):
+            GroupCommitter(fsync_policy="sometimes")
+
+
+class RWLockTests(TestCase):
+    def test_readers_share_and_writer_excludes(self):
+        lock = RWLock()
+        lock.acquire_read()
+        lock.acquire_read()
+
+        acquired = threading.Event()
+
+        def write():
+            lock.acquire_write()
+            acquired.set()
+            lock.release_write()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.assertFalse(acquired.wait(0.05))
+        lock.release_read()
+        self.assertFalse(acquired.wait(0.05))
+        lock.release_read()
+        self.assertTrue(acquired.wait(1))
+        writer.join()
+
+
+class LockManagerTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = Path(self.temp_dir) / "conversation.txt"
+        self.locks = LockManager()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _try_flock(self, operation: int) -> bool:
+        # A separate open file description contends like another process would.
+        with open(LockManager.lock_path(self.path), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return True
+
+    def test_file_locks(self):
+        with self.locks.read(self.path):
+            self.assertTrue(self._try_flock(fcntl.LOCK_SH))
+            self.assertFalse(self._try_flock(fcntl.LOCK_EX))
+        with self.locks.write(self.path):
+            self.assertFalse(self._try_flock(fcntl.LOCK_SH))
+        self.assertTrue(self._try_flock(fcntl.LOCK_EX))
+
+    def test_unlinked_lock_file_is_not_locked(self):
+        # Another process holds the lock, then unlinks the lock file while holding it.
+        lock_path = LockManager.lock_path(self.path)
+        other = open(lock_path, "a")
+        fcntl.flock(other, fcntl.LOCK_EX)
+        acquired, release = threading.Event(), threading.Event()
+
+        def write():
+            with self.locks.write(self.path):
+                acquired.set()
+                release.wait(5)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.assertFalse(acquired.wait(0.05))
+        lock_path.unlink()
+        fcntl.flock(other, fcntl.LOCK_UN)
+        other.close()
+
+        self.assertTrue(acquired.wait(1))
+        # The writer holds the lock file now at the path, not the unlinked one.
+        self.assertFalse(self._try_flock(fcntl.LOCK_EX))
+        release.set()
+        writer.join()
+        self.assertTrue(self._try_flock(fcntl.LOCK_EX))
+
+    def test_unused_locks_are_dropped(self):
+        with self.locks.read(self.path), self.locks.read(self.path):
+            self.assertEqual(len(self.locks), 1)
+        self.assertEqual(len(self.locks), 0)
+
+    def test_concurrent_appends_and_reads(self):
+        transcript = TranscriptFile(self.path)
+        errors: list[Exception] = []
+
+        def append(writer_idx: int):
+            for idx in range(20):
+                transcript.append(Message(f"Writer {writer_idx} message {idx}", True))
+
+        def read():
+            try:
+                for _ in range(20):
+                    for message in transcript.read_all():
+                        self.assertTrue(message.message.startswith("Writer "))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=append, args=(idx,)) for idx in range(4)]
+        threads += [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(transcript.count(), 80)
+
+
+class HandlePoolTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = Path(self.temp_dir) / "conversation.txt"
+        self.pool = HandlePool(max_handles=2)
+
+    def tearDown(self):
+        self.pool.close_all()
+        shutil.rmtree(self.temp_dir)
+
+    def test_handles_are_reused(self):
+        with self.pool.handle(self.path) as fd:
+            self.assertIsNone(fd)
+        with self.pool.handle(self.path, create=True) as fd:
+            os.write(fd, b"Hello")
+        with self.pool.handle(self.path) as fd:
+            self.assertEqual(os.pread(fd, 5, 0), b"Hello")
+
+        self.assertEqual((self.pool.stats.opens, self.pool.stats.hits), (1, 1))
+
+    def test_eviction_waits_for_users(self):
+        paths = [Path(self.temp_dir) / f"conversation_{idx}.txt" for idx in range(3)]
+        with self.pool.handle(paths[0], create=True) as fd:
+            for path in paths[1:]:
+                with self.pool.handle(path, create=True):
+                    pass
+            self.assertEqual(len(self.pool), 2)
+            self.assertEqual(self.pool.stats.evictions, 1)
+            # The evicted handle stays open until it is released.
+            os.write(fd, b"Still open")
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_replaced_file_is_reopened(self):
+        with self.pool.handle(self.path, create=True) as fd:
+            os.write(fd, b"Old")
+        # Replaced behind the pool's back, e.g. by another process.
+        self.path.unlink()
+        self.path.write_bytes(b"New")
+
+        with self.pool.handle(self.path) as fd:
+            self.assertEqual(os.pread(fd, 3, 0), b"New")
+        self.assertEqual(self.pool.stats.stale, 1)
+
+    def test_invalidate_and_fork(self):
+        with self.pool.handle(self.path, create=True):
+            pass
+        self.pool.invalidate(self.path)
+        self.assertEqual(len(self.pool), 0)
+
+        with self.pool.handle(self.path):
+            pass
+        self.pool._after_fork()
+        self.assertEqual(len(self.pool), 0)
+
+
+class StorageBackendTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        self.conversation = ConversationModel.objects.create(
+            title="Test Chat",
+            user=user,
+            file_name="storage_backend.txt",
+            time_of_last_message=timezone.now(),
+        )
+        self.backends = {
+            "file": FileSystemStorage(TranscriptCache(1024 * 1024, 1024 * 1024)),
+            "database": DatabaseStorage(),
+            "sqlite_blob": SQLiteBlobStorage(Path(self.temp_dir) / "messages.sqlite3"),
+            "memory": MemoryStorage(),
+        }
+
+    def tearDown(self):
+        for convo in ConversationModel.objects.all():
+            remove_transcript(convo.transcript)
+        shutil.rmtree(self.temp_dir)
+
+    def test_backends_agree(self):
+        messages = [Message(f"Message {idx}", idx % 2 == 0) for idx in range(6)]
+        for name, storage in self.backends.items():
+            with self.subTest(backend=name):
+                storage.append(self.conversation, messages[0])
+                storage.append_many(self.conversation, messages[1:], fsync=True)
+
+                self.assertEqual(storage.read_all(self.conversation), messages)
+                self.assertEqual(list(storage.iter_messages(self.conversation)), messages)
+                self.assertEqual(storage.read(self.conversation, 2, 4), messages[2:4])
+                self.assertEqual(storage.read(self.conversation, -2), messages[-2:])
+                self.assertEqual(storage.read_tail(self.conversation, 2), messages[-2:])
+                self.assertEqual(storage.read_tail(self.conversation, 0), [])
+                self.assertEqual(storage.read_since(self.conversation, 4), messages[4:])
+                self.assertEqual(storage.read_since(self.conversation, 6), [])
+                self.assertEqual(storage.count(self.conversation), 6)
+
+                storage.prepend_many(self.conversation, [Message("First", True)])
+                self.assertEqual(
+                    storage.read_all(self.conversation), [Message("First", True)] + messages
+                )
+                storage.append(self.conversation, Message("Last", False))
+                self.assertEqual(storage.read_tail(self.conversation, 1), [Message("Last", False)])
+                self.assertEqual(storage.count(self.conversation), 8)
+                self.assertGreater(storage.size(self.conversation), 0)
+
+                storage.delete(self.conversation)
+                self.assertEqual(storage.read_all(self.conversation), [])
+                self.assertEqual(storage.count(self.conversation), 0)
+
+    def test_backends_delete_many(self):
+        convos = [self.conversation] + [
+            ConversationModel.objects.create(
+                title=f"Chat {idx}",
+                user=self.conversation.user,
+                file_name=f"storage_backend_{idx}.txt",
+                time_of_last_message=timezone.now(),
+            )
+            for idx in range(3)
+        ]
+        for name, storage in self.backends.items():
+            with self.subTest(backend=name):
+                for convo in convos:
+                    storage.append(convo, Message(f"Hello {convo.id}", True))
+
+                storage.delete_many(convos[:3])
+                for convo in convos[:3]:
+                    self.assertEqual(storage.count(convo), 0)
+                self.assertEqual(
+                    storage.read_all(convos[3]), [Message(f"Hello {convos[3].id}", True)]
+                )
+                storage.delete(convos[3])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_storage("tape")
+
+    @override_settings(CHAT_MESSAGE_STORE="memory")
+    def test_commands_use_configured_backend(self):
+        self.assertTrue(CommandSaveMessage.execute(self.conversation.id, Message("Hello", True)))
+
+        self.assertFalse(self.conversation.abs_path.exists())
+        self.assertEqual(get_storage().read_all(self.conversation), [Message("Hello", True)])
+        response = QueryRetrieveMessages.execute(self.conversation.id)
+        self.assertEqual(response["data"], [Message("Hello", True)])
+        get_storage().delete(self.conversation)
+
+
+@override_settings(CHAT_MESSAGE_STORE="memory")
+class GenerateItinerariesCommandTests(TestCase):
+    def setUp(self):
+        self.user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.prompts = self.temp_dir / "prompts.txt"
+        self.prompts.write_text("Hello there!\n# Skipped\n\n3 days in Rome\n")
+        self.output = self.temp_dir / "itineraries.ndjson"
+
+    def tearDown(self):
+        for convo in ConversationModel.objects.all():
+            get_storage().delete(convo)
+        shutil.rmtree(self.temp_dir)
+
+    def _generate(self) -> MockedOpenAI:
+        client = MockedOpenAI()
+        with patch("chatbot.travel_chatbot.OpenAI", return_value=client), patch.dict(
+            os.environ, {"OPENAI_API_KEY": "test"}
+        ):
+            call_command(
+                "generate_itineraries",
+                self.prompts,
+                "--output",
+                self.output,
+                "--user",
+                "testuser",
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+        return client
+
+    def test_generates_with_full_model(self):
+        client = self._generate()
+
+        # Even a greeting, which would be routed to the fast model, gets web search.
+        self.assertEqual(len(client.requests), 2)
+        for request in client.requests:
+            self.assertEqual(request["model"], "gpt-5.1")
+            self.assertEqual(request["tools"], [{"type": "web_search"}])
+
+        results = [json.loads(line) for line in self.output.read_text().splitlines()]
+        self.assertEqual(
+            sorted((result["prompt"], result["response"]) for result in results),
+            [
+                ("3 days in Rome", "Reply to 3 days in Rome"),
+                ("Hello there!", "Reply to Hello there!"),
+            ],
+        )
+        convo = ConversationModel.objects.get(user=self.user, title="3 days in Rome")
+        self.assertEqual(
+            get_storage().read_all(convo),
+            [Message("3 days in Rome", True), Message("Reply to 3 days in Rome", False)],
+        )
+
+    def test_rerun_skips_completed_prompts(self):
+        self._generate()
+        client = self._generate()
+
+        self.assertEqual(client.requests, [])
+        self.assertEqual(len(self.output.read_text().splitlines()), 2)
+        self.assertEqual(ConversationModel.objects.filter(user=self.user).count(), 2)
+
+    def test_failed_save_is_not_appended_to_older_conversation(self):
+        older = ConversationModel.objects.create(
+            title="3 days in Rome",
+            user=self.user,
+            file_name="older.txt",
+            time_of_last_message=timezone.now(),
+        )
+        with patch.object(CommandCreateConversation, "execute", return_value=False):
+            self._generate()
+
+        self.assertEqual(get_storage().read_all(older), [])
+        self.assertEqual(self.output.read_text(), "")
+
+        # Failed prompts are not checkpointed, so a rerun saves them.
+        client = self._generate()
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(ConversationModel.objects.filter(user=self.user).count(), 3)
+
+
+class ReplayConversationsCommandTests(TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.messages = [
+            Message("Hello!", True),
+            Message("Hi, where would you like to go?", False),
+            Message("Plan a 3 day itinerary for Rome", True),
+            Message("Day 1: the Colosseum.", False),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _replay(self) -> str:
+        stdout = StringIO()
+        call_command("replay_conversations", self.temp_dir, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_replays_sharded_transcripts(self):
+        for conv_id in (1, 2):
+            transcript = TranscriptFile(self.temp_dir / ConversationModel.storage_name(conv_id))
+            transcript.append_many(self.messages)
+
+        output = self._replay()
+        self.assertIn("Replayed 2 transcripts.", output)
+        self.assertIn("Turns: 4 (0 failed)", output)
+
+    def test_skips_sidecars_and_reads_archives(self):
+        live = TranscriptFile(self.temp_dir / ConversationModel.storage_name(1))
+        live.append_many(self.messages)
+        live.index_path.with_name(live.index_path.name + ".1.2.tmp").write_bytes(b"\xff")
+        archived = TranscriptFile(self.temp_dir / ConversationModel.storage_name(2))
+        archived.append_many(self.messages)
+        archived.archive("lzma")
+
+        output = self._replay()
+        self.assertIn("Replayed 2 transcripts.", output)
+        self.assertIn("Turns: 4 (0 failed)", output)
+
+    def test_unreadable_transcript_fails_alone(self):
+        TranscriptFile(self.temp_dir / ConversationModel.storage_name(1)).append_many(
+            self.messages
+        )
+        unreadable = self.temp_dir / ConversationModel.storage_name(2)
+        unreadable.parent.mkdir(parents=True, exist_ok=True)
+        unreadable.write_bytes(b"\xff\xfe not a transcript")
+
+        self.assertIn("Turns: 2 (1 failed)", self._replay())
+
+
+class RelocateTranscriptsCommandTests(TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.media_dir = self.temp_dir / ConversationModel.MEDIA_DIR
+        self.media_dir.mkdir(parents=True)
+        self.user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        self.messages = [Message("Hello", True), Message("Hi!", False)]
+        patcher = patch.object(
+            ConversationModel,
+            "abs_path",
+            new_callable=lambda: property(lambda convo: self.media_dir / convo.file_name),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch(
+            "chat.management.commands.relocate_transcripts.PROJECT_DIR", self.temp_dir
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _legacy_conversation(self, file_name: str) -> ConversationModel:
+        convo = ConversationModel.objects.create(
+            title="Trip",
+            user=self.user,
+            file_name=file_name,
+            time_of_last_message=timezone.now(),
+        )
+        TranscriptFile(self.media_dir / file_name).append_many(self.messages)
+        return convo
+
+    def _relocate(self) -> str:
+        stdout = StringIO()
+        call_command("relocate_transcripts", stdout=stdout)
+        return stdout.getvalue()
+
+    def test_moves_flat_transcripts_into_shards(self):
+        convo = self._legacy_conversation("1_trip.txt")
+
+        self.assertIn("Relocated 1 transcripts", self._relocate())
+
+        convo.refresh_from_db()
+        self.assertEqual(convo.file_name, ConversationModel.storage_name(convo.id))
+        self.assertEqual(convo.transcript.read_all(), self.messages)
+        self.assertFalse((self.media_dir / "1_trip.txt").exists())
+
+    def test_shared_file_is_copied(self):
+        convos = [self._legacy_conversation("shared.txt") for _ in range(2)]
+        TranscriptFile(self.media_dir / "shared.txt").delete()
+        TranscriptFile(self.media_dir / "shared.txt").append_many(self.messages)
+
+        self.assertIn("2 of them copied out of shared files", self._relocate())
+
+        for convo in convos:
+            convo.refresh_from_db()
+            self.assertEqual(convo.transcript.read_all(), self.messages)
+        convos[0].transcript.append(Message("Only here", True))
+        self.assertEqual(convos[1].transcript.read_all(), self.messages)
+
+    def test_rerun_is_a_no_op(self):
+        convo = self._legacy_conversation("1_trip.txt")
+        self._relocate()
+        convo.refresh_from_db()
+        file_name = convo.file_name
+
+        self.assertIn("Relocated 0 transcripts", self._relocate())
+        convo.refresh_from_db()
+        self.assertEqual(convo.file_name, file_name)
+        self.assertEqual(convo.transcript.read_all(), self.messages)
+
+    def test_dry_run_moves_nothing(self):
+        convo = self._legacy_conversation("1_trip.txt")
+
+        stdout = StringIO()
+        call_command("relocate_transcripts", "--dry-run", stdout=stdout)
+        self.assertIn("Would relocate 1 transcripts", stdout.getvalue())
+        convo.refresh_from_db()
+        self.assertEqual(convo.file_name, "1_trip.txt")
+        self.assertEqual(convo.transcript.read_all(), self.messages)
+
+    def test_paths_share_a_lock_while_linked(self):
+        convo = self._legacy_conversation("1_trip.txt")
+        old_path = self.media_dir / "1_trip.txt"
+        new_path = self.media_dir / ConversationModel.storage_name(convo.id)
+        contended = []
+
+        def check_lock(_):
+            # Runs once the row points at the new path, before the old path is unlinked.
+            old_lock, new_lock = LockManager.lock_path(old_path), LockManager.lock_path(new_path)
+            self.assertEqual(old_lock.stat().st_ino, new_lock.stat().st_ino)
+            with transcript_locks.write(old_path), open(new_lock, "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    contended.append(True)
+
+        with patch(
+            "chat.management.commands.relocate_transcripts.transcript_cache.invalidate",
+            side_effect=check_lock,
+        ):
+            self._relocate()
+        self.assertEqual(contended, [True])
+
+
+class GCTranscriptsCommandTests(TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.media_dir = self.temp_dir / ConversationModel.MEDIA_DIR
+        user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        patcher = patch.object(
+            ConversationModel,
+            "abs_path",
+            new_callable=lambda: property(lambda convo: self.media_dir / convo.file_name),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("chat.management.commands.gc_transcripts.PROJECT_DIR", self.temp_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.live, self.archived = [
+            ConversationModel.objects.create(
+                title=title, user=user, file_name="", time_of_last_message=timezone.now()
+            )
+            for title in ("Live", "Archived")
+        ]
+        for convo in (self.live, self.archived):
+            convo.file_name = ConversationModel.storage_name(convo.id)
+            convo.save()
+            convo.transcript.append(Message(f"Hello {convo.title}", True))
+        self.archived.transcript.archive()
+        # Left behind by an interrupted index rewrite of a live conversation.
+        self.stale_tmp = self.live.abs_path.with_name(self.live.abs_path.name + ".idx.1.2.tmp")
+        self.stale_tmp.write_bytes(b"")
+        self.orphan = TranscriptFile(self.media_dir / "ab" / "cd" / "999.txt")
+        self.orphan.append(Message("Gone", True))
+        self.kept = self._files()
+        self.orphans = {
+            "ab/cd/999.txt",
+            "ab/cd/999.txt.idx",
+            "ab/cd/999.txt.lock",
+            self.stale_tmp.relative_to(self.media_dir).as_posix(),
+        }
+        self.kept -= self.orphans
+        # Only files untouched for a while are collected.
+        old = time.time() - 2 * 60 * 60
+        for path in self.media_dir.rglob("*"):
+            os.utime(path, (old, old))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _files(self, root: Optional[Path] = None) -> set[str]:
+        root = root or self.media_dir
+        return {path.relative_to(root).as_posix() for path in root.rglob("*") if path.is_file()}
+
+    def _gc(self, *args) -> str:
+        stdout = StringIO()
+        call_command("gc_transcripts", *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_dry_run_removes_nothing(self):
+        output = self._gc("--dry-run")
+
+        self.assertIn("would remove 4 orphaned files", output)
+        self.assertEqual(self._files(), self.kept | self.orphans)
+
+    def test_removes_orphans_only(self):
+        self.assertIn("removed 4 orphaned files", self._gc())
+
+        self.assertEqual(self._files(), self.kept)
+        self.assertEqual(self.live.transcript.read_all(), [Message("Hello Live", True)])
+        self.assertTrue(self.archived.transcript.is_archived())
+        self.assertEqual(self.archived.transcript.read_all(), [Message("Hello Archived", True)])
+
+    def test_quarantine(self):
+        quarantine = self.temp_dir / "quarantine"
+        self._gc("--quarantine", quarantine)
+
+        self.assertEqual(self._files(), self.kept)
+        # Lock files are deleted rather than kept.
+        self.assertEqual(
+            self._files(quarantine),
+            self.orphans - {"ab/cd/999.txt.lock"},
+        )
+        self.assertEqual(
+            TranscriptFile(quarantine / "ab" / "cd" / "999.txt").read_all(),
+            [Message("Gone", True)],
+        )
+
+    def test_recent_files_are_kept(self):
+        recent = TranscriptFile(self.media_dir / "ef" / "01" / "1000.txt")
+        recent.append(Message("Just written", True))
+        self._gc()
+
+        self.assertTrue(recent.exists())
+
+
+class ImportTranscriptsCommandTests(TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        user = AccountModel.objects.create(
+            first_name="Test",
+            last_name="User",
+            user_name="testuser",
+            password_hash=make_password("testpass"),
+        )
+        patcher = patch.object(
+            ConversationModel,
+            "abs_path",
+            new_callable=lambda: property(lambda convo: self.temp_dir / convo.file_name),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.messages = [Message(f"Message {idx}", idx % 2 == 0) for idx in range(4)]
+        self.convos = [
+            ConversationModel.objects.create(
+                title=title,
+                user=user,
+                file_name=f"{title}.txt",
+                time_of_last_message=timezone.now(),
+            )
+            for title in ("live", "archived")
+        ]
+        for convo in self.convos:
+            convo.transcript.append_many(self.messages)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_imports_archived_transcripts(self):
+        self.convos[1].transcript.archive()
+
+        stdout = StringIO()
+        call_command("import_transcripts", "--no-render", stdout=stdout)
+
+        self.assertIn(
+            "Imported 8 messages from 2 conversations, skipped 0, 0 did not match",
+            stdout.getvalue(),
+        )
+        for convo in self.convos:
+            with self.subTest(convo=convo.title):
+                rows = MessageModel.objects.filter(conversation=convo).order_by("seq")
+                self.assertEqual([row.to_message() for row in rows], self.messages)
+        # The archive is read in place.
+        self.assertTrue(self.convos[1].transcript.is_archived())
+
+    def test_rerun_imports_messages_appended_since(self):
+        call_command("import_transcripts", "--no-render", stdout=StringIO())
+        new_messages = [Message("Message 4", True), Message("Message 5", False)]
+        self.convos[0].transcript.append_many(new_messages)
+
+        stdout = StringIO()
+        call_command("import_transcripts", "--no-render", stdout=stdout)
+
+        self.assertIn("Imported 2 messages from 1 conversations, skipped 1", stdout.getvalue())
+        rows = MessageModel.objects.filter(conversation=self.convos[0]).order_by("seq")
+        self.assertEqual([row.to_message() for row in rows], self.messages + new_messages)
+
+    def test_reports_transcripts_shorter_than_imported(self):
+        call_command("import_transcripts", "--no-render", stdout=StringIO())
+        self.convos[0].transcript.delete()
+        self.convos[0].transcript.append_many(self.messages[:2])
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command("import_transcripts", "--no-render", stdout=stdout, stderr=stderr)
+
+        self.assertIn("skipped 1, 1 did not match their transcript.", stdout.getvalue())
+        self.assertIn(
+            f"Conversation {self.convos[0].id} has 4 messages imported but only 2",
+            stderr.getvalue(),
+        )
+        self.assertEqual(MessageModel.objects.filter(conversation=self.convos[0]).count(), 4)
+
+
+@override_settings(CHAT_MESSAGE_STORE="memory")
+class ExportImportConversationsCommandTests(TestCase):
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.traveller, self.other = [
+            AccountModel.objects.create(
+                first_name="Test",
+                last_name="User",
+                user_name=user_name,
+                password_hash=make_password("testpass"),
+            )
+            for user_name in ("traveller", "other")
+        ]
+        self.messages = [Message(f"Message {idx}", idx % 2 == 0) for idx in range(6)]
+        self.trip = self._conversation(self.traveller, "Trip", self.messages)
+        self.fork_id = CommandForkConversation.execute(self.traveller.id, self.trip.id, 3)
+        get_storage().append(ConversationModel.objects.get(id=self.fork_id), Message("Own", True))
+        self._conversation(self.other, "Other", [Message("Elsewhere", True)])
+
+    def tearDown(self):
+        for convo in ConversationModel.objects.all():
+            get_storage().delete(convo)
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def _conversation(user, title: str, messages: list[Message]) -> ConversationModel:
+        convo = ConversationModel.objects.create(
+            title=title, user=user, file_name="", time_of_last_message=timezone.now()
+        )
+        convo.file_name = ConversationModel.storage_name(convo.id)
+        convo.save()
+        get_storage().append_many(convo, messages)
+        return convo
+
+    def _export(self, path: Path, *args):
+        call_command("export_conversations", path, *args, stderr=StringIO())
+
+    def _import(self, path: Path) -> str:
+        stdout = StringIO()
+        call_command("import_conversations", path, "--batch-size", "2", stdout=stdout)
+        return stdout.getvalue()
+
+    def test_round_trip_keeps_forks_and_users(self):
+        path = self.temp_dir / "conversations.ndjson.gz"
+        self._export(path, "--user", "traveller")
+        password_hash = self.traveller.password_hash
+        with self.captureOnCommitCallbacks(execute=True):
+            self.traveller.delete()
+
+        output = self._import(path)
+
+        self.assertIn("Imported 1 users, 2 conversations and 7 messages.", output)
+        traveller = AccountModel.objects.get(user_name="traveller")
+        self.assertEqual(traveller.password_hash, password_hash)
+        trip = ConversationModel.objects.get(user=traveller, parent__isnull=True)
+        fork = ConversationModel.objects.get(user=traveller, parent=trip)
+        self.assertEqual(fork.fork_point, 3)
+        self.assertEqual(ConversationHistory(trip).read(), self.messages)
+        self.assertEqual(get_storage().read_all(fork), [Message("Own", True)])
+        self.assertEqual(
+            ConversationHistory(fork).read(), self.messages[:3] + [Message("Own", True)]
+        )
+
+    def test_user_filter(self):
+        path = self.temp_dir / "conversations.ndjson"
+        self._export(path, "--user", "other")
+
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+        self.assertEqual(
+            [(record["type"], record.get("user_name", record.get("title"))) for record in records],
+            [("user", "other"), ("conversation", "Other"), ("message", None)],
+        )
+        self.assertEqual(records[2]["message"], "Elsewhere")
+
+    def test_import_matches_existing_users(self):
+        path = self.temp_dir / "conversations.ndjson"
+        self._export(path)
+
+        self.assertIn("Imported 2 users, 3 conversations and 8 messages.", self._import(path))
+        self.assertEqual(AccountModel.objects.count(), 2)
+        self.assertEqual(ConversationModel.objects.filter(user=self.other).count(), 2)
+
+    def test_malformed_line(self):
+        path = self.temp_dir / "conversations.ndjson"
+        self._export(path, "--user", "other")
+        with open(path, "a") as outfile:
+            outfile.write('{"type": "message", "conversation_id"\n')
+
+        with self.assertRaisesRegex(CommandError, "Line 4 is not valid JSON"):
+            self._import(path)
+
+    def test_invalid_record(self):
+        path = self.temp_dir / "conversations.ndjson"
+        path.write_text('{"type": "itinerary"}\n')
+
+        with self.assertRaisesRegex(CommandError, "Line 1 is not a valid record"):
+            self._import(path)
@@ -15,6 +15,16 @@ urlpatterns = [
         views.handle_delete_chat,
         name="operation__delete_chat",
     ),
+    path(
+        "operation/delete_chats",
+        views.handle_delete_chats,
+        name="operation__delete_chats",
+    ),
+    path(
+        "operation/fork_chat/<int:conv_id>/<int:num_messages>",
+        views.handle_fork_chat,
+        name="operation__fork_chat",
+    ),
     path("operation/new_chat", views.handle_new_chat, name="operation__new_chat"),
     path(
         "operation/go_to_select",
@@ -26,6 +36,11 @@ urlpatterns = [
         views.handle_new_user_message,
         name="operation__new_user_message",
     ),
+    path(
+        "operation/sync_messages",
+        views.handle_sync_messages,
+        name="operation__sync_messages",
+    ),
     path(
         "operation/download_pdf",
         views.handle_download_pdf,
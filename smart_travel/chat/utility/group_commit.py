@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Hashable, Optional
+
+from chat.utility.message import Message
+from chat.utility.transcript import TranscriptFile
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICY__NEVER = "never"
+FSYNC_POLICY__ALWAYS = "always"
+
+
+def _append_to_transcript(path: Path, messages: list[Message], fsync: bool):
+    TranscriptFile(path).append_many(messages, fsync=fsync)
+
+
+@dataclass
+class _PendingWrite(object):
+    conv_id: int
+    target: Hashable
+    message: Message
+    done: bool = False
+    ok: bool = False
+
+
+class GroupCommitter(object):
+    """
+    Batches concurrent transcript appends into group commits.
+
+    Note:
+        Writers queue their message and wait. The first writer to find no commit in progress
+        becomes the leader: it optionally waits a short delay for others to join, then
+        appends everything queued, grouped per conversation, with a single append (and fsync,
+        depending on the policy) per conversation. The commit callback is then called once with
+        every conversation touched, e.g. to bump them all in a single UPDATE. Writers queued
+        while a commit is running are taken by the next leader, so batches grow with load
+        without adding latency to a lone writer.
+    """
+
+    def __init__(
+        self,
+        max_batch: int = 256,
+        delay: float = 0.0,
+        fsync_policy: str = FSYNC_POLICY__NEVER,
+        on_commit: Optional[Callable[[set[int]], None]] = None,
+        append: Optional[Callable[[Any, list[Message], bool], None]] = None,
+    ):
+        """
+        Args:
+            append (Optional[Callable[[Any, list[Message], bool], None]], optional): Appends
+                messages, given the target they were written to and whether to fsync.
+                Defaults to None, treating targets as transcript paths.
+        """
+
+        if fsync_policy not in (FSYNC_POLICY__NEVER, FSYNC_POLICY__ALWAYS):
+            raise ValueError(f"Unknown fsync policy {fsync_policy!r}.")
+        self.max_batch = max_batch
+        self.delay = delay
+        self.fsync_policy = fsync_policy
+        self.on_commit = on_commit
+        self.append = _append_to_transcript if append is None else append
+        self.num_commits = 0
+        self.num_writes = 0
+        self._pending: list[_PendingWrite] = []
+        self._leader_active = False
+        self._cond = threading.Condition()
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.num_writes / self.num_commits if self.num_commits else 0.0
+
+    def write(self, conv_id: int, target: Hashable, message: Message) -> bool:
+        """
+        Append the message to the conversation, returning once it is written.
+
+        Args:
+            conv_id (int): Conversation the message belongs to.
+            target (Hashable): Where the message is appended to, e.g. the path of the
+                conversation's transcript.
+            message (Message): Message to be appended.
+
+        Returns:
+            bool: True if the message was written.
+        """
+
+        pending = _PendingWrite(conv_id, target, message)
+        with self._cond:
+            self._pending.append(pending)
+            while not pending.done and self._leader_active:
+                self._cond.wait()
+            if pending.done:
+                return pending.ok
+            self._leader_active = True
+
+        try:
+            if self.delay > 0:
+                time.sleep(self.delay)
+            while not pending.done:
+                with self._cond:
+                    batch = self._pending[:self.max_batch]
+                    del self._pending[:self.max_batch]
+                self._commit(batch)
+                with self._cond:
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._leader_active = False
+                self._cond.notify_all()
+        return pending.ok
+
+    def _commit(self, batch: list[_PendingWrite]):
+        by_target: dict[Hashable, list[_PendingWrite]] = {}
+        for pending in batch:
+            by_target.setdefault(pending.target, []).append(pending)
+
+        written: list[_PendingWrite] = []
+        for target, writes in by_target.items():
+            try:
+                self.append(
+                    target,
+                    [pending.message for pending in writes],
+                    self.fsync_policy == FSYNC_POLICY__ALWAYS,
+                )
+                written.extend(writes)
+            except Exception:
+                logger.exception("Failed to append %d messages to %r", len(writes), target)
+
+        ok = True
+        if self.on_commit is not None and len(written):
+            conv_ids = {pending.conv_id for pending in written}
+            try:
+                self.on_commit(conv_ids)
+            except Exception:
+                logger.exception("Commit callback failed for conversations %s", sorted(conv_ids))
+                ok = False
+
+        for pending in written:
+            pending.ok = ok
+        for pending in batch:
+            pending.done = True
+        self.num_commits += 1
+        self.num_writes += len(batch)
@@ -0,0 +1,148 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+HANDLE_POOL_PARAMS__MAX_HANDLES = 256
+
+
+@dataclass
+class HandlePoolStats(object):
+    hits: int = 0
+    opens: int = 0
+    evictions: int = 0
+    stale: int = 0
+
+
+class _Handle(object):
+    __slots__ = ("fd", "users", "retired")
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.users = 0
+        self.retired = False
+
+
+class HandlePool(object):
+    """
+    Bounded LRU pool of open file descriptors, keyed by path.
+
+    Note:
+        Files are opened read-write in append mode, so one descriptor serves both appends
+        (`os.write` always lands at the end) and positional reads (`os.pread`) from any number
+        of threads. A handle whose file was unlinked or replaced, e.g. by another process, is
+        detected by its link count dropping to zero and reopened. Handles evicted or
+        invalidated while in use are closed once their last user releases them. After a fork
+        the child drops the handles it inherited.
+    """
+
+    def __init__(self, max_handles: int = HANDLE_POOL_PARAMS__MAX_HANDLES):
+        self.max_handles = max_handles
+        self.stats = HandlePoolStats()
+        self._handles: OrderedDict[str, _Handle] = OrderedDict()
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    @contextmanager
+    def handle(self, path: Union[str, Path], create: bool = False) -> Iterator[Optional[int]]:
+        """
+        Borrow the open descriptor of a file.
+
+        Args:
+            path (Union[str, Path]): File to be opened.
+            create (bool, optional): Create the file if it does not exist. Defaults to False.
+
+        Yields:
+            Optional[int]: Descriptor, or None if the file does not exist and was not created.
+                It must not be closed or used once the context exits.
+        """
+
+        key = os.fspath(path)
+        handle = self._checkout(key)
+        if handle is None:
+            try:
+                fd = os.open(key, os.O_RDWR | os.O_APPEND | (os.O_CREAT if create else 0), 0o644)
+            except FileNotFoundError:
+                yield None
+                return
+            handle = self._add(key, fd)
+        try:
+            yield handle.fd
+        finally:
+            self._checkin(handle)
+
+    def invalidate(self, path: Union[str, Path]):
+        """
+        Drop the pooled descriptor of a file, e.g. after deleting or replacing it.
+        """
+
+        with self._lock:
+            handle = self._handles.pop(os.fspath(path), None)
+            if handle is not None:
+                self._retire(handle)
+
+    def close_all(self):
+        with self._lock:
+            while len(self._handles):
+                self._retire(self._handles.popitem()[1])
+
+    def _checkout(self, key: str) -> Optional[_Handle]:
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is None:
+                return None
+            if os.fstat(handle.fd).st_nlink == 0:
+                del self._handles[key]
+                self._retire(handle)
+                self.stats.stale += 1
+                return None
+            self._handles.move_to_end(key)
+            handle.users += 1
+            self.stats.hits += 1
+            return handle
+
+    def _add(self, key: str, fd: int) -> _Handle:
+        handle = _Handle(fd)
+        handle.users = 1
+        with self._lock:
+            self.stats.opens += 1
+            # Another thread may have opened the same file meanwhile, its handle is replaced.
+            previous = self._handles.pop(key, None)
+            if previous is not None:
+                self._retire(previous)
+            self._handles[key] = handle
+            while len(self._handles) > self.max_handles:
+                self._retire(self._handles.popitem(last=False)[1])
+                self.stats.evictions += 1
+        return handle
+
+    def _checkin(self, handle: _Handle):
+        with self._lock:
+            handle.users -= 1
+            if handle.retired and not handle.users:
+                os.close(handle.fd)
+
+    def _retire(self, handle: _Handle):
+        # Called with the lock held.
+        handle.retired = True
+        if not handle.users:
+            os.close(handle.fd)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        for handle in self._handles.values():
+            try:
+                os.close(handle.fd)
+            except OSError:
+                pass
+        self._handles = OrderedDict()
+
+
+handle_pool = HandlePool()
@@ -0,0 +1,209 @@
+import os
+import threading
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+from chat.utility.handle_pool import handle_pool
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover, e.g. on Windows
+    fcntl = None  # type: ignore
+
+LOCK_FILE_SUFFIX = ".lock"
+
+
+class RWLock(object):
+    """
+    Reader-writer lock for threads of one process.
+
+    Note:
+        Any number of readers may hold the lock at once, a writer holds it alone. Waiting
+        writers take precedence over new readers so a steady stream of reads cannot starve
+        writes. The lock is not reentrant.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+
+    def release_write(self):
+        with self._cond:
+            self._writing = False
+            self._cond.notify_all()
+
+
+class _LockEntry(object):
+    __slots__ = ("rw_lock", "users", "file_lock", "file_holders", "file_fd", "file_handle")
+
+    def __init__(self):
+        self.rw_lock = RWLock()
+        self.users = 0
+        self.file_lock = threading.Lock()
+        self.file_holders = 0
+        self.file_fd: Optional[int] = None
+        self.file_handle: Optional[ExitStack] = None
+
+
+class LockManager(object):
+    """
+    Shared and exclusive locks keyed by file, across threads and processes.
+
+    Note:
+        Each file gets an in-process `RWLock`, dropped again once nobody holds or waits for it,
+        so locks of different files never contend. The process as a whole then holds a `flock`
+        advisory lock on a sidecar lock file, shared while any of its threads read and
+        exclusive while one writes, which coordinates with other processes such as further
+        server workers or management commands. Lock files are kept open in the handle pool.
+        Without `fcntl` only threads are coordinated.
+
+        A lock file must only be unlinked while holding its exclusive lock. A waiter that then
+        acquires the unlinked file notices and locks the file now at the path instead.
+    """
+
+    def __init__(self):
+        self._locks: dict[Path, _LockEntry] = {}
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @contextmanager
+    def read(self, path: Path) -> Iterator[None]:
+        """
+        Hold a shared lock on the file, e.g. while reading it.
+
+        Args:
+            path (Path): File to be locked. Its directory must exist.
+        """
+
+        entry = self._checkout(path)
+        entry.rw_lock.acquire_read()
+        try:
+            # Threads share the process' lock on the file, the first takes it and the last
+            # releases it.
+            with entry.file_lock:
+                if not entry.file_holders:
+                    self._lock_file(entry, path, exclusive=False)
+                entry.file_holders += 1
+            try:
+                yield
+            finally:
+                with entry.file_lock:
+                    entry.file_holders -= 1
+                    if not entry.file_holders:
+                        self._unlock_file(entry)
+        finally:
+            entry.rw_lock.release_read()
+            self._checkin(path)
+
+    @contextmanager
+    def write(self, path: Path) -> Iterator[None]:
+        """
+        Hold an exclusive lock on the file, e.g. while appending to or rewriting it.
+
+        Args:
+            path (Path): File to be locked. Its directory must exist.
+        """
+
+        entry = self._checkout(path)
+        entry.rw_lock.acquire_write()
+        try:
+            self._lock_file(entry, path, exclusive=True)
+            try:
+                yield
+            finally:
+                self._unlock_file(entry)
+        finally:
+            entry.rw_lock.release_write()
+            self._checkin(path)
+
+    @staticmethod
+    def lock_path(path: Path) -> Path:
+        return path.with_name(path.name + LOCK_FILE_SUFFIX)
+
+    @staticmethod
+    def _lock_file(entry: _LockEntry, path: Path, exclusive: bool):
+        if fcntl is None:
+            return
+        lock_path = os.fspath(path) + LOCK_FILE_SUFFIX
+        while True:
+            file_handle = ExitStack()
+            fd = file_handle.enter_context(handle_pool.handle(lock_path, create=True))
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                if LockManager._is_linked(fd, lock_path):
+                    break
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            except BaseException:
+                file_handle.close()
+                raise
+            file_handle.close()
+            handle_pool.invalidate(lock_path)
+        entry.file_fd, entry.file_handle = fd, file_handle
+
+    @staticmethod
+    def _is_linked(fd: int, path: str) -> bool:
+        # Whether the locked file is still the one at the path.
+        try:
+            linked = os.stat(path)
+        except FileNotFoundError:
+            return False
+        locked = os.fstat(fd)
+        return (linked.st_dev, linked.st_ino) == (locked.st_dev, locked.st_ino)
+
+    @staticmethod
+    def _unlock_file(entry: _LockEntry):
+        if entry.file_handle is None:
+            return
+        fcntl.flock(entry.file_fd, fcntl.LOCK_UN)
+        entry.file_handle.close()
+        entry.file_fd = entry.file_handle = None
+
+    def _checkout(self, path: Path) -> _LockEntry:
+        with self._lock:
+            entry = self._locks.get(path)
+            if entry is None:
+                entry = self._locks[path] = _LockEntry()
+            entry.users += 1
+            return entry
+
+    def _checkin(self, path: Path):
+        with self._lock:
+            entry = self._locks[path]
+            entry.users -= 1
+            if not entry.users:
+                del self._locks[path]
+
+    def _after_fork(self):
+        # Locks held by threads of the parent are not held in the child.
+        self._lock = threading.Lock()
+        self._locks = {}
+
+
+transcript_locks = LockManager()
@@ -1,12 +1,72 @@
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional, Union
 
+import markdown as md  # type: ignore
 
-@dataclass
+
+def render_markdown(text: str) -> str:
+    """
+    Render a message's markdown to HTML for display.
+
+    Args:
+        text (str): Markdown to be rendered.
+
+    Returns:
+        str: Rendered HTML.
+    """
+
+    return md.Markdown(extensions=["fenced_code"]).convert(text)
+
+
+def _parse_source_label(line: str) -> Optional[bool]:
+    """
+    A source label is a line above a message's contents indicating who is the source or
+    of the message: user or agent.
+
+    A source label must follow the following format:
+    ### <User|Agent>
+
+    Args:
+        line (str): potential source label to be parsed.
+
+    Returns:
+        Optional[bool]: If the line is not a source label, return None. Otherwise,
+        return a boolean indicating if the source is the user, if not then it's the
+        agent.
+    """
+
+    if not line.startswith("### "):
+        return None
+    parts = line.split("### ")
+    if len(parts) != 2 or len(parts[1]) == 0:
+        return None
+    return parts[1].strip().lower() == "user"
+
+
+@dataclass(slots=True)
 class Message(object):
+    """
+    A single message of a conversation.
+
+    Note:
+        Messages are slotted to keep large in-memory histories compact. The rendered HTML is
+        produced on first access instead of being stored alongside every message, and is not
+        part of equality.
+    """
+
     message: str
     is_user: bool
-    markdown: Optional[str] = None
+    _markdown: Optional[str] = field(default=None, compare=False, repr=False)
+
+    @property
+    def markdown(self) -> str:
+        if self._markdown is None:
+            self._markdown = render_markdown(self.message)
+        return self._markdown
+
+    @markdown.setter
+    def markdown(self, html: Optional[str]):
+        self._markdown = html
 
     def serialize(self) -> str:
         """
@@ -30,47 +90,43 @@ class Message(object):
             list[Message]: All parsed messages from the text file.
         """
 
-        def parse_source_label(line: str) -> Optional[bool]:
-            """
-            A source label is a line above a message's contents indicating who is the source or
-            of the message: user or agent.
+        return list(cls.iter_messages(raw_contents))
 
-            A source label must follow the following format:
-            ### <User|Agent>
+    @classmethod
+    def iter_messages(cls, lines: Iterable[Union[str, bytes]]) -> Iterator["Message"]:
+        """
+        Lazily deserialize messages from a stream of lines, e.g. an open file.
 
-            Args:
-                line (str): potential source label to be parsed.
+        Note:
+            Each message is yielded as soon as the next source label is read, so only one
+            message is held in memory at a time. Its lines are collected and joined once
+            instead of being concatenated one by one.
 
-            Returns:
-                Optional[bool]: If the line is not a source label, return None. Otherwise,
-                return a boolean indicating if the source is the user, if not then it's the
-                agent.
-            """
+        Args:
+            lines (Iterable[Union[str, bytes]]): Lines of text to be parsed, bytes are decoded
+                as UTF-8.
 
-            if not line.startswith("### "):
-                return None
-            parts = line.split("### ")
-            if len(parts) != 2 or len(parts[1]) == 0:
-                return None
-            return parts[1].strip().lower() == "user"
+        Yields:
+            Message: Parsed messages in order.
+        """
 
-        line_iter = iter(raw_contents)
-        messages = []
         is_user = False
-        message = ""
+        parts: list[str] = []
         source_label_encountered = False
 
-        while (line := next(line_iter, None)) is not None:
-            if (next_is_user := parse_source_label(line)) is not None:
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            if (next_is_user := _parse_source_label(line)) is not None:
+                message = "".join(parts)
                 if len(message) and source_label_encountered:
-                    messages.append(Message(message, is_user))
+                    yield cls(message, is_user)
                 is_user = next_is_user
-                message = ""
+                parts = []
                 source_label_encountered = True
             else:
-                message += line
+                parts.append(line)
         # loop terminates before the adding the final message.
+        message = "".join(parts)
         if len(message) and source_label_encountered:
-            messages.append(cls(message, is_user))
-
-        return messages
+            yield cls(message, is_user)
@@ -0,0 +1,166 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import date
+from typing import Optional
+
+from accounts.models import AccountModel
+from chat.models import DailyTokenUsageModel
+from django.db import close_old_connections  # type: ignore
+from django.db.models import F  # type: ignore
+from django.utils import timezone  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    def __init__(self, capacity: float, refill_rate: float):
+        """
+        Args:
+            capacity (float): Maximum number of requests allowed in a burst.
+            refill_rate (float): Requests regained per second.
+        """
+
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+
+    def take(self, amount: float = 1.0) -> bool:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._last_refill) * self.refill_rate
+        )
+        self._last_refill = now
+        if self._tokens < amount:
+            return False
+        self._tokens -= amount
+        return True
+
+
+class RateLimiter(object):
+    """
+    Token-bucket rate limiter keyed by account ID.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self._capacity = capacity
+        self._refill_rate = refill_rate
+        self._buckets: dict[int, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, user_id: int) -> bool:
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(
+                    self._capacity, self._refill_rate
+                )
+            return bucket.take()
+
+
+class TokenQuotaTracker(object):
+    """
+    Daily per-account token quotas tracked in memory.
+
+    Note:
+        Usage is loaded from the database the first time an account is seen on a given day,
+        charges accumulate in memory and are flushed to the database at most once every
+        flush interval. Each process only sees the charges of the others once they are
+        flushed and it reloads the account's usage, so the quota is approximate across
+        processes.
+    """
+
+    def __init__(self, daily_quota: int, flush_interval: float):
+        self.daily_quota = daily_quota
+        self.flush_interval = flush_interval
+        self._used: dict[tuple[int, date], int] = {}
+        self._unflushed: dict[tuple[int, date], int] = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """
+        Flush charges every flush interval from a background thread, and on exit.
+        """
+
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def used(self, user_id: int) -> int:
+        key = (user_id, timezone.localdate())
+        with self._lock:
+            return self._used_locked(key)
+
+    def remaining(self, user_id: int) -> int:
+        return max(0, self.daily_quota - self.used(user_id))
+
+    def charge(self, user_id: int, tokens: int):
+        key = (user_id, timezone.localdate())
+        with self._lock:
+            self._used[key] = self._used_locked(key) + tokens
+            self._unflushed[key] = self._unflushed.get(key, 0) + tokens
+            should_flush = time.monotonic() - self._last_flush >= self.flush_interval
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all unflushed charges to the database.
+        """
+
+        with self._lock:
+            unflushed, self._unflushed = self._unflushed, {}
+            self._last_flush = time.monotonic()
+            today = timezone.localdate()
+            self._used = {key: used for key, used in self._used.items() if key[1] == today}
+        if not unflushed:
+            return
+
+        # Accounts deleted since being charged have nothing left to record against.
+        existing_users = set(
+            AccountModel.objects.filter(
+                id__in={user_id for user_id, _ in unflushed}
+            ).values_list("id", flat=True)
+        )
+        for (user_id, day), tokens in unflushed.items():
+            if user_id not in existing_users:
+                continue
+            updated = DailyTokenUsageModel.objects.filter(user_id=user_id, day=day).update(
+                tokens=F("tokens") + tokens
+            )
+            if not updated:
+                DailyTokenUsageModel.objects.create(user_id=user_id, day=day, tokens=tokens)
+
+        # Accounts without charges since are reloaded, picking up what other processes flushed.
+        with self._lock:
+            self._used = {
+                key: used for key, used in self._used.items() if key in self._unflushed
+            }
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush token usage")
+            finally:
+                close_old_connections()
+
+    def _used_locked(self, key: tuple[int, date]) -> int:
+        if key not in self._used:
+            self._used[key] = self._load(key)
+        return self._used[key]
+
+    def _load(self, key: tuple[int, date]) -> int:
+        user_id, day = key
+        usage: Optional[DailyTokenUsageModel] = DailyTokenUsageModel.objects.filter(
+            user_id=user_id, day=day
+        ).first()
+        return usage.tokens if usage is not None else 0
@@ -0,0 +1,265 @@
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+
+from chat.utility.message import Message
+
+RETRIEVAL_PARAMS__MAX_DOCUMENTS = 20_000
+RETRIEVAL_PARAMS__MIN_SNIPPET_CHARS = 80
+RETRIEVAL_PARAMS__MIN_DUPLICATE_TERMS = 4
+
+_MARKDOWN_LINK = re.compile(r"\[([^\]]+)\]\([^)]*\)")
+_TOKEN = re.compile(r"[a-z0-9]+")
+_STOP_WORDS = frozenset(
+    "a an and are as at be but by can do for from has have how i if in is it its me my "
+    "of on or our so that the their there this to was we what when where which who will "
+    "with would you your about like want should could".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split text into lowercase terms, dropping stop words and the URLs of markdown links.
+
+    Args:
+        text (str): Text to be tokenized.
+
+    Returns:
+        list[str]: Terms of the text in order.
+    """
+
+    text = _MARKDOWN_LINK.sub(r"\1", text).lower()
+    return [term for term in _TOKEN.findall(text) if term not in _STOP_WORDS]
+
+
+@dataclass
+class SearchResult(object):
+    score: float
+    text: str
+    payload: Any
+
+
+class TfidfIndex(object):
+    """
+    Incrementally built TF-IDF index with cosine similarity search.
+
+    Note:
+        Documents are stored as flat (document, term, count) arrays. IDF weights and document
+        norms are recomputed with vectorized NumPy operations on the first search after new
+        documents have been added. When the index grows past its maximum size, the oldest half
+        of the documents is dropped.
+    """
+
+    def __init__(self, max_documents: int = RETRIEVAL_PARAMS__MAX_DOCUMENTS):
+        self.max_documents = max_documents
+        self._lock = threading.Lock()
+        self._clear()
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def add(self, text: str, payload: Any = None, owner: int = -1) -> bool:
+        """
+        Add a document to the index.
+
+        Args:
+            text (str): Text of the document.
+            payload (Any, optional): Returned alongside the document when matched.
+            owner (int, optional): Owner of the document searches can be restricted to.
+
+        Returns:
+            bool: True if the document had any indexable terms.
+        """
+
+        terms, counts = np.unique(tokenize(text), return_counts=True)
+        if not len(terms):
+            return False
+
+        with self._lock:
+            if len(self._texts) >= self.max_documents:
+                self._compact()
+            term_ids = np.fromiter(
+                (self._vocab.setdefault(term, len(self._vocab)) for term in terms),
+                dtype=np.int32,
+                count=len(terms),
+            )
+            doc_id = len(self._texts)
+            self._texts.append(text)
+            self._payloads.append(payload)
+            self._owners.append(owner)
+            self._pending.append((doc_id, term_ids, counts.astype(np.float32)))
+            self._stale = True
+        return True
+
+    def search(
+        self, text: str, k: int = 3, min_score: float = 0.0, owner: Optional[int] = None
+    ) -> list[SearchResult]:
+        """
+        Find the documents most similar to the text.
+
+        Args:
+            text (str): Query text.
+            k (int, optional): Maximum number of results. Defaults to 3.
+            min_score (float, optional): Minimum cosine similarity of results. Defaults to 0.
+            owner (Optional[int], optional): Restrict results to documents of this owner.
+
+        Returns:
+            list[SearchResult]: Matches ordered from most to least similar.
+        """
+
+        with self._lock:
+            query_ids, query_counts = np.unique(
+                np.array(
+                    [self._vocab[term] for term in tokenize(text) if term in self._vocab],
+                    dtype=np.int32,
+                ),
+                return_counts=True,
+            )
+            if not len(query_ids) or not len(self._texts):
+                return []
+            self._refresh()
+
+            query_weights = query_counts * self._idf[query_ids]
+            query_norm = np.linalg.norm(query_weights)
+
+            mask = np.isin(self._term_ids, query_ids)
+            if not mask.any():
+                return []
+            contributions = self._weights[mask] * query_weights[
+                np.searchsorted(query_ids, self._term_ids[mask])
+            ]
+            scores = np.bincount(
+                self._doc_ids[mask], contributions, minlength=len(self._texts)
+            )
+            scores /= np.maximum(self._norms, 1e-12) * query_norm
+            if owner is not None:
+                scores[self._owner_ids != owner] = 0.0
+
+            candidates = np.flatnonzero(scores >= max(min_score, 1e-12))
+            top = candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+            return [
+                SearchResult(float(scores[idx]), self._texts[idx], self._payloads[idx])
+                for idx in top
+            ]
+
+    def _refresh(self):
+        if len(self._pending):
+            doc_ids, term_ids, counts = zip(*self._pending)
+            self._doc_ids = np.concatenate(
+                [self._doc_ids]
+                + [np.full(len(ids), doc_id, np.int32) for doc_id, ids in zip(doc_ids, term_ids)]
+            )
+            self._term_ids = np.concatenate([self._term_ids, *term_ids])
+            self._counts = np.concatenate([self._counts, *counts])
+            self._pending = []
+        if not self._stale:
+            return
+
+        doc_freq = np.bincount(self._term_ids, minlength=len(self._vocab))
+        self._idf = (np.log((1 + len(self._texts)) / (1 + doc_freq)) + 1).astype(np.float32)
+        self._weights = self._counts * self._idf[self._term_ids]
+        self._norms = np.sqrt(
+            np.bincount(self._doc_ids, self._weights**2, minlength=len(self._texts))
+        )
+        self._owner_ids = np.asarray(self._owners, dtype=np.int64)
+        self._stale = False
+
+    def _compact(self):
+        self._refresh()
+        keep_from = len(self._texts) // 2
+        texts, payloads, owners = self._texts, self._payloads, self._owners
+        mask = self._doc_ids >= keep_from
+        doc_ids, term_ids, counts = self._doc_ids[mask], self._term_ids[mask], self._counts[mask]
+        vocab = self._vocab
+
+        self._clear()
+        self._vocab = vocab
+        self._texts = texts[keep_from:]
+        self._payloads = payloads[keep_from:]
+        self._owners = owners[keep_from:]
+        self._doc_ids = doc_ids - keep_from
+        self._term_ids = term_ids
+        self._counts = counts
+        self._stale = True
+
+    def _clear(self):
+        self._vocab: dict[str, int] = {}
+        self._texts: list[str] = []
+        self._payloads: list[Any] = []
+        self._owners: list[int] = []
+        self._pending: list[tuple[int, np.ndarray, np.ndarray]] = []
+        self._doc_ids = np.zeros(0, np.int32)
+        self._term_ids = np.zeros(0, np.int32)
+        self._counts = np.zeros(0, np.float32)
+        self._idf = np.zeros(0, np.float32)
+        self._weights = np.zeros(0, np.float32)
+        self._norms = np.zeros(0, np.float32)
+        self._owner_ids = np.zeros(0, np.int64)
+        self._stale = False
+
+
+class ExchangeIndex(object):
+    """
+    Index over past question and agent reply exchanges.
+
+    Note:
+        User questions are indexed to detect near-duplicate questions whose earlier reply can be
+        served again. Paragraphs of agent replies are indexed separately so relevant excerpts can
+        be given to the chatbot as compact context.
+    """
+
+    def __init__(self, max_documents: int = RETRIEVAL_PARAMS__MAX_DOCUMENTS):
+        self.questions = TfidfIndex(max_documents)
+        self.snippets = TfidfIndex(max_documents)
+        self._last_question: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, conv_id: int, user_id: int, message: Message):
+        """
+        Feed a message saved to a conversation into the index.
+
+        Args:
+            conv_id (int): Conversation the message was saved to.
+            user_id (int): Owner of the conversation.
+            message (Message): Saved message.
+        """
+
+        with self._lock:
+            if message.is_user:
+                self._last_question[conv_id] = message.message
+                return
+            question = self._last_question.pop(conv_id, None)
+
+        if question is not None:
+            self.questions.add(question, payload=message.message, owner=user_id)
+        for paragraph in message.message.split("\n\n"):
+            paragraph = paragraph.strip()
+            if len(paragraph) >= RETRIEVAL_PARAMS__MIN_SNIPPET_CHARS:
+                self.snippets.add(paragraph, owner=user_id)
+
+    def find_duplicate(self, user_id: int, question: str, min_score: float) -> Optional[str]:
+        """
+        Find the reply to an earlier question that is a near-duplicate of this one.
+
+        Returns:
+            Optional[str]: Earlier reply, or None if no question is similar enough.
+        """
+
+        if len(set(tokenize(question))) < RETRIEVAL_PARAMS__MIN_DUPLICATE_TERMS:
+            return None
+        matches = self.questions.search(question, k=1, min_score=min_score, owner=user_id)
+        return matches[0].payload if len(matches) else None
+
+    def context_snippets(
+        self, user_id: int, question: str, k: int, min_score: float
+    ) -> list[str]:
+        return [
+            match.text
+            for match in self.snippets.search(question, k=k, min_score=min_score, owner=user_id)
+        ]
+
+
+exchange_index = ExchangeIndex()
@@ -0,0 +1,170 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Callable, Hashable
+
+from django.db import close_old_connections  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """
+    Priority classes of agent work. Lower values are always served first.
+    """
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+@dataclass(order=True)
+class _Job(object):
+    priority: int
+    finish_tag: float
+    seq: int
+    user_id: Hashable = field(compare=False)
+    target: Callable[..., Any] = field(compare=False)
+    args: tuple = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    future: Future = field(compare=False)
+
+
+@dataclass
+class UserWaitStats(object):
+    count: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.count if self.count else 0.0
+
+
+class AgentScheduler(object):
+    """
+    Weighted-fair, priority-aware scheduler for agent calls.
+
+    Note:
+        Within a priority class jobs are ordered by self-clocked fair queueing: each user's job
+        is stamped with a virtual finish tag of max(virtual time, user's last finish tag) plus
+        1 / weight, and the job with the smallest tag is served next. A user firing many
+        messages therefore only pushes back their own later messages instead of everyone's.
+    """
+
+    def __init__(self, num_workers: int = 4):
+        self._cond = threading.Condition()
+        self._heap: list[_Job] = []
+        self._seq = itertools.count()
+        self._virtual_time: dict[int, float] = {priority: 0.0 for priority in Priority}
+        self._last_finish: dict[tuple[int, Hashable], float] = {}
+        self._pending: dict[tuple[int, Hashable], int] = {}
+        self._wait_stats: dict[Hashable, UserWaitStats] = {}
+        self._workers = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(
+        self,
+        user_id: Hashable,
+        target: Callable[..., Any],
+        *args,
+        priority: Priority = Priority.INTERACTIVE,
+        weight: float = 1.0,
+    ) -> Future:
+        """
+        Queue a call to `target(*args)` on behalf of a user.
+
+        Args:
+            user_id (Hashable): User the work is done for.
+            target (Callable[..., Any]): Function to call.
+            priority (Priority, optional): Priority class. Defaults to INTERACTIVE.
+            weight (float, optional): User's share relative to other users. Defaults to 1.0.
+
+        Returns:
+            Future: Result of the call, or the exception it raised.
+        """
+
+        future: Future = Future()
+        with self._cond:
+            key = (priority, user_id)
+            start_tag = max(self._virtual_time[priority], self._last_finish.get(key, 0.0))
+            finish_tag = start_tag + 1.0 / weight
+            self._last_finish[key] = finish_tag
+            self._pending[key] = self._pending.get(key, 0) + 1
+            heapq.heappush(
+                self._heap,
+                _Job(
+                    priority=priority,
+                    finish_tag=finish_tag,
+                    seq=next(self._seq),
+                    user_id=user_id,
+                    target=target,
+                    args=args,
+                    enqueued_at=time.perf_counter(),
+                    future=future,
+                ),
+            )
+            self._cond.notify()
+        return future
+
+    def queued(self, user_id: Hashable) -> int:
+        with self._cond:
+            return sum(
+                self._pending.get((priority, user_id), 0) for priority in Priority
+            )
+
+    def wait_times(self) -> dict[Hashable, UserWaitStats]:
+        """
+        Time each user's jobs spent queued before a worker picked them up.
+
+        Returns:
+            dict[Hashable, UserWaitStats]: Snapshot of wait statistics keyed by user.
+        """
+
+        with self._cond:
+            return {
+                user_id: UserWaitStats(stats.count, stats.total_wait, stats.max_wait)
+                for user_id, stats in self._wait_stats.items()
+            }
+
+    def _next_job(self) -> _Job:
+        with self._cond:
+            while not len(self._heap):
+                self._cond.wait()
+            job = heapq.heappop(self._heap)
+            self._virtual_time[job.priority] = job.finish_tag
+            key = (job.priority, job.user_id)
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                # Idle users restart from the virtual clock, forget their tag.
+                del self._pending[key]
+                del self._last_finish[key]
+
+            wait = time.perf_counter() - job.enqueued_at
+            stats = self._wait_stats.setdefault(job.user_id, UserWaitStats())
+            stats.count += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            return job
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = job.target(*job.args)
+            except Exception as error:
+                logger.exception("Agent job of user %r failed", job.user_id)
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+            finally:
+                close_old_connections()
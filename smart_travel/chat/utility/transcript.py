@@ -0,0 +1,685 @@
+import gzip
+import io
+import lzma
+import mmap
+import os
+import threading
+import time
+from array import array
+from contextlib import nullcontext
+from pathlib import Path
+from types import ModuleType
+from typing import ContextManager, Iterator, Optional
+
+from chat.utility.handle_pool import handle_pool
+from chat.utility.locks import transcript_locks
+from chat.utility.message import Message
+
+TRANSCRIPT_MAGIC = b"#!smart-travel-transcript v1\n"
+TRANSCRIPT_INDEX_SUFFIX = ".idx"
+# Codecs of archived transcripts, by name: file suffix and module.
+TRANSCRIPT_ARCHIVE_CODECS: dict[str, tuple[str, ModuleType]] = {
+    "gzip": (".gz", gzip),
+    "lzma": (".xz", lzma),
+}
+_RECORD_PREFIX = b"#!"
+_ROLE_USER = b"U"
+_ROLE_AGENT = b"A"
+# Headers are well below this, e.g. `#!A 1234 1760000000.000`.
+_HEADER_READ_SIZE = 64
+_MAX_READ_SIZE = 1 << 30
+
+
+def _encode_record(message: Message, timestamp: Optional[float] = None) -> bytes:
+    """
+    Encode a message as a framed record.
+
+    Note:
+        A record is a header line `#!<U|A> <payload length> <unix timestamp>` followed by the
+        payload, which is the message serialized as usual. The length makes the record
+        unambiguous even when the message itself contains source labels, while the payload
+        keeps the transcript readable as plain text.
+    """
+
+    payload = message.serialize().encode("utf-8")
+    header = b"%s%s %d %.3f\n" % (
+        _RECORD_PREFIX,
+        _ROLE_USER if message.is_user else _ROLE_AGENT,
+        len(payload),
+        time.time() if timestamp is None else timestamp,
+    )
+    return header + payload
+
+
+def _parse_header(line: bytes) -> Optional[tuple[bool, int]]:
+    if not line.startswith(_RECORD_PREFIX) or not line.endswith(b"\n"):
+        return None
+    parts = line.removeprefix(_RECORD_PREFIX).split()
+    if len(parts) != 3 or parts[0] not in (_ROLE_USER, _ROLE_AGENT) or not parts[1].isdigit():
+        return None
+    return parts[0] == _ROLE_USER, int(parts[1])
+
+
+def _read_header(fd: int, offset: int) -> Optional[tuple[int, int]]:
+    """
+    Read the header of the record at an offset.
+
+    Returns:
+        Optional[tuple[int, int]]: Length of the header line and of the payload, or None if
+            there is no complete header at the offset.
+    """
+
+    chunk = os.pread(fd, _HEADER_READ_SIZE, offset)
+    header_end = chunk.find(b"\n") + 1
+    header = _parse_header(chunk[:header_end]) if header_end else None
+    return None if header is None else (header_end, header[1])
+
+
+def _pread(fd: int, length: int, offset: int) -> bytes:
+    chunks = []
+    while length > 0:
+        chunk = os.pread(fd, min(length, _MAX_READ_SIZE), offset)
+        if not len(chunk):
+            break
+        chunks.append(chunk)
+        length -= len(chunk)
+        offset += len(chunk)
+    return b"".join(chunks)
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while len(view):
+        view = view[os.write(fd, view):]
+
+
+def _decode_records(buffer: bytes) -> tuple[list[Message], int]:
+    """
+    Decode consecutive records.
+
+    Returns:
+        tuple[list[Message], int]: Decoded messages, and the number of bytes they spanned.
+    """
+
+    messages = []
+    pos = 0
+    while pos < len(buffer):
+        header_end = buffer.find(b"\n", pos) + 1
+        header = _parse_header(buffer[pos:header_end]) if header_end else None
+        # A partially written trailing record is not part of the transcript yet.
+        if header is None or header_end + header[1] > len(buffer):
+            break
+        is_user, length = header
+        pos = header_end + length
+        # Strip the source label line and the newline serialize appends.
+        body_start = buffer.index(b"\n", header_end) + 1
+        messages.append(Message(buffer[body_start:pos - 1].decode("utf-8"), is_user))
+    return messages, pos
+
+
+class TranscriptFile(object):
+    """
+    Conversation transcript made of length-prefixed records with a sidecar offset index.
+
+    Note:
+        The index file next to the transcript holds the byte offset of every record as
+        unsigned 64-bit integers, so message N or the last K messages are read with a single
+        seek. A missing or stale index, e.g. after a crash between the two writes, is rebuilt
+        by hopping from header to header. Transcripts written before the framed format are
+        read with the line parser and upgraded in place the next time a message is appended.
+
+        Appends and rewrites hold an exclusive lock on the transcript and reads a shared one,
+        see `LockManager`, so concurrent threads and processes never see a torn record or
+        truncate one another's appends. Transcripts and indexes are read and appended through
+        descriptors kept open in the handle pool, so hot conversations skip the open and close.
+
+        Idle transcripts can be archived, i.e. compressed into a single file that replaces the
+        transcript and its index, see `archive`. Archived transcripts are decompressed
+        whole when read and restored the next time a message is appended.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.index_path = path.with_name(path.name + TRANSCRIPT_INDEX_SUFFIX)
+        self.archive_paths = {
+            codec: path.with_name(path.name + suffix)
+            for codec, (suffix, _) in TRANSCRIPT_ARCHIVE_CODECS.items()
+        }
+
+    def exists(self) -> bool:
+        return self.path.exists() or self._archive() is not None
+
+    def stat(self) -> os.stat_result:
+        """
+        Stat the transcript through its pooled handle, without resolving the path. Archived
+        transcripts stat their archive.
+
+        Raises:
+            FileNotFoundError: If the transcript does not exist.
+        """
+
+        with handle_pool.handle(self.path) as fd:
+            if fd is not None:
+                return os.fstat(fd)
+        archive = self._archive()
+        if archive is None:
+            raise FileNotFoundError(self.path)
+        return archive[0].stat()
+
+    def is_archived(self) -> bool:
+        with self._shared():
+            return not self.path.exists() and self._archive() is not None
+
+    def is_legacy(self) -> bool:
+        with self._shared(), handle_pool.handle(self.path) as fd:
+            return fd is not None and self._is_legacy(fd)
+
+    def archive(self, codec: str = "gzip") -> Optional[tuple[int, int]]:
+        """
+        Compress the transcript into an archive replacing it and its index.
+
+        Args:
+            codec (str, optional): One of `TRANSCRIPT_ARCHIVE_CODECS`. Defaults to "gzip".
+
+        Returns:
+            Optional[tuple[int, int]]: Size of the transcript before and after, or None if
+                there is no transcript to archive, e.g. it is archived already.
+        """
+
+        suffix, module = TRANSCRIPT_ARCHIVE_CODECS[codec]
+        if not self.path.parent.exists():
+            return None
+        with transcript_locks.write(self.path):
+            with handle_pool.handle(self.path) as fd:
+                if fd is None:
+                    return None
+                is_legacy = self._is_legacy(fd)
+            # Archives are always framed, so they are read without the line parser.
+            if is_legacy:
+                self._upgrade()
+            with handle_pool.handle(self.path) as fd:
+                data = _pread(fd, os.fstat(fd).st_size, 0)
+
+            archive_path = self.archive_paths[codec]
+            tmp_path = archive_path.with_name(archive_path.name + ".tmp")
+            with open(tmp_path, "wb") as outfile:
+                outfile.write(module.compress(data))
+                # The transcript is removed next, the archive must be on disk first.
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmp_path, archive_path)
+            # The lock file stays, see `delete`.
+            for path in (self.path, self.index_path, *self.archive_paths.values()):
+                if path != archive_path:
+                    path.unlink(missing_ok=True)
+                    handle_pool.invalidate(path)
+        return len(data), archive_path.stat().st_size
+
+    def append(self, message: Message):
+        self.append_many([message])
+
+    def append_many(self, messages: list[Message], fsync: bool = False):
+        """
+        Append messages to the transcript, creating it if needed.
+
+        Args:
+            messages (list[Message]): Messages to be appended in order.
+            fsync (bool, optional): Force the records to stable storage before returning. The
+                index is not synced since it can be rebuilt. Defaults to False.
+        """
+
+        if not len(messages):
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with transcript_locks.write(self.path):
+            self._append_many(messages, fsync)
+
+    def _append_many(self, messages: list[Message], fsync: bool):
+        self._prepare_write()
+
+        # Validates the index and truncates a torn record so appends start on a boundary.
+        self._load_index(repair=True)
+        with handle_pool.handle(self.path, create=True) as fd:
+            position = os.fstat(fd).st_size
+            records = []
+            if position == 0:
+                records.append(TRANSCRIPT_MAGIC)
+                position = len(TRANSCRIPT_MAGIC)
+            new_offsets = array("Q")
+            for message in messages:
+                record = _encode_record(message)
+                new_offsets.append(position)
+                records.append(record)
+                position += len(record)
+            _write_all(fd, b"".join(records))
+            if fsync:
+                os.fsync(fd)
+
+        with handle_pool.handle(self.index_path, create=True) as index_fd:
+            _write_all(index_fd, new_offsets.tobytes())
+
+    def prepend_many(self, messages: list[Message]):
+        """
+        Insert messages before the existing ones, rewriting the transcript.
+
+        Note:
+            The existing records are copied over as they are, keeping their timestamps. The
+            index is removed before the transcript is replaced, so a crash in between leaves an
+            index that is rebuilt rather than one pointing into the wrong records.
+
+        Args:
+            messages (list[Message]): Messages to be inserted in order.
+        """
+
+        if not len(messages):
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with transcript_locks.write(self.path):
+            self._prepare_write()
+            own_offsets = self._load_index(repair=True)
+            with handle_pool.handle(self.path, create=True) as fd:
+                size = os.fstat(fd).st_size
+                own = _pread(fd, max(size - len(TRANSCRIPT_MAGIC), 0), len(TRANSCRIPT_MAGIC))
+
+            records = [TRANSCRIPT_MAGIC]
+            offsets = array("Q")
+            position = len(TRANSCRIPT_MAGIC)
+            for message in messages:
+                record = _encode_record(message)
+                offsets.append(position)
+                records.append(record)
+                position += len(record)
+            shift = position - len(TRANSCRIPT_MAGIC)
+            offsets.extend(offset + shift for offset in own_offsets)
+            records.append(own)
+
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "wb") as outfile:
+                outfile.write(b"".join(records))
+            self.index_path.unlink(missing_ok=True)
+            handle_pool.invalidate(self.index_path)
+            os.replace(tmp_path, self.path)
+            handle_pool.invalidate(self.path)
+            with open(self.index_path, "wb") as index_file:
+                offsets.tofile(index_file)
+
+    def count(self) -> int:
+        with self._shared(), handle_pool.handle(self.path) as fd:
+            if fd is None:
+                return len(self._read_archive())
+            if self._is_legacy(fd):
+                return len(self._read_legacy())
+            return len(self._load_index())
+
+    def read_all(self) -> list[Message]:
+        return self.read(0)
+
+    def read(self, start: int = 0, stop: Optional[int] = None) -> list[Message]:
+        """
+        Read the messages in [start, stop) without scanning the rest of the transcript.
+
+        Args:
+            start (int, optional): Index of the first message. Negative values count from the
+                end. Defaults to 0.
+            stop (Optional[int], optional): Index one past the last message. Defaults to None,
+                reading to the end.
+
+        Returns:
+            list[Message]: Messages in order.
+        """
+
+        with self._shared(), handle_pool.handle(self.path) as fd:
+            if fd is None:
+                return self._read_archive()[start:stop]
+            if self._is_legacy(fd):
+                return self._read_legacy()[start:stop]
+
+            offsets = self._load_index()
+            start, stop, _ = slice(start, stop).indices(len(offsets))
+            if start >= stop:
+                return []
+            end = offsets[stop] if stop < len(offsets) else os.fstat(fd).st_size
+            buffer = _pread(fd, end - offsets[start], offsets[start])
+        return _decode_records(buffer)[0]
+
+    def read_since(self, seq: int) -> list[Message]:
+        """
+        Read the messages from a sequence number onwards, i.e. all but the first `seq`.
+
+        Note:
+            Only the index entries and records from `seq` onwards are read, so polling for new
+            messages costs as much as the new messages, not the whole transcript.
+
+        Args:
+            seq (int): Sequence number, i.e. index, of the first message.
+
+        Returns:
+            list[Message]: Messages in order.
+        """
+
+        seq = max(seq, 0)
+        with self._shared(), handle_pool.handle(self.path) as fd:
+            if fd is None:
+                return self._read_archive()[seq:]
+            if self._is_legacy(fd):
+                return self._read_legacy()[seq:]
+
+            offsets, end = self._offsets_since(fd, seq)
+            if not len(offsets):
+                return []
+            buffer = _pread(fd, end - offsets[0], offsets[0])
+        return _decode_records(buffer)[0]
+
+    def iter_messages(self) -> Iterator[Message]:
+        """
+        Lazily read every message, holding one message in memory at a time.
+
+        Note:
+            A shared lock is held until the iterator is exhausted or closed, so appends to the
+            transcript wait for it.
+
+        Yields:
+            Message: Messages in order.
+        """
+
+        with self._shared():
+            with handle_pool.handle(self.path) as fd:
+                is_archived = fd is None
+                is_legacy = not is_archived and self._is_legacy(fd)
+            if is_archived:
+                yield from self._read_archive()
+                return
+            if is_legacy:
+                with open(self.path, "r") as infile:
+                    yield from Message.iter_messages(infile)
+                return
+
+            with open(self.path, "rb") as infile:
+                infile.seek(len(TRANSCRIPT_MAGIC))
+                while header_line := infile.readline():
+                    header = _parse_header(header_line)
+                    if header is None:
+                        return
+                    is_user, length = header
+                    payload = infile.read(length)
+                    if len(payload) < length:
+                        return
+                    body_start = payload.index(b"\n") + 1
+                    yield Message(payload[body_start:-1].decode("utf-8"), is_user)
+
+    def read_tail(self, k: int) -> list[Message]:
+        """
+        Read the last k messages without touching the rest of the transcript.
+
+        Note:
+            Framed transcripts read the last k offsets from the end of the index. Legacy
+            transcripts are memory-mapped and scanned backwards for source labels, so only the
+            tail is decoded and parsed.
+
+        Args:
+            k (int): Number of messages.
+
+        Returns:
+            list[Message]: Up to k of the most recent messages in order.
+        """
+
+        if k <= 0:
+            return []
+        with self._shared(), handle_pool.handle(self.path) as fd:
+            if fd is None:
+                return self._read_archive()[-k:]
+            if self._is_legacy(fd):
+                return self._read_legacy_tail(k)
+
+            offsets, end = self._tail_offsets(fd, k)
+            if not len(offsets):
+                return []
+            buffer = _pread(fd, end - offsets[0], offsets[0])
+        return _decode_records(buffer)[0]
+
+    def read_from(self, offset: int) -> tuple[list[Message], int]:
+        """
+        Read every complete record from a byte offset onwards, e.g. the records appended since
+        the transcript was last read.
+
+        Args:
+            offset (int): Record boundary to start at, 0 for the start of the transcript.
+
+        Returns:
+            tuple[list[Message], int]: Messages, and the offset just past the last of them.
+        """
+
+        offset = max(offset, len(TRANSCRIPT_MAGIC))
+        with self._shared(), handle_pool.handle(self.path) as fd:
+            if fd is None:
+                archive = self._archive()
+                if archive is None:
+                    raise FileNotFoundError(self.path)
+                buffer = self._decompress(*archive)[offset:]
+            else:
+                buffer = _pread(fd, os.fstat(fd).st_size - offset, offset)
+        messages, consumed = _decode_records(buffer)
+        return messages, offset + consumed
+
+    def delete(self):
+        # Conversations without messages never had a transcript, nor need a lock file for one.
+        if not self.exists() and not self.index_path.exists():
+            return
+        # The lock file stays, a process waiting for it would otherwise lock an unlinked file
+        # while the next one creates a new one.
+        with transcript_locks.write(self.path):
+            for path in (self.path, self.index_path, *self.archive_paths.values()):
+                path.unlink(missing_ok=True)
+                handle_pool.invalidate(path)
+
+    def _shared(self) -> ContextManager:
+        # Nothing to lock if the transcript's directory does not exist yet.
+        if not self.path.parent.exists():
+            return nullcontext()
+        return transcript_locks.read(self.path)
+
+    def _archive(self) -> Optional[tuple[Path, str]]:
+        for codec, path in self.archive_paths.items():
+            if path.exists():
+                return path, codec
+        return None
+
+    @staticmethod
+    def _decompress(path: Path, codec: str) -> bytes:
+        return TRANSCRIPT_ARCHIVE_CODECS[codec][1].decompress(path.read_bytes())
+
+    def _read_archive(self) -> list[Message]:
+        archive = self._archive()
+        if archive is None:
+            return []
+        return _decode_records(self._decompress(*archive)[len(TRANSCRIPT_MAGIC):])[0]
+
+    def _prepare_write(self):
+        # Called with the write lock held.
+        with handle_pool.handle(self.path) as fd:
+            is_new = fd is None
+            is_legacy = not is_new and self._is_legacy(fd)
+        # A new message brings an archived conversation back.
+        if is_new:
+            self._restore()
+        elif is_legacy:
+            self._upgrade()
+
+    def _restore(self):
+        archive = self._archive()
+        if archive is None:
+            return
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(self._decompress(*archive))
+        os.replace(tmp_path, self.path)
+        handle_pool.invalidate(self.path)
+        # The index is rebuilt by the append that follows.
+        archive[0].unlink()
+
+    @staticmethod
+    def _is_legacy(fd: int) -> bool:
+        magic = os.pread(fd, len(TRANSCRIPT_MAGIC), 0)
+        return len(magic) > 0 and magic != TRANSCRIPT_MAGIC
+
+    def _read_legacy(self) -> list[Message]:
+        with open(self.path, "r") as infile:
+            return list(Message.iter_messages(infile))
+
+    def _read_legacy_tail(self, k: int) -> list[Message]:
+        with open(self.path, "rb") as infile:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                start = len(mapped)
+                wanted = k
+                while True:
+                    # Step back over the next `wanted` candidate labels. Not every candidate
+                    # starts a message, e.g. empty messages are dropped by the parser, so
+                    # parse what was found and widen the search if it came up short.
+                    for _ in range(wanted):
+                        label = mapped.rfind(b"\n### ", 0, start)
+                        start = label + 1 if label != -1 else 0
+                        if start == 0:
+                            break
+                    lines = io.TextIOWrapper(
+                        io.BytesIO(mapped[start:]), encoding="utf-8"
+                    ).readlines()
+                    messages = Message.deserialize_messages(lines)
+                    if len(messages) >= k or start == 0:
+                        return messages[-k:]
+                    wanted *= 2
+
+    def _tail_offsets(self, fd: int, k: int) -> tuple[array, int]:
+        """
+        Read the offsets of the last k records from the end of the index.
+
+        Returns:
+            tuple[array, int]: Offsets, and the end of the last record.
+        """
+
+        size = os.fstat(fd).st_size
+        with handle_pool.handle(self.index_path) as index_fd:
+            if index_fd is not None:
+                offsets = array("Q")
+                index_size = os.fstat(index_fd).st_size
+                num_tail = min(k, index_size // offsets.itemsize)
+                offsets.frombytes(
+                    _pread(
+                        index_fd,
+                        num_tail * offsets.itemsize,
+                        index_size - num_tail * offsets.itemsize,
+                    )
+                )
+                if self._records_end(fd, offsets) == max(size, len(TRANSCRIPT_MAGIC)):
+                    return offsets, size
+
+        offsets = self._load_index()
+        end = self._records_end(fd, offsets)
+        return offsets[-k:], size if end is None else end
+
+    def _offsets_since(self, fd: int, seq: int) -> tuple[array, int]:
+        """
+        Read the offsets of the records from sequence number `seq` onwards.
+
+        Note:
+            The entry before `seq` is read as well, so the index is validated against the end
+            of the transcript even if there are no new records.
+
+        Returns:
+            tuple[array, int]: Offsets, and the end of the last record.
+        """
+
+        size = os.fstat(fd).st_size
+        first = max(seq - 1, 0)
+        with handle_pool.handle(self.index_path) as index_fd:
+            if index_fd is not None:
+                offsets = array("Q")
+                num_offsets = os.fstat(index_fd).st_size // offsets.itemsize
+                if first <= num_offsets:
+                    offsets.frombytes(
+                        _pread(
+                            index_fd,
+                            (num_offsets - first) * offsets.itemsize,
+                            first * offsets.itemsize,
+                        )
+                    )
+                    if self._records_end(fd, offsets) == max(size, len(TRANSCRIPT_MAGIC)):
+                        return offsets[seq - first:], size
+
+        offsets = self._load_index()
+        end = self._records_end(fd, offsets)
+        return offsets[seq:], size if end is None else end
+
+    def _upgrade(self):
+        messages = self._read_legacy()
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        offsets = array("Q")
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(TRANSCRIPT_MAGIC)
+            for message in messages:
+                offsets.append(outfile.tell())
+                outfile.write(_encode_record(message))
+        with open(self.index_path, "wb") as index_file:
+            offsets.tofile(index_file)
+        os.replace(tmp_path, self.path)
+        handle_pool.invalidate(self.path)
+
+    def _load_index(self, repair: bool = False) -> array:
+        """
+        Load the record offsets, rebuilding the index if it does not match the transcript.
+
+        Args:
+            repair (bool, optional): Also truncate a partially written trailing record, so
+                the next append starts on a record boundary. Defaults to False.
+        """
+
+        offsets = array("Q")
+        with handle_pool.handle(self.path) as fd:
+            if fd is None:
+                self.index_path.unlink(missing_ok=True)
+                handle_pool.invalidate(self.index_path)
+                return offsets
+            with handle_pool.handle(self.index_path) as index_fd:
+                if index_fd is not None:
+                    index_size = os.fstat(index_fd).st_size
+                    offsets.frombytes(
+                        _pread(index_fd, index_size - index_size % offsets.itemsize, 0)
+                    )
+
+            size = os.fstat(fd).st_size
+            if self._records_end(fd, offsets) == max(size, len(TRANSCRIPT_MAGIC)):
+                return offsets
+
+            offsets, end = self._scan(fd, size)
+            # Readers sharing the lock may rebuild the index at the same time, each through its
+            # own temporary file so the index is always replaced whole.
+            tmp_path = self.index_path.with_name(
+                f"{self.index_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            with open(tmp_path, "wb") as index_file:
+                offsets.tofile(index_file)
+            os.replace(tmp_path, self.index_path)
+            handle_pool.invalidate(self.index_path)
+            if repair and end < size:
+                os.ftruncate(fd, end)
+        return offsets
+
+    @staticmethod
+    def _records_end(fd: int, offsets: array) -> Optional[int]:
+        if not len(offsets):
+            return len(TRANSCRIPT_MAGIC)
+        header = _read_header(fd, offsets[-1])
+        if header is None:
+            return None
+        return offsets[-1] + header[0] + header[1]
+
+    @staticmethod
+    def _scan(fd: int, size: int) -> tuple[array, int]:
+        offsets = array("Q")
+        position = len(TRANSCRIPT_MAGIC)
+        while position < size:
+            header = _read_header(fd, position)
+            if header is None or position + header[0] + header[1] > size:
+                break
+            offsets.append(position)
+            position += header[0] + header[1]
+        return offsets, position
@@ -0,0 +1,160 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from chat.utility.message import Message
+from chat.utility.transcript import TranscriptFile
+
+
+@dataclass
+class TranscriptCacheStats(object):
+    hits: int = 0
+    partial_hits: int = 0
+    misses: int = 0
+    bypasses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.partial_hits + self.misses + self.bypasses
+        return (self.hits + self.partial_hits) / lookups if lookups else 0.0
+
+
+@dataclass
+class _Entry(object):
+    path: Path
+    messages: list[Message]
+    inode: int
+    size: int
+    mtime_ns: int
+    end: int
+    is_legacy: bool
+
+
+class TranscriptCache(object):
+    """
+    In-process LRU cache of parsed transcripts keyed by conversation ID.
+
+    Note:
+        Entries are validated against the transcript's inode, size and modification time.
+        When a framed transcript has only grown, just the appended records are parsed and
+        added to the entry. Memory is bounded by the total size of the cached transcripts,
+        and transcripts larger than the per-entry limit are read directly instead of cached.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.stats = TranscriptCacheStats()
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+    def read(
+        self, conv_id: int, transcript: TranscriptFile, start: int = 0, stop: Optional[int] = None
+    ) -> list[Message]:
+        messages = self._get(conv_id, transcript)
+        if messages is None:
+            return transcript.read(start, stop)
+        return messages[start:stop]
+
+    def read_tail(self, conv_id: int, transcript: TranscriptFile, k: int) -> list[Message]:
+        messages = self._get(conv_id, transcript)
+        if messages is None:
+            return transcript.read_tail(k)
+        return messages[-k:] if k > 0 else []
+
+    def read_since(self, conv_id: int, transcript: TranscriptFile, seq: int) -> list[Message]:
+        messages = self._get(conv_id, transcript)
+        if messages is None:
+            return transcript.read_since(seq)
+        return messages[max(seq, 0):]
+
+    def count(self, conv_id: int, transcript: TranscriptFile) -> int:
+        messages = self._get(conv_id, transcript)
+        return transcript.count() if messages is None else len(messages)
+
+    def invalidate(self, conv_id: int):
+        with self._lock:
+            entry = self._entries.pop(conv_id, None)
+            if entry is not None:
+                self._num_bytes -= entry.end
+
+    def _get(self, conv_id: int, transcript: TranscriptFile) -> Optional[list[Message]]:
+        """
+        Look up the parsed transcript, refreshing the entry if the file changed.
+
+        Returns:
+            Optional[list[Message]]: Parsed messages, or None if the transcript is too large
+                to be cached.
+        """
+
+        try:
+            stat = transcript.stat()
+        except FileNotFoundError:
+            self.invalidate(conv_id)
+            return []
+
+        with self._lock:
+            entry = self._entries.get(conv_id)
+            if entry is not None and entry.path != transcript.path:
+                entry = None
+            if (
+                entry is not None
+                and (entry.inode, entry.size, entry.mtime_ns)
+                == (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            ):
+                self._entries.move_to_end(conv_id)
+                self.stats.hits += 1
+                return entry.messages[:]
+            if stat.st_size > self.max_entry_bytes:
+                self.stats.bypasses += 1
+                return None
+
+        if (
+            entry is not None
+            and not entry.is_legacy
+            and entry.inode == stat.st_ino
+            and stat.st_size > entry.size
+        ):
+            appended, end = transcript.read_from(entry.end)
+            messages = entry.messages + appended
+            is_legacy = is_miss = False
+        else:
+            is_legacy = transcript.is_legacy()
+            if is_legacy:
+                messages, end = transcript.read_all(), stat.st_size
+            else:
+                messages, end = transcript.read_from(0)
+            is_miss = True
+
+        new_entry = _Entry(
+            transcript.path,
+            messages,
+            stat.st_ino,
+            stat.st_size,
+            stat.st_mtime_ns,
+            end,
+            is_legacy,
+        )
+        with self._lock:
+            if is_miss:
+                self.stats.misses += 1
+            else:
+                self.stats.partial_hits += 1
+            old_entry = self._entries.pop(conv_id, None)
+            if old_entry is not None:
+                self._num_bytes -= old_entry.end
+            self._entries[conv_id] = new_entry
+            self._num_bytes += new_entry.end
+            while self._num_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= evicted.end
+                self.stats.evictions += 1
+        return messages[:]
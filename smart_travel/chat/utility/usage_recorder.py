@@ -0,0 +1,115 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
+from accounts.models import AccountModel
+from chat.models import CompletionUsageModel, ConversationModel
+from chatbot.usage import CompletionUsage
+from django.db import close_old_connections  # type: ignore
+from django.utils import timezone  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class UsageRecorder(object):
+    """
+    Writes completion usage to the database off the request path.
+
+    Note:
+        Records are queued in memory and written by a background thread in batches, either
+        once a batch fills up or once the flush interval has elapsed.
+    """
+
+    def __init__(self, batch_size: int = 50, flush_interval: float = 1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue[CompletionUsageModel] = queue.Queue()
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def record(
+        self,
+        usage: CompletionUsage,
+        user_id: Optional[int] = None,
+        conv_id: Optional[int] = None,
+    ):
+        self._queue.put(
+            CompletionUsageModel(
+                user_id=user_id,
+                conversation_id=conv_id,
+                model=usage.model[:50],
+                route=usage.route,
+                input_tokens=usage.input_tokens,
+                output_tokens=usage.output_tokens,
+                cached_tokens=usage.cached_tokens,
+                latency_ms=round(usage.latency * 1000),
+                web_search_calls=usage.web_search_calls,
+                created_at=timezone.now(),
+            )
+        )
+
+    def flush(self):
+        """
+        Write everything queued so far from the calling thread.
+        """
+
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._write(batch)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Failed to write %d usage records", len(batch))
+            finally:
+                close_old_connections()
+
+    def _write(self, batch: list[CompletionUsageModel]):
+        if not len(batch):
+            return
+
+        # Usage outlives accounts and conversations deleted while it was queued.
+        existing_users = set(
+            AccountModel.objects.filter(
+                id__in={usage.user_id for usage in batch}
+            ).values_list("id", flat=True)
+        )
+        existing_convos = set(
+            ConversationModel.objects.filter(
+                id__in={usage.conversation_id for usage in batch}
+            ).values_list("id", flat=True)
+        )
+        for usage in batch:
+            if usage.user_id not in existing_users:
+                usage.user_id = None
+            if usage.conversation_id not in existing_convos:
+                usage.conversation_id = None
+
+        with self._write_lock:
+            CompletionUsageModel.objects.bulk_create(batch)
@@ -1,5 +1,4 @@
 import json
-import threading
 import time
 from enum import Enum
 from pathlib import Path
@@ -10,18 +9,36 @@ from accounts.models import AccountModel
 from chat.cqrs.commands import (
     CommandCreateConversation,
     CommandDeleteConversation,
+    CommandDeleteConversations,
+    CommandForkConversation,
     CommandSaveMessage,
 )
-from chat.cqrs.queries import QueryFindConversation, QueryRetrieveMessages
+from chat.cqrs.queries import (
+    QueryCountMessages,
+    QueryFindConversation,
+    QueryRetrieveMessages,
+    QueryRetrieveMessagesSince,
+    QueryRetrieveRecentMessages,
+)
 from chat.forms import MessageForm, NewChatForm
 from chat.models import ConversationModel
 from chat.utility.message import Message
+from chat.utility.rate_limit import RateLimiter, TokenQuotaTracker
+from chat.utility.retrieval import exchange_index
+from chat.utility.scheduler import AgentScheduler, Priority
+from chat.utility.usage_recorder import UsageRecorder
 from chatbot.travel_chatbot import Chatbot
+from chatbot.usage import CompletionUsage
 from chatbot.pdf import PDFCreator
-from django.http.response import StreamingHttpResponse, HttpResponse  # type: ignore
+from django.conf import settings  # type: ignore
+from django.http.response import (  # type: ignore
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import HttpResponseRedirect, redirect, render  # type: ignore
+from django.template.loader import render_to_string  # type: ignore
 from eda.event_dispatcher import EmittedEvent, get_event, publish, subscribe
-import markdown  # type: ignore
 
 PROJECT_DIR = Path(__file__).parent.parent
 DEBUG = False
@@ -30,6 +47,19 @@ chatbot = Chatbot()
 if not DEBUG:
     chatbot.initialize_session()
 
+agent_scheduler = AgentScheduler(num_workers=settings.CHAT_AGENT_WORKERS)
+rate_limiter = RateLimiter(
+    capacity=settings.CHAT_RATE_LIMIT_BURST,
+    refill_rate=settings.CHAT_RATE_LIMIT_PER_SECOND,
+)
+token_quota = TokenQuotaTracker(
+    daily_quota=settings.CHAT_DAILY_TOKEN_QUOTA,
+    flush_interval=settings.CHAT_TOKEN_QUOTA_FLUSH_INTERVAL,
+)
+token_quota.start()
+usage_recorder = UsageRecorder()
+usage_recorder.start()
+
 """
 Auxillary
 """
@@ -52,10 +82,34 @@ def _submit_message_to_agent(request, last_user_message: str, conv_id: int):
         time.sleep(1)  # pragma: no cover
         message = Message("RESPONSE", False)  # pragma: no cover
     else:
-        prev_messages = QueryRetrieveMessages.execute(request.session["conv_id"])[
-            "data"
-        ]
-        response = chatbot.prompt_completion(prev_messages)
+        user_id = request.session.get("user_id")
+
+        def on_usage(usage: CompletionUsage):
+            usage_recorder.record(usage, user_id=user_id, conv_id=conv_id)
+            if user_id is not None:
+                token_quota.charge(user_id, usage.input_tokens + usage.output_tokens)
+
+        response: Optional[str] = None
+        context: list[str] = []
+        if user_id is not None:
+            if settings.CHAT_RETRIEVAL_DUPLICATE_SCORE is not None:
+                response = exchange_index.find_duplicate(
+                    user_id, last_user_message, settings.CHAT_RETRIEVAL_DUPLICATE_SCORE
+                )
+            context = exchange_index.context_snippets(
+                user_id,
+                last_user_message,
+                k=settings.CHAT_RETRIEVAL_CONTEXT_SNIPPETS,
+                min_score=settings.CHAT_RETRIEVAL_MIN_SCORE,
+            )
+
+        if response is None:
+            prev_messages = QueryRetrieveRecentMessages.execute(
+                conv_id, settings.CHAT_AGENT_HISTORY_MESSAGES
+            )["data"]
+            response = chatbot.prompt_completion(
+                prev_messages, on_usage=on_usage, context=context
+            )
         if response is not None:
             message = Message(response, False)
 
@@ -77,11 +131,15 @@ Event Handlers
 class EventHandlerAction(Enum):
     IDLE = 0
     RELOAD = 1
+    # Fetch only the new messages, see `handle_sync_messages`.
+    SYNC = 2
 
     def response(self) -> str:
         if EventHandlerAction.IDLE == self:
             time.sleep(1)
             return ": keepalive\n\n"
+        elif EventHandlerAction.SYNC == self:
+            return f"data: {json.dumps({'action': 'sync'})}\n\n"
         else:
             return f"data: {json.dumps({'action': 'reload'})}\n\n"
 
@@ -99,20 +157,24 @@ def event_handler__new_user_message(request, event: EmittedEvent) -> EventHandle
     message = event["data"]["message"]
     conv_id = request.session["conv_id"]
     CommandSaveMessage.execute(conv_id, message)
-    thread = threading.Thread(
-        target=_submit_message_to_agent,
-        args=(request, message.message, conv_id),
-        daemon=True,
+    agent_scheduler.submit(
+        request.session.get("user_id"),
+        _submit_message_to_agent,
+        request,
+        message.message,
+        conv_id,
+        priority=Priority.INTERACTIVE,
     )
-    thread.start()
-    return EventHandlerAction.RELOAD
+    return EventHandlerAction.SYNC
 
 
 EVENT_HANDLER_CALLBACKS = {
     "NEW_CONVERSATION": event_handler__new_conversation,
     "NEW_USER_MESSAGE": event_handler__new_user_message,
-    "NEW_AGENT_MESSAGE": EventHandlerAction.RELOAD,
+    "NEW_AGENT_MESSAGE": EventHandlerAction.SYNC,
     "DELETE_CONVERSATION": EventHandlerAction.RELOAD,
+    "DELETE_CONVERSATIONS": EventHandlerAction.RELOAD,
+    "PURGE_CONVERSATIONS": EventHandlerAction.RELOAD,
 }
 SUBSCRIBER__EVENT_STREAM = "event_stream"
 
@@ -155,6 +217,32 @@ def handle_delete_chat(request, conv_id: int):
     return redirect("/chat")
 
 
+def handle_delete_chats(request):
+    if request.method != "POST":
+        return _handle_error(request, "Invalid delete chats request.")
+
+    try:
+        conv_ids = [int(conv_id) for conv_id in request.POST.getlist("conv_ids")]
+    except ValueError:
+        return _handle_error(request, "Invalid delete chats request.")
+
+    curr_user = get_current_user(request)
+    assert curr_user is not None
+    CommandDeleteConversations.execute(curr_user.id, conv_ids)
+    return redirect("/chat")
+
+
+def handle_fork_chat(request, conv_id: int, num_messages: int):
+    curr_user = get_current_user(request)
+    assert curr_user is not None
+    fork_id = CommandForkConversation.execute(curr_user.id, conv_id, num_messages)
+    if fork_id is None:
+        return _handle_error(request, "Could not fork this chat.")
+
+    request.session["conv_id"] = fork_id
+    return redirect("/chat")
+
+
 def handle_new_chat(request):
     if request.method != "POST":
         return _handle_error(request, "Invalid new chat request.")
@@ -183,11 +271,58 @@ def handle_new_user_message(request):
     if not form.is_valid():
         return _handle_error(request, "Invalid message request.")
 
+    user_id = request.session.get("user_id")
+    if user_id is not None:
+        if token_quota.remaining(user_id) <= 0:
+            return _handle_error(
+                request, "You have used your daily message allowance. Please come back tomorrow."
+            )
+        if not rate_limiter.allow(user_id):
+            return _handle_error(
+                request, "You are sending messages too quickly. Please wait a moment."
+            )
+
     message = Message(form.cleaned_data["message"], True)
     publish("NEW_USER_MESSAGE", data={"message": message})
     return redirect("/chat")
 
 
+def handle_sync_messages(request):
+    """
+    Messages of the selected conversation from the `since` sequence number onwards, as JSON
+    with the rendered HTML to append and the sequence number to pass next time.
+    """
+
+    if get_current_user(request) is None or "conv_id" not in request.session:
+        return JsonResponse({"error": "No conversation selected."}, status=400)
+    try:
+        since = max(int(request.GET.get("since", 0)), 0)
+    except ValueError:
+        return JsonResponse({"error": "Invalid sequence number."}, status=400)
+
+    result = QueryRetrieveMessagesSince.execute(request.session["conv_id"], since)
+    if not result["status"]:
+        return JsonResponse({"error": "Conversation not found."}, status=404)
+    messages = result["data"]
+    return JsonResponse(
+        {
+            "messages": [
+                {"seq": since + idx, "is_user": message.is_user, "message": message.message}
+                for idx, message in enumerate(messages)
+            ],
+            "html": render_to_string(
+                "messages.html",
+                {
+                    "chat_id": request.session["conv_id"],
+                    "messages": messages,
+                    "first_seq": since,
+                },
+            ),
+            "next_seq": result["next_seq"],
+        }
+    )
+
+
 def handle_download_pdf(request):
     conv_id = request.session["conv_id"]
     result = QueryRetrieveMessages.execute(conv_id)
@@ -259,22 +394,32 @@ def chat_view_controller(request):
     if curr_user is None:
         return redirect("/accounts")
 
+    limit = settings.CHAT_VIEW_RECENT_MESSAGES
+    if request.method == "POST":
+        limit = int(request.POST.get("limit", limit))
+        limit += settings.CHAT_VIEW_RECENT_MESSAGES  # load earlier messages on request
+
     conv_id = request.session["conv_id"]
-    result = QueryRetrieveMessages.execute(conv_id)
-    messages = result["data"]
+    # The page starts syncing new messages after the ones shown.
+    start = max(QueryCountMessages.execute(conv_id)["data"] - limit, 0)
+    result = QueryRetrieveMessagesSince.execute(conv_id, start)
 
-    for message in messages:
-        if message.markdown is None:
-            md = markdown.Markdown(extensions=["fenced_code"])
-            message.markdown = md.convert(message.message)
+    error = request.session.get("error", None)
+    if "error" in request.session:
+        del request.session["error"]
 
     context = {
         "chat_id": conv_id,
         "first_name": curr_user.first_name,
         "last_name": curr_user.last_name,
         "title": result["title"],
-        "messages": messages,
+        "messages": result["data"],
+        "first_seq": start,
+        "has_earlier": start > 0,
+        "next_seq": result["next_seq"],
+        "limit": limit,
         "message_form": MessageForm(),
+        "error": error,
     }
 
     return render(request, "chat.html", context)
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from openai import AsyncOpenAI
+
+ENV_VAR__HEDGE_PERCENTILE = "CHATBOT_HEDGE_PERCENTILE"
+ENV_VAR__HEDGE_FALLBACK_MODEL = "CHATBOT_HEDGE_FALLBACK_MODEL"
+ENV_VAR__HEDGE_INITIAL_DELAY = "CHATBOT_HEDGE_INITIAL_DELAY"
+ENV_VAR__HEDGE_MIN_DELAY = "CHATBOT_HEDGE_MIN_DELAY"
+
+HEDGE_PARAMS__INITIAL_DELAY = 8.0
+HEDGE_PARAMS__MIN_DELAY = 0.5
+HEDGE_PARAMS__MIN_SAMPLES = 20
+HEDGE_PARAMS__LATENCY_WINDOW = 500
+
+
+@dataclass
+class HedgingPolicy(object):
+    """
+    Decides how long to wait on the primary request before issuing a backup request.
+
+    Note:
+        The delay is the configured percentile of recently observed primary latencies of the
+        same model, since routed models differ widely in latency. Until enough samples have
+        been observed for a model, the initial delay is used instead.
+    """
+
+    percentile: float
+    fallback_model: Optional[str] = None
+    initial_delay: float = HEDGE_PARAMS__INITIAL_DELAY
+    min_delay: float = HEDGE_PARAMS__MIN_DELAY
+    min_samples: int = HEDGE_PARAMS__MIN_SAMPLES
+    _latencies: dict[Optional[str], deque[float]] = field(default_factory=dict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @classmethod
+    def from_env(cls) -> Optional["HedgingPolicy"]:
+        """
+        Build the deployment's hedging policy from environment variables.
+
+        Returns:
+            Optional[HedgingPolicy]: Configured policy, or None if hedging is disabled.
+        """
+
+        percentile = os.environ.get(ENV_VAR__HEDGE_PERCENTILE)
+        if percentile is None or float(percentile) <= 0:
+            return None
+        return cls(
+            percentile=float(percentile),
+            fallback_model=os.environ.get(ENV_VAR__HEDGE_FALLBACK_MODEL) or None,
+            initial_delay=float(
+                os.environ.get(ENV_VAR__HEDGE_INITIAL_DELAY, HEDGE_PARAMS__INITIAL_DELAY)
+            ),
+            min_delay=float(os.environ.get(ENV_VAR__HEDGE_MIN_DELAY, HEDGE_PARAMS__MIN_DELAY)),
+        )
+
+    def record(self, latency: float, model: Optional[str] = None):
+        with self._lock:
+            if model not in self._latencies:
+                self._latencies[model] = deque(maxlen=HEDGE_PARAMS__LATENCY_WINDOW)
+            self._latencies[model].append(latency)
+
+    def delay(self, model: Optional[str] = None) -> float:
+        with self._lock:
+            latencies = sorted(self._latencies.get(model, ()))
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        idx = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[idx])
+
+
+@dataclass
+class HedgingStats(object):
+    requests: int = 0
+    hedges: int = 0
+    backup_wins: int = 0
+    cancelled: int = 0
+
+
+class HedgedRequester(object):
+    """
+    Issues hedged `responses.create` requests on a dedicated event loop.
+
+    Note:
+        The event loop lives in a daemon thread for the lifetime of the requester so the async
+        client's connection pool is reused across calls. Callers block on the result from their
+        own thread. Losing requests are cancelled, which aborts the in-flight HTTP request.
+    """
+
+    def __init__(self, client: AsyncOpenAI, policy: HedgingPolicy):
+        self._client = client
+        self._policy = policy
+        self.stats = HedgingStats()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def create(self, request: dict[str, Any]) -> Any:
+        return asyncio.run_coroutine_threadsafe(self._hedged_create(request), self._loop).result()
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _hedged_create(self, request: dict[str, Any]) -> Any:
+        self.stats.requests += 1
+        model = request.get("model")
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(self._client.responses.create(**request))
+
+        done, _ = await asyncio.wait({primary}, timeout=self._policy.delay(model))
+        if primary in done:
+            self._policy.record(time.perf_counter() - start, model)
+            return primary.result()
+
+        self.stats.hedges += 1
+        backup_request = dict(request)
+        if self._policy.fallback_model is not None:
+            backup_request["model"] = self._policy.fallback_model
+        backup = asyncio.ensure_future(self._client.responses.create(**backup_request))
+
+        pending = {primary, backup}
+        winner: Optional[asyncio.Future] = None
+        while winner is None and len(pending):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # A failed attempt only loses if the other attempt can still succeed.
+            succeeded = [task for task in done if task.exception() is None]
+            if len(succeeded):
+                winner = primary if primary in succeeded else succeeded[0]
+            elif not len(pending):
+                winner = done.pop()
+
+        # The primary's latency is censored by the delay when the backup wins, record the
+        # elapsed time as a lower bound so the percentile keeps tracking the tail.
+        self._policy.record(time.perf_counter() - start, model)
+        for task in pending:
+            task.cancel()
+            self.stats.cancelled += 1
+        if winner is backup:
+            self.stats.backup_wins += 1
+        return winner.result()
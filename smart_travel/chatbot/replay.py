@@ -0,0 +1,230 @@
+import statistics
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Iterable, Optional
+
+from chat.utility.message import Message  # type: ignore
+from chat.utility.transcript import TranscriptFile  # type: ignore
+from chatbot.travel_chatbot import Chatbot
+from chatbot.usage import CompletionUsage, estimate_tokens
+
+# USD per million input, cached input and output tokens.
+REPLAY_PARAMS__PRICING: dict[str, tuple[float, float, float]] = {
+    "gpt-5.1": (1.25, 0.125, 10.0),
+    "gpt-5": (1.25, 0.125, 10.0),
+    "gpt-5-mini": (0.25, 0.025, 2.0),
+    "gpt-5-nano": (0.05, 0.005, 0.4),
+}
+REPLAY_PARAMS__WEB_SEARCH_COST = 0.01
+
+
+def estimate_cost(usage: CompletionUsage) -> Optional[float]:
+    """
+    Estimate the cost of a completion in USD.
+
+    Args:
+        usage (CompletionUsage): Usage of the completion.
+
+    Returns:
+        Optional[float]: Cost of the completion, or None if the model has no known pricing.
+    """
+
+    # Dated snapshots such as gpt-5-mini-2025-08-07 are priced like their base model.
+    model = max(
+        (name for name in REPLAY_PARAMS__PRICING if usage.model.startswith(name)),
+        key=len,
+        default=None,
+    )
+    if model is None:
+        return None
+
+    input_price, cached_price, output_price = REPLAY_PARAMS__PRICING[model]
+    uncached_tokens = usage.input_tokens - usage.cached_tokens
+    return (
+        uncached_tokens * input_price
+        + usage.cached_tokens * cached_price
+        + usage.output_tokens * output_price
+    ) / 1e6 + usage.web_search_calls * REPLAY_PARAMS__WEB_SEARCH_COST
+
+
+class RecordedBackend(object):
+    """
+    Offline backend answering every turn with the reply recorded in the transcript.
+
+    Note:
+        No usage is reported, so token counts are estimated from the text. Latency is
+        simulated as a base latency plus a per-token cost of the prompt and the reply.
+    """
+
+    def __init__(self, base_latency: float = 0.0, latency_per_1k_tokens: float = 0.0):
+        self.base_latency = base_latency
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.responses = self
+        self._reply = ""
+
+    def attach(self, chatbot: Chatbot):
+        chatbot._client = self  # type: ignore
+
+    def prepare_turn(self, recorded_reply: str):
+        self._reply = recorded_reply
+
+    def create(self, **request) -> Any:
+        num_tokens = estimate_tokens(
+            "".join(msg["content"] for msg in request["input"]) + self._reply
+        )
+        time.sleep(self.base_latency + num_tokens / 1000 * self.latency_per_1k_tokens)
+        return SimpleNamespace(
+            output_text=self._reply, model=request["model"], output=[], usage=None
+        )
+
+
+@dataclass
+class TurnReport(object):
+    transcript: str
+    turn: int
+    route: str
+    model: str
+    prompt_chars: int
+    estimated_tokens: int
+    input_tokens: int
+    output_tokens: int
+    cached_tokens: int
+    latency: float
+    cost: Optional[float]
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class ReplayReport(object):
+    turns: list[TurnReport] = field(default_factory=list)
+    failures: int = 0
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        latencies = sorted(turn.latency for turn in self.turns)
+        if not len(latencies):
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    @property
+    def total_cost(self) -> float:
+        return sum(turn.cost for turn in self.turns if turn.cost is not None)
+
+    @property
+    def unpriced_turns(self) -> int:
+        return sum(1 for turn in self.turns if turn.cost is None)
+
+    def summary(self) -> str:
+        if not len(self.turns):
+            return f"No turns replayed, {self.failures} failed."
+
+        routes: dict[str, int] = {}
+        for turn in self.turns:
+            routes[turn.route] = routes.get(turn.route, 0) + 1
+        lines = [
+            f"Turns: {len(self.turns)} ({self.failures} failed), "
+            + ", ".join(f"{route}: {count}" for route, count in sorted(routes.items())),
+            "Prompt chars: mean {:.0f}, max {}".format(
+                statistics.mean(turn.prompt_chars for turn in self.turns),
+                max(turn.prompt_chars for turn in self.turns),
+            ),
+            "Tokens: estimated {}, input {}, cached {}, output {}".format(
+                sum(turn.estimated_tokens for turn in self.turns),
+                sum(turn.input_tokens for turn in self.turns),
+                sum(turn.cached_tokens for turn in self.turns),
+                sum(turn.output_tokens for turn in self.turns),
+            ),
+            "Latency (s): "
+            + ", ".join(
+                f"p{p} {self.latency_percentile(p):.3f}" for p in (50, 90, 95, 99)
+            )
+            + f", max {max(turn.latency for turn in self.turns):.3f}",
+            f"Cost: ${self.total_cost:.4f}"
+            + (f" ({self.unpriced_turns} turns unpriced)" if self.unpriced_turns else ""),
+        ]
+        return "\n".join(lines)
+
+
+def read_transcript(path: Path) -> list[Message]:
+    return TranscriptFile(path).read_all()
+
+
+def replay_transcripts(
+    chatbot: Chatbot,
+    transcripts: Iterable[Path],
+    backend: Optional[RecordedBackend] = None,
+    max_history: Optional[int] = None,
+    on_turn: Optional[Callable[[TurnReport], None]] = None,
+) -> ReplayReport:
+    """
+    Replay recorded transcripts turn by turn through the chatbot.
+
+    Note:
+        Every user message is sent with the recorded conversation preceding it, so each turn
+        sees exactly the history it saw originally regardless of what the backend replies.
+
+    Args:
+        chatbot (Chatbot): Initialized chatbot the turns are sent through.
+        transcripts (Iterable[Path]): Transcript files to be replayed.
+        backend (Optional[RecordedBackend], optional): Recorded backend the chatbot is
+            configured with, told the recorded reply of each turn. Defaults to None.
+        max_history (Optional[int], optional): Only send this many of the most recent
+            messages with each turn. Defaults to None, sending the full history.
+        on_turn (Optional[Callable[[TurnReport], None]], optional): Called after each turn.
+
+    Returns:
+        ReplayReport: Reports of all replayed turns.
+    """
+
+    report = ReplayReport()
+    for path in transcripts:
+        try:
+            messages = read_transcript(path)
+        except Exception:
+            report.failures += 1
+            continue
+        for idx, message in enumerate(messages):
+            if not message.is_user:
+                continue
+
+            history = messages[: idx + 1]
+            if max_history is not None:
+                history = history[-max_history:]
+            if backend is not None:
+                recorded_reply = (
+                    messages[idx + 1].message
+                    if idx + 1 < len(messages) and not messages[idx + 1].is_user
+                    else ""
+                )
+                backend.prepare_turn(recorded_reply)
+
+            usages: list[CompletionUsage] = []
+            try:
+                chatbot.prompt_completion(history, on_usage=usages.append)
+            except Exception:
+                report.failures += 1
+                continue
+
+            usage = usages[-1]
+            prompt = chatbot.system_prompt + "".join(msg.message for msg in history)
+            turn = TurnReport(
+                transcript=path.name,
+                turn=idx,
+                route=usage.route,
+                model=usage.model,
+                prompt_chars=len(prompt),
+                estimated_tokens=estimate_tokens(prompt),
+                input_tokens=usage.input_tokens,
+                output_tokens=usage.output_tokens,
+                cached_tokens=usage.cached_tokens,
+                latency=usage.latency,
+                cost=estimate_cost(usage),
+            )
+            report.turns.append(turn)
+            if on_turn is not None:
+                on_turn(turn)
+
+    return report
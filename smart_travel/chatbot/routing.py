@@ -0,0 +1,118 @@
+import re
+import statistics
+import threading
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+from chat.utility.message import Message  # type: ignore
+
+ROUTING_PARAMS__FAST_MAX_WORDS = 25
+ROUTING_PARAMS__LATENCY_WINDOW = 1000
+
+# Requests that need fresh web data or long structured output (itineraries, budgets, safety
+# statistics, emergency services) are routed to the full model with web search enabled.
+ROUTING_PARAMS__FULL_KEYWORDS = re.compile(
+    r"\b("
+    r"itinerar(y|ies)|budget\w*|cost\w*|price\w*|expens\w*|afford\w*|"
+    r"plan|schedule|day[- ]by[- ]day|\d+[- ]days?|week(s|end)?|"
+    r"hotels?|lodging|flights?|accommodations?|"
+    r"safety|safe|crime|hospitals?|embass(y|ies)|police|emergenc(y|ies)|"
+    r"compare|comparison|rank\w*"
+    r")\b",
+    re.IGNORECASE,
+)
+ROUTING_PARAMS__AFFIRMATIVE = re.compile(
+    r"^\s*(yes|yeah|yep|sure|ok(ay)?|please( do)?|go ahead|sounds good|do it|let'?s do it)\b",
+    re.IGNORECASE,
+)
+
+
+class Route(Enum):
+    FAST = "fast"
+    FULL = "full"
+
+
+@dataclass(frozen=True)
+class RouteConfig(object):
+    model: str
+    use_tools: bool
+
+
+def classify_turn(history: list[Message]) -> Route:
+    """
+    Cheaply classify the latest turn of a conversation using local heuristics.
+
+    Note:
+        Short conversational turns and clarifying answers are routed to the fast model. Turns
+        asking for itineraries, budgets or other information requiring web search, long turns,
+        and affirmative replies to an agent offering an itinerary or budget are routed to the
+        full model.
+
+    Args:
+        history (list[Message]): Conversation history ending with the latest user message.
+
+    Returns:
+        Route: Route the turn should be sent down.
+    """
+
+    last_user_idx = next(
+        (idx for idx in range(len(history) - 1, -1, -1) if history[idx].is_user), None
+    )
+    if last_user_idx is None:
+        return Route.FAST
+
+    text = history[last_user_idx].message
+    if ROUTING_PARAMS__FULL_KEYWORDS.search(text):
+        return Route.FULL
+    if len(text.split()) > ROUTING_PARAMS__FAST_MAX_WORDS:
+        return Route.FULL
+
+    prev_agent_message = next(
+        (msg for msg in reversed(history[:last_user_idx]) if not msg.is_user), None
+    )
+    if (
+        prev_agent_message is not None
+        and ROUTING_PARAMS__AFFIRMATIVE.search(text)
+        and ROUTING_PARAMS__FULL_KEYWORDS.search(prev_agent_message.message)
+    ):
+        return Route.FULL
+
+    return Route.FAST
+
+
+class RoutingStats(object):
+    """
+    Thread-safe record of routing decisions and the latency observed for each route.
+    """
+
+    def __init__(self, window: int = ROUTING_PARAMS__LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._counts: dict[Route, int] = {route: 0 for route in Route}
+        self._latencies: dict[Route, deque[float]] = {
+            route: deque(maxlen=window) for route in Route
+        }
+
+    def record(self, route: Route, latency: float):
+        with self._lock:
+            self._counts[route] += 1
+            self._latencies[route].append(latency)
+
+    def count(self, route: Route) -> int:
+        with self._lock:
+            return self._counts[route]
+
+    def median_latency(self, route: Route) -> Optional[float]:
+        with self._lock:
+            latencies = list(self._latencies[route])
+        return statistics.median(latencies) if len(latencies) else None
+
+    def summary(self) -> dict[str, dict[str, Optional[float]]]:
+        return {
+            route.value: {
+                "count": self.count(route),
+                "median_latency": self.median_latency(route),
+            }
+            for route in Route
+        }
@@ -1,9 +1,120 @@
+import json
+import os
 import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
 
+from chat.utility.message import Message
 from django.test import TestCase  # type: ignore
+from openai import AsyncOpenAI
 
+from chatbot.hedging import HedgedRequester, HedgingPolicy
 from chatbot.pdf import PDFCreator
+from chatbot.replay import RecordedBackend, estimate_cost, replay_transcripts
+from chatbot.routing import Route, RoutingStats, classify_turn
+from chatbot.travel_chatbot import Chatbot
+from chatbot.usage import CompletionUsage, estimate_tokens
+
+
+class FakeResponses:
+    def __init__(self):
+        self.requests = []
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return SimpleNamespace(
+            output_text="Response",
+            model=kwargs["model"],
+            output=[SimpleNamespace(type="message")],
+            usage=SimpleNamespace(
+                input_tokens=120,
+                output_tokens=30,
+                input_tokens_details=SimpleNamespace(cached_tokens=100),
+            ),
+        )
+
+
+class FakeClient:
+    def __init__(self):
+        self.responses = FakeResponses()
+
+
+class FakeResponsesServer:
+    """
+    Local stand-in for the Responses API with injected latency.
+
+    Latency is looked up by model first, then taken from the queue of per-call latencies.
+    """
+
+    def __init__(self, model_latency=None, call_latency=None):
+        self.model_latency = model_latency or {}
+        self.call_latency = list(call_latency or [])
+        self.models_requested = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with server._lock:
+                    call_idx = len(server.models_requested)
+                    server.models_requested.append(body["model"])
+                    latency = server.model_latency.get(
+                        body["model"],
+                        server.call_latency[call_idx] if call_idx < len(server.call_latency) else 0,
+                    )
+                time.sleep(latency)
+                payload = json.dumps(
+                    {
+                        "id": f"resp_{call_idx}",
+                        "object": "response",
+                        "created_at": 0,
+                        "model": body["model"],
+                        "status": "completed",
+                        "output": [
+                            {
+                                "type": "message",
+                                "id": f"msg_{call_idx}",
+                                "role": "assistant",
+                                "status": "completed",
+                                "content": [
+                                    {
+                                        "type": "output_text",
+                                        "text": f"call {call_idx} from {body['model']}",
+                                        "annotations": [],
+                                    }
+                                ],
+                            }
+                        ],
+                    }
+                ).encode("utf-8")
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The client cancelled this request.
+
+            def log_message(self, *_):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
 
 
 class PDFCreatorTests(TestCase):
@@ -24,3 +135,330 @@ class PDFCreatorTests(TestCase):
 
             self.assertTrue(file_path.exists())
             self.assertGreater(file_path.stat().st_size, 0)
+
+
+class ClassifyTurnTests(TestCase):
+    def test_short_conversational_turn_is_fast(self):
+        history = [Message("Hi! I love beaches and warm weather.", True)]
+        self.assertEqual(classify_turn(history), Route.FAST)
+
+    def test_itinerary_request_is_full(self):
+        history = [Message("Can you make me a 3-day itinerary for Lisbon?", True)]
+        self.assertEqual(classify_turn(history), Route.FULL)
+
+    def test_budget_request_is_full(self):
+        history = [Message("What would the budget look like?", True)]
+        self.assertEqual(classify_turn(history), Route.FULL)
+
+    def test_long_turn_is_full(self):
+        history = [Message(" ".join(["word"] * 40), True)]
+        self.assertEqual(classify_turn(history), Route.FULL)
+
+    def test_affirmative_reply_to_itinerary_offer_is_full(self):
+        history = [
+            Message("I think Kyoto sounds perfect.", True),
+            Message("Great choice! Would you like me to generate an itinerary?", False),
+            Message("Yes please", True),
+        ]
+        self.assertEqual(classify_turn(history), Route.FULL)
+
+    def test_affirmative_reply_to_question_is_fast(self):
+        history = [
+            Message("Do you enjoy hiking?", False),
+            Message("Yes, quite a lot", True),
+        ]
+        self.assertEqual(classify_turn(history), Route.FAST)
+
+    def test_empty_history_is_fast(self):
+        self.assertEqual(classify_turn([]), Route.FAST)
+
+
+class RoutingStatsTests(TestCase):
+    def test_record_and_summary(self):
+        stats = RoutingStats()
+        stats.record(Route.FAST, 0.1)
+        stats.record(Route.FAST, 0.3)
+        stats.record(Route.FULL, 2.0)
+
+        self.assertEqual(stats.count(Route.FAST), 2)
+        self.assertAlmostEqual(stats.median_latency(Route.FAST), 0.2)
+        self.assertEqual(stats.summary()["full"]["count"], 1)
+
+    def test_median_latency_no_samples(self):
+        self.assertIsNone(RoutingStats().median_latency(Route.FULL))
+
+
+class ChatbotRoutingTests(TestCase):
+    def setUp(self):
+        self.chatbot = Chatbot(model="full-model", fast_model="fast-model")
+        self.chatbot._client = FakeClient()
+
+    def test_fast_route_uses_fast_model_without_tools(self):
+        self.chatbot.prompt_completion([Message("Hello there!", True)])
+
+        request = self.chatbot._client.responses.requests[-1]
+        self.assertEqual(request["model"], "fast-model")
+        self.assertNotIn("tools", request)
+        self.assertEqual(self.chatbot.routing_stats.count(Route.FAST), 1)
+
+    def test_full_route_uses_full_model_with_web_search(self):
+        self.chatbot.prompt_completion([Message("Plan a budget for Rome", True)])
+
+        request = self.chatbot._client.responses.requests[-1]
+        self.assertEqual(request["model"], "full-model")
+        self.assertEqual(request["tools"], [{"type": "web_search"}])
+        self.assertEqual(self.chatbot.routing_stats.count(Route.FULL), 1)
+
+    def test_context_is_sent_as_system_message(self):
+        self.chatbot.prompt_completion(
+            [Message("Hello there!", True)], context=["The Louvre is closed on Tuesdays."]
+        )
+
+        request = self.chatbot._client.responses.requests[-1]
+        self.assertEqual(request["input"][1]["role"], "system")
+        self.assertIn("- The Louvre is closed on Tuesdays.", request["input"][1]["content"])
+
+    def test_no_context_no_extra_message(self):
+        self.chatbot.prompt_completion([Message("Hello there!", True)], context=[])
+
+        request = self.chatbot._client.responses.requests[-1]
+        self.assertEqual(len(request["input"]), 2)
+
+    def test_routing_disabled_always_uses_full_model(self):
+        chatbot = Chatbot(model="full-model", fast_model="fast-model", routing=False)
+        chatbot._client = FakeClient()
+        chatbot.prompt_completion([Message("Hello there!", True)])
+
+        self.assertEqual(chatbot._client.responses.requests[-1]["model"], "full-model")
+
+    def test_positional_arguments_keep_their_meaning(self):
+        chatbot = Chatbot("full-model", 0.2, 0.5)
+
+        self.assertEqual(chatbot._temperature, 0.2)
+        self.assertEqual(chatbot._top_p, 0.5)
+        self.assertEqual(chatbot._routes[Route.FAST].model, "gpt-5-mini")
+
+
+class HedgingPolicyTests(TestCase):
+    def test_initial_delay_until_enough_samples(self):
+        policy = HedgingPolicy(percentile=90, initial_delay=5.0, min_samples=3)
+        policy.record(0.1)
+        self.assertEqual(policy.delay(), 5.0)
+
+    def test_percentile_delay(self):
+        policy = HedgingPolicy(percentile=90, min_delay=0.0, min_samples=10)
+        for latency in range(1, 11):
+            policy.record(float(latency))
+        self.assertEqual(policy.delay(), 10.0)
+
+    def test_min_delay_floor(self):
+        policy = HedgingPolicy(percentile=50, min_delay=1.0, min_samples=1)
+        policy.record(0.01)
+        self.assertEqual(policy.delay(), 1.0)
+
+    def test_latencies_are_kept_per_model(self):
+        policy = HedgingPolicy(percentile=50, min_delay=0.0, initial_delay=5.0, min_samples=2)
+        for _ in range(2):
+            policy.record(0.2, "fast-model")
+            policy.record(4.0, "full-model")
+        self.assertEqual(policy.delay("fast-model"), 0.2)
+        self.assertEqual(policy.delay("full-model"), 4.0)
+        self.assertEqual(policy.delay("other-model"), 5.0)
+
+    def test_from_env(self):
+        env = {"CHATBOT_HEDGE_PERCENTILE": "95", "CHATBOT_HEDGE_FALLBACK_MODEL": "backup"}
+        with patch.dict(os.environ, env):
+            policy = HedgingPolicy.from_env()
+        self.assertEqual(policy.percentile, 95.0)
+        self.assertEqual(policy.fallback_model, "backup")
+
+    def test_from_env_disabled(self):
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(HedgingPolicy.from_env())
+
+
+class HedgedRequesterTests(TestCase):
+    REQUEST = {"input": [{"role": "user", "content": "Hi"}], "model": "primary"}
+
+    def _requester(self, server, policy):
+        client = AsyncOpenAI(api_key="test", base_url=server.base_url, max_retries=0)
+        requester = HedgedRequester(client, policy)
+        self.addCleanup(requester.close)
+        return requester
+
+    def test_fast_primary_is_not_hedged(self):
+        server = FakeResponsesServer(model_latency={"primary": 0.0})
+        self.addCleanup(server.close)
+        requester = self._requester(server, HedgingPolicy(percentile=95, initial_delay=1.0))
+
+        response = requester.create(self.REQUEST)
+
+        self.assertEqual(response.output_text, "call 0 from primary")
+        self.assertEqual(requester.stats.hedges, 0)
+        self.assertEqual(server.models_requested, ["primary"])
+
+    def test_slow_primary_hedges_to_fallback_model(self):
+        server = FakeResponsesServer(model_latency={"primary": 3.0, "fallback": 0.0})
+        self.addCleanup(server.close)
+        policy = HedgingPolicy(percentile=95, fallback_model="fallback", initial_delay=0.1)
+        requester = self._requester(server, policy)
+
+        start = time.perf_counter()
+        response = requester.create(self.REQUEST)
+
+        self.assertLess(time.perf_counter() - start, 2.0)
+        self.assertEqual(response.output_text, "call 1 from fallback")
+        self.assertEqual(requester.stats.hedges, 1)
+        self.assertEqual(requester.stats.backup_wins, 1)
+        self.assertEqual(requester.stats.cancelled, 1)
+
+    def test_slow_primary_hedges_to_same_model(self):
+        server = FakeResponsesServer(call_latency=[3.0, 0.0])
+        self.addCleanup(server.close)
+        requester = self._requester(server, HedgingPolicy(percentile=95, initial_delay=0.1))
+
+        response = requester.create(self.REQUEST)
+
+        self.assertEqual(response.output_text, "call 1 from primary")
+        self.assertEqual(server.models_requested, ["primary", "primary"])
+
+    def test_primary_wins_after_hedge(self):
+        server = FakeResponsesServer(call_latency=[0.3, 3.0])
+        self.addCleanup(server.close)
+        requester = self._requester(server, HedgingPolicy(percentile=95, initial_delay=0.1))
+
+        response = requester.create(self.REQUEST)
+
+        self.assertEqual(response.output_text, "call 0 from primary")
+        self.assertEqual(requester.stats.hedges, 1)
+        self.assertEqual(requester.stats.backup_wins, 0)
+
+
+class ChatbotHedgingTests(TestCase):
+    def test_prompt_completion_hedges_through_fake_server(self):
+        server = FakeResponsesServer(model_latency={"fast-model": 3.0, "fallback": 0.0})
+        self.addCleanup(server.close)
+        policy = HedgingPolicy(percentile=95, fallback_model="fallback", initial_delay=0.1)
+        chatbot = Chatbot(model="full-model", fast_model="fast-model", hedging=policy)
+
+        env = {"OPENAI_API_KEY": "test", "OPENAI_BASE_URL": server.base_url}
+        with patch.dict(os.environ, env):
+            self.assertTrue(chatbot.initialize_session())
+        self.addCleanup(chatbot._hedged_requester.close)
+
+        response = chatbot.prompt_completion([Message("Hello!", True)])
+        self.assertEqual(response, "call 1 from fallback")
+
+
+class CompletionUsageTests(TestCase):
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertEqual(estimate_tokens("abcd"), 1)
+        self.assertEqual(estimate_tokens("abcde"), 2)
+
+    def test_from_response_with_usage(self):
+        response = SimpleNamespace(
+            output_text="Hi",
+            model="gpt-test",
+            output=[
+                SimpleNamespace(type="web_search_call"),
+                SimpleNamespace(type="web_search_call"),
+                SimpleNamespace(type="message"),
+            ],
+            usage=SimpleNamespace(
+                input_tokens=10,
+                output_tokens=5,
+                input_tokens_details=SimpleNamespace(cached_tokens=4),
+            ),
+        )
+        usage = CompletionUsage.from_response(
+            response, model="requested", route="full", latency=1.5, prompt="ignored"
+        )
+        self.assertEqual(usage.model, "gpt-test")
+        self.assertEqual(usage.input_tokens, 10)
+        self.assertEqual(usage.output_tokens, 5)
+        self.assertEqual(usage.cached_tokens, 4)
+        self.assertEqual(usage.web_search_calls, 2)
+        self.assertEqual(usage.latency, 1.5)
+
+    def test_from_response_without_usage_is_estimated(self):
+        response = SimpleNamespace(output_text="abcdefgh", usage=None)
+        usage = CompletionUsage.from_response(
+            response, model="requested", route="fast", latency=0.1, prompt="a" * 40
+        )
+        self.assertEqual(usage.model, "requested")
+        self.assertEqual(usage.input_tokens, 10)
+        self.assertEqual(usage.output_tokens, 2)
+        self.assertEqual(usage.web_search_calls, 0)
+
+    def test_prompt_completion_reports_usage(self):
+        chatbot = Chatbot(model="full-model", fast_model="fast-model")
+        chatbot._client = FakeClient()
+        reported = []
+
+        chatbot.prompt_completion([Message("Hello!", True)], on_usage=reported.append)
+
+        self.assertEqual(len(reported), 1)
+        self.assertEqual(reported[0].model, "fast-model")
+        self.assertEqual(reported[0].route, "fast")
+        self.assertEqual(reported[0].input_tokens, 120)
+        self.assertEqual(reported[0].cached_tokens, 100)
+
+
+class EstimateCostTests(TestCase):
+    def test_known_model(self):
+        usage = CompletionUsage("gpt-5-mini-2025-08-07", "fast", 1_000_000, 1_000_000, 0, 1.0, 0)
+        self.assertAlmostEqual(estimate_cost(usage), 2.25)
+
+    def test_cached_tokens_and_web_search(self):
+        usage = CompletionUsage("gpt-5.1", "full", 1_000_000, 0, 1_000_000, 1.0, 2)
+        self.assertAlmostEqual(estimate_cost(usage), 0.145)
+
+    def test_unknown_model(self):
+        self.assertIsNone(estimate_cost(CompletionUsage("other", "fast", 1, 1, 0, 1.0, 0)))
+
+
+class ReplayTranscriptsTests(TestCase):
+    TRANSCRIPT = (
+        "### User\nHello!\n"
+        "### Agent\nHi, where would you like to go?\n"
+        "### User\nPlan a 3 day itinerary for Rome\n"
+        "### Agent\nDay 1: the Colosseum.\n"
+    )
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.transcript = Path(self.tmp_dir.name) / "convo.txt"
+        self.transcript.write_text(self.TRANSCRIPT)
+        self.chatbot = Chatbot(model="gpt-5.1", fast_model="gpt-5-mini")
+        self.backend = RecordedBackend()
+        self.backend.attach(self.chatbot)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_replays_each_user_turn(self):
+        report = replay_transcripts(self.chatbot, [self.transcript], backend=self.backend)
+
+        self.assertEqual([turn.turn for turn in report.turns], [0, 2])
+        self.assertEqual([turn.route for turn in report.turns], ["fast", "full"])
+        self.assertEqual(report.turns[1].model, "gpt-5.1")
+        self.assertGreater(report.turns[1].prompt_chars, report.turns[0].prompt_chars)
+        self.assertEqual(report.turns[1].output_tokens, 6)
+        self.assertGreater(report.total_cost, 0)
+        self.assertIn("Turns: 2 (0 failed)", report.summary())
+
+    def test_max_history(self):
+        full = replay_transcripts(self.chatbot, [self.transcript], backend=self.backend)
+        windowed = replay_transcripts(
+            self.chatbot, [self.transcript], backend=self.backend, max_history=1
+        )
+
+        self.assertLess(windowed.turns[1].prompt_chars, full.turns[1].prompt_chars)
+
+    def test_simulated_latency(self):
+        backend = RecordedBackend(base_latency=0.01)
+        backend.attach(self.chatbot)
+        report = replay_transcripts(self.chatbot, [self.transcript], backend=backend)
+
+        self.assertGreaterEqual(report.latency_percentile(50), 0.01)
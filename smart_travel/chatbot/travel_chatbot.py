@@ -1,19 +1,27 @@
 import os
+import time
 from pathlib import Path
-from typing import Literal, Optional
+from typing import Any, Callable, Literal, Optional
 
 from chat.utility.message import Message  # type: ignore
+from chatbot.hedging import HedgedRequester, HedgingPolicy
+from chatbot.routing import Route, RouteConfig, RoutingStats, classify_turn
+from chatbot.usage import CompletionUsage
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
 load_dotenv()
 
 ENV_VAR__API_KEY = "OPENAI_API_KEY"
 SYSTEM_PROMPT_PATH = Path(__file__).parent / "prompt.txt"
+CONTEXT_PREAMBLE = (
+    "Excerpts from your earlier replies to this user that may be relevant. Reuse them where "
+    "they still apply instead of searching again:\n\n"
+)
 
 
-def _read_system_prompt() -> str:
-    with open(SYSTEM_PROMPT_PATH, "r") as infile:
+def _read_system_prompt(path: Path = SYSTEM_PROMPT_PATH) -> str:
+    with open(path, "r") as infile:
         return "\n".join(infile.readlines())
 
 
@@ -25,12 +33,34 @@ def _create_chatbot_message(
 
 class Chatbot:
     def __init__(
-        self, model: str = "gpt-5.1", temperature: float = 0.7, top_p: float = 0.99
+        self,
+        model: str = "gpt-5.1",
+        temperature: float = 0.7,
+        top_p: float = 0.99,
+        fast_model: str = "gpt-5-mini",
+        routing: bool = True,
+        hedging: Optional[HedgingPolicy] = None,
+        system_prompt_path: Path = SYSTEM_PROMPT_PATH,
     ):
         self._model: str = model
         self._temperature: float = temperature
         self._top_p: float = top_p
         self._client: Optional[OpenAI] = None
+        self._routing: bool = routing
+        self._routes: dict[Route, RouteConfig] = {
+            Route.FULL: RouteConfig(model=model, use_tools=True),
+            Route.FAST: RouteConfig(model=fast_model, use_tools=False),
+        }
+        self.routing_stats = RoutingStats()
+        self._hedging: Optional[HedgingPolicy] = (
+            hedging if hedging is not None else HedgingPolicy.from_env()
+        )
+        self._hedged_requester: Optional[HedgedRequester] = None
+        self._system_prompt_path: Path = system_prompt_path
+
+    @property
+    def system_prompt(self) -> str:
+        return _read_system_prompt(self._system_prompt_path)
 
     def initialize_session(self) -> bool:
         api_key = os.environ.get(ENV_VAR__API_KEY)
@@ -38,14 +68,43 @@ class Chatbot:
             return False
         try:
             self._client = OpenAI(api_key=api_key)
+            if self._hedging is not None:
+                self._hedged_requester = HedgedRequester(
+                    AsyncOpenAI(api_key=api_key), self._hedging
+                )
             return True
         except Exception:
             return False
 
-    def prompt_completion(self, history: list[Message]) -> Optional[str]:
+    def prompt_completion(
+        self,
+        history: list[Message],
+        on_usage: Optional[Callable[[CompletionUsage], None]] = None,
+        context: Optional[list[str]] = None,
+    ) -> Optional[str]:
+        """
+        Generate the agent's next reply to the conversation.
+
+        Args:
+            history (list[Message]): Conversation so far, ending with the user's message.
+            on_usage (Optional[Callable[[CompletionUsage], None]], optional): Called with the
+                upstream usage of the completion. Defaults to None.
+            context (Optional[list[str]], optional): Relevant excerpts of earlier replies given
+                to the model as extra context. Defaults to None.
+
+        Returns:
+            Optional[str]: The agent's reply.
+        """
         assert self._client is not None
 
-        messages = [_create_chatbot_message("system", _read_system_prompt())]
+        messages = [_create_chatbot_message("system", self.system_prompt)]
+        if context:
+            messages.append(
+                _create_chatbot_message(
+                    "system",
+                    CONTEXT_PREAMBLE + "\n\n".join(f"- {snippet}" for snippet in context),
+                )
+            )
         for msg in history:
             messages.append(
                 _create_chatbot_message(
@@ -53,10 +112,29 @@ class Chatbot:
                 )
             )
 
-        response = self._client.responses.create(
-            input=messages,  # type: ignore
-            model=self._model,
-            tools=[{"type": "web_search"}],
-        )
+        route = classify_turn(history) if self._routing else Route.FULL
+        route_config = self._routes[route]
+        request: dict[str, Any] = {"input": messages, "model": route_config.model}
+        if route_config.use_tools:
+            request["tools"] = [{"type": "web_search"}]
+
+        start = time.perf_counter()
+        if self._hedged_requester is not None:
+            response = self._hedged_requester.create(request)
+        else:
+            response = self._client.responses.create(**request)
+        latency = time.perf_counter() - start
+        self.routing_stats.record(route, latency)
+
+        if on_usage is not None:
+            on_usage(
+                CompletionUsage.from_response(
+                    response,
+                    model=route_config.model,
+                    route=route.value,
+                    latency=latency,
+                    prompt="".join(msg["content"] for msg in messages),
+                )
+            )
 
         return response.output_text
@@ -0,0 +1,79 @@
+import math
+from dataclasses import dataclass
+from typing import Any
+
+USAGE_PARAMS__CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a piece of text without a tokenizer.
+
+    Args:
+        text (str): Text to be estimated.
+
+    Returns:
+        int: Estimated token count, roughly four characters per token for English text.
+    """
+
+    return math.ceil(len(text) / USAGE_PARAMS__CHARS_PER_TOKEN)
+
+
+@dataclass
+class CompletionUsage(object):
+    model: str
+    route: str
+    input_tokens: int
+    output_tokens: int
+    cached_tokens: int
+    latency: float
+    web_search_calls: int
+
+    @classmethod
+    def from_response(
+        cls, response: Any, model: str, route: str, latency: float, prompt: str
+    ) -> "CompletionUsage":
+        """
+        Extract the upstream usage of a Responses API call.
+
+        Note:
+            If the response carries no usage, token counts are estimated from the prompt and
+            the output text.
+
+        Args:
+            response (Any): Response returned by `responses.create`.
+            model (str): Model requested, used if the response does not name one.
+            route (str): Route the request was sent down.
+            latency (float): Wall-clock latency of the call in seconds.
+            prompt (str): Concatenated prompt text, used only for estimation.
+
+        Returns:
+            CompletionUsage: Usage of the call.
+        """
+
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            input_tokens = usage.input_tokens
+            output_tokens = usage.output_tokens
+            details = getattr(usage, "input_tokens_details", None)
+            cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+        else:
+            input_tokens = estimate_tokens(prompt)
+            output_tokens = estimate_tokens(response.output_text or "")
+            cached_tokens = 0
+
+        web_search_calls = sum(
+            1
+            for item in (getattr(response, "output", None) or [])
+            if getattr(item, "type", None) == "web_search_call"
+        )
+
+        return cls(
+            model=getattr(response, "model", None) or model,
+            route=route,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            cached_tokens=cached_tokens,
+            latency=latency,
+            web_search_calls=web_search_calls,
+        )
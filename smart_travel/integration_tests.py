@@ -9,7 +9,9 @@ from unittest.mock import patch
 
 from accounts.models import AccountModel
 from chat.models import ConversationModel
+from chat.utility.locks import LockManager
 from chat.utility.message import Message
+from chat.utility.transcript import TranscriptFile
 from chat.views import event_handler__new_conversation, event_handler__new_user_message
 from django.contrib.auth.hashers import make_password  # type: ignore
 from django.test import Client, TestCase, TransactionTestCase  # type: ignore
@@ -27,7 +29,7 @@ class MockedChatbot:
     def initialize_session(self) -> bool:
         return False
 
-    def prompt_completion(self, _: list[Message]) -> Optional[str]:
+    def prompt_completion(self, _: list[Message], **__) -> Optional[str]:
         return MOCK__PROMPT_COMPLETION__RET_VAL
 
 
@@ -71,6 +73,13 @@ def clear_events():
         continue
 
 
+def remove_transcript(transcript: TranscriptFile):
+    # Transcripts keep their lock file once deleted, tests writing to the media directory
+    # remove it too.
+    transcript.delete()
+    LockManager.lock_path(transcript.path).unlink(missing_ok=True)
+
+
 """
 Tests
 """
@@ -350,7 +359,7 @@ class MessagePersistenceWorkflowTests(TestCase):
             self.assertFalse(retrieved_messages[3].is_user)
         finally:
             if file_path.exists():
-                file_path.unlink()
+                TranscriptFile(file_path).delete()
 
 
 class MultiUserIsolationTests(TestCase):
@@ -513,8 +522,7 @@ class AgentConversationWorkflowTests(TransactionTestCase):
             self.assertNotIn("user_id", self.client.session)
 
         finally:
-            if conversation.abs_path.exists():
-                conversation.abs_path.unlink()
+            remove_transcript(conversation.transcript)
             MOCK__PROMPT_COMPLETION__RET_VAL = None
 
     @patch("chat.views.chatbot", new_callable=MockedChatbot)
@@ -578,8 +586,7 @@ class AgentConversationWorkflowTests(TransactionTestCase):
             self.assertIn("Colosseum", agent_messages[0].message)
 
         finally:
-            if conversation.abs_path.exists():
-                conversation.abs_path.unlink()
+            remove_transcript(conversation.transcript)
             MOCK__PROMPT_COMPLETION__RET_VAL = None
 
     @patch("chat.views.chatbot", new_callable=MockedChatbot)
@@ -651,6 +658,5 @@ class AgentConversationWorkflowTests(TransactionTestCase):
                 self.assertEqual(len([m for m in messages if not m.is_user]), 3)
 
         finally:
-            if conversation.abs_path.exists():
-                conversation.abs_path.unlink()
+            remove_transcript(conversation.transcript)
             MOCK__PROMPT_COMPLETION__RET_VAL = None
@@ -124,3 +124,59 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 SESSION_ENGINE = "django.contrib.sessions.backends.db"
+
+# Chat
+
+# Number of worker threads serving agent calls, shared fairly across users.
+CHAT_AGENT_WORKERS = 4
+
+# Number of most recent messages sent to the agent as history, and shown when opening a chat.
+CHAT_AGENT_HISTORY_MESSAGES = 40
+CHAT_VIEW_RECENT_MESSAGES = 50
+
+# Per-account message rate limit: burst size and sustained messages per second.
+CHAT_RATE_LIMIT_BURST = 10
+CHAT_RATE_LIMIT_PER_SECOND = 0.2
+
+# Per-account daily token quota, and how often in-memory usage is flushed to the database.
+CHAT_DAILY_TOKEN_QUOTA = 200_000
+CHAT_TOKEN_QUOTA_FLUSH_INTERVAL = 30
+
+# Local retrieval over earlier replies. Near-duplicate questions scoring at least the duplicate
+# score are answered with the earlier reply, otherwise up to the given number of relevant
+# excerpts scoring at least the minimum score are sent as context. Reused replies may quote
+# outdated prices or availability, so this is off (None) unless a score, e.g. 0.95, is set.
+CHAT_RETRIEVAL_DUPLICATE_SCORE = None
+CHAT_RETRIEVAL_CONTEXT_SNIPPETS = 3
+CHAT_RETRIEVAL_MIN_SCORE = 0.3
+
+# Memory budget of the in-process cache of parsed transcripts, and the largest transcript it
+# will hold. Larger transcripts are read directly from disk.
+CHAT_TRANSCRIPT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+CHAT_TRANSCRIPT_CACHE_MAX_ENTRY_BYTES = 4 * 1024 * 1024
+
+# Transcript appends from concurrent chats are group committed. A commit waits the given delay
+# in seconds for more messages to join, and takes at most the given number of messages. With
+# the "always" fsync policy every commit is forced to disk, with "never" it is left to the OS.
+CHAT_GROUP_COMMIT_DELAY = 0.0
+CHAT_GROUP_COMMIT_MAX_BATCH = 256
+CHAT_TRANSCRIPT_FSYNC = "never"
+
+# Where messages are stored: "file" appends to a transcript file per conversation, "database"
+# stores one indexed MessageModel row per message, "sqlite_blob" stores messages in a separate
+# SQLite database at CHAT_SQLITE_BLOB_PATH and "memory" keeps them in process memory only.
+# Import existing transcripts with `manage.py import_transcripts` before switching to
+# "database". Compare the backends with `manage.py benchmark storage`.
+CHAT_MESSAGE_STORE = "file"
+CHAT_SQLITE_BLOB_PATH = BASE_DIR / "media" / "messages.sqlite3"
+
+# `manage.py archive_transcripts` compresses the transcripts of conversations without new
+# messages for the given number of days, with "gzip" or the slower but smaller "lzma".
+# Archived transcripts are read transparently and restored by the next message.
+CHAT_TRANSCRIPT_ARCHIVE_AFTER_DAYS = 30
+CHAT_TRANSCRIPT_ARCHIVE_CODEC = "gzip"
+
+# `manage.py purge_conversations` deletes conversations without new messages for the given
+# number of days, a chunk of conversations per transaction. None keeps them forever unless
+# `--days` is passed.
+CHAT_RETENTION_DAYS = None